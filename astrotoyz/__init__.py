@@ -16,6 +16,10 @@ if not _ASTROPY_SETUP_:
     from astrotoyz import tasks
     from astrotoyz import viewer
     from astrotoyz import detect_sources
+    from astrotoyz import seeing
+    from astrotoyz import display_stats
+    from astrotoyz import header_index
+    from astrotoyz import task_queue
     from astrotoyz import io
     from astrotoyz import data_types
     from astrotoyz import config
\ No newline at end of file
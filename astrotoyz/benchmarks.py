@@ -0,0 +1,292 @@
+"""
+Benchmarks for the fitting functions in Astro-Toyz
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import time
+import numpy as np
+
+import astrotoyz.kernels as kernels
+from astrotoyz import detect_sources
+
+# Parameters (in the order used by each model function) for the synthetic sources
+# used in the benchmarks. The positions are offset from the center of the stamp.
+benchmark_params = {
+    'circular_moffat': (1000., .3, -.2, 3., 3.5, 100.),
+    'elliptical_moffat': (1000., .3, -.2, 3., 2., 3.5, .5, 100.),
+    'circular_gaussian': (1000., .3, -.2, 2., 100.),
+    'elliptical_gaussian': (1000., .3, -.2, 2.5, 1.5, .5, 100.)
+}
+
+def make_stamp(model_name, size=21, noise=5., params=None, seed=None):
+    """
+    Create a synthetic stamp containing a single source
+
+    Parameters
+    ----------
+    model_name: str
+        Name of the model used to generate the source (a key in ``benchmark_params``)
+    size: int, optional
+        Width and height of the stamp
+    noise: float, optional
+        Standard deviation of the gaussian noise added to the stamp
+    params: tuple, optional
+        Parameters of the model. Positions are relative to the center of the stamp.
+        Defaults to ``benchmark_params[model_name]``
+    seed: int, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    stamp: 2D numpy array
+    """
+    if params is None:
+        params = benchmark_params[model_name]
+    params = list(params)
+    params[1] += size//2
+    params[2] += size//2
+    x, y = np.meshgrid(np.arange(size, dtype=float), np.arange(size, dtype=float))
+    model = getattr(detect_sources, model_name)
+    stamp = model((x,y), *params).reshape(size, size)
+    random = np.random.RandomState(seed)
+    return stamp + random.normal(0, noise, stamp.shape)
+
+def time_fits(model_name, stamps):
+    """
+    Fit each stamp in ``stamps`` and return the mean time per fit (in seconds)
+    """
+    fit_func = detect_sources.fit_types[model_name]
+    start = time.time()
+    for stamp in stamps:
+        fit_func(stamp)
+    return (time.time()-start)/len(stamps)
+
+def benchmark_models(size=21, num_fits=50, models=None):
+    """
+    Compare the time per fit of the numpy and compiled (numba) implementation of each model
+
+    Parameters
+    ----------
+    size: int, optional
+        Width and height of each stamp
+    num_fits: int, optional
+        Number of stamps fit for each model
+    models: list, optional
+        Names of the models to benchmark. Defaults to all of the models in ``benchmark_params``
+
+    Returns
+    -------
+    result: dict
+        For each model a dict with the mean time per fit for the ``numpy`` and ``compiled``
+        kernels (``None`` if numba is not installed) and the ``speedup``
+    """
+    if models is None:
+        models = sorted(benchmark_params.keys())
+    use_compiled = kernels.use_compiled
+    result = {}
+    try:
+        for model_name in models:
+            stamps = [make_stamp(model_name, size, seed=n) for n in range(num_fits)]
+            kernels.use_compiled = False
+            numpy_time = time_fits(model_name, stamps)
+            compiled_time = None
+            speedup = None
+            if kernels.numba is not None:
+                kernels.use_compiled = True
+                # Run one fit first so that the compilation time is not included
+                time_fits(model_name, stamps[:1])
+                compiled_time = time_fits(model_name, stamps)
+                speedup = numpy_time/compiled_time
+            result[model_name] = {
+                'numpy': numpy_time,
+                'compiled': compiled_time,
+                'speedup': speedup
+            }
+    finally:
+        kernels.use_compiled = use_compiled
+    return result
+
+def print_benchmarks(result):
+    """
+    Print the results of one of the benchmarks as a table
+    """
+    columns = sorted(next(iter(result.values())).keys())
+    print('{0:<22}'.format('model')+''.join(['{0:>14}'.format(col) for col in columns]))
+    for model_name in sorted(result):
+        row = []
+        for col in columns:
+            value = result[model_name][col]
+            if value is None:
+                row.append('{0:>14}'.format('-'))
+            elif isinstance(value, float):
+                row.append('{0:>14.6g}'.format(value))
+            else:
+                row.append('{0:>14}'.format(value))
+        print('{0:<22}'.format(model_name)+''.join(row))
+
+def make_field(model_name, shape=(512,512), num_sources=200, noise=5., floor=100.,
+        seed=None, width_range=(.7, 1.5)):
+    """
+    Create a synthetic field of sources with a wide range of amplitudes and shapes,
+    including faint sources near the noise level and sources near the edges of the image.
+    The width of each source is multiplied by a random factor in ``width_range``.
+
+    Returns
+    -------
+    field: 2D numpy array
+        Image of the field
+    positions: 2D numpy array
+        ``(x,y)`` position of each source, with shape ``(num_sources, 2)``
+    """
+    random = np.random.RandomState(seed)
+    height, width = shape
+    x, y = np.meshgrid(np.arange(width, dtype=float), np.arange(height, dtype=float))
+    model = getattr(detect_sources, model_name)
+    field = np.zeros(shape)+floor
+    positions = np.column_stack([random.uniform(0, width-1, num_sources),
+        random.uniform(0, height-1, num_sources)])
+    for xc, yc in positions:
+        params = list(benchmark_params[model_name])
+        # Amplitudes from ~1 to ~1000 times the noise
+        params[0] = noise*10**random.uniform(0, 3)
+        params[1] = xc
+        params[2] = yc
+        params[-1] = 0
+        # Vary the width of each source
+        for n in range(3, len(params)-1):
+            if 'angle' not in detect_sources.fit_columns[model_name][n]:
+                params[n] *= random.uniform(*width_range)
+        # Only evaluate the model near the source
+        xmin = int(max(0, xc-15))
+        xmax = int(min(width, xc+16))
+        ymin = int(max(0, yc-15))
+        ymax = int(min(height, yc+16))
+        stamp = (x[ymin:ymax,xmin:xmax], y[ymin:ymax,xmin:xmax])
+        field[ymin:ymax,xmin:xmax] += model(stamp, *params).reshape(ymax-ymin, xmax-xmin)
+    field += random.normal(0, noise, shape)
+    return field, positions
+
+def benchmark_field(model_name='elliptical_moffat', radius=7, max_offset=1.,
+        field=None, positions=None, **field_kwargs):
+    """
+    Fit every source in a benchmark field with and without bounded fits and
+    report the failure rate and time per fit.
+
+    Parameters
+    ----------
+    model_name: str, optional
+        Name of the model to fit
+    radius: int, optional
+        Radius of the stamp used to fit each source
+    max_offset: float, optional
+        A fit whose position is more than ``max_offset`` pixels from the true position
+        is counted as a failure
+    field, positions: numpy arrays, optional
+        Field and source positions (see :py:func:`make_field`). If these are not
+        specified a field is created using ``field_kwargs``
+
+    Returns
+    -------
+    result: dict
+        For both the ``bounded`` and ``unbounded`` fits a dict with the ``failure_rate``,
+        the mean ``time_per_fit`` (in seconds) and ``num_fits``
+    """
+    if field is None:
+        field, positions = make_field(model_name, **field_kwargs)
+    fit_func = detect_sources.fit_types[model_name]
+    bounded_fits = detect_sources.bounded_fits
+    # Fit a single source so that compilation time (if using numba) is not included
+    fit_func(make_stamp(model_name))
+    result = {}
+    try:
+        for bounded in [True, False]:
+            detect_sources.bounded_fits = bounded
+            failures = 0
+            start = time.time()
+            for xc, yc in positions:
+                stamp, xmin, ymin = detect_sources.get_stamp(
+                    field, int(round(xc)), int(round(yc)), radius)
+                best_fit, pcov = fit_func(stamp)
+                if (len(best_fit)==0 or not np.all(np.isfinite(best_fit)) or
+                        np.hypot(best_fit[1]+xmin-xc, best_fit[2]+ymin-yc)>max_offset):
+                    failures += 1
+            runtime = time.time()-start
+            result['bounded' if bounded else 'unbounded'] = {
+                'failure_rate': failures/len(positions),
+                'time_per_fit': runtime/len(positions),
+                'num_fits': len(positions)
+            }
+    finally:
+        detect_sources.bounded_fits = bounded_fits
+    return result
+
+def benchmark_stamp_sizes(model_name='elliptical_moffat', fixed_radius=10, max_offset=1.,
+        field=None, positions=None, **field_kwargs):
+    """
+    Compare fits using a fixed stamp radius to fits using stamps sized from the
+    estimated seeing of the image and from the estimated FWHM of each source.
+
+    Parameters
+    ----------
+    model_name: str, optional
+        Name of the model to fit
+    fixed_radius: int, optional
+        Radius of the stamps for the fixed size fits
+    max_offset: float, optional
+        A fit whose position is more than ``max_offset`` pixels from the true position
+        is counted as a failure
+    field, positions: numpy arrays, optional
+        Field and source positions (see :py:func:`make_field`). If these are not
+        specified a field is created using ``field_kwargs``. By default the widths of
+        the sources only vary by 10%, similar to the variation in seeing across an image
+
+    Returns
+    -------
+    result: dict
+        For the ``fixed``, ``image`` and ``source`` stamp sizes a dict with the mean number
+        of ``pixels`` per stamp, mean ``time_per_fit`` (in seconds), ``failure_rate``
+        and the median position error (``median_offset``) of the successful fits
+    """
+    if field is None:
+        field_kwargs.setdefault('width_range', (.9, 1.1))
+        field, positions = make_field(model_name, **field_kwargs)
+    fit_func = detect_sources.fit_types[model_name]
+    fit_func(make_stamp(model_name))
+    x = np.round(positions[:,0]).astype(int)
+    y = np.round(positions[:,1]).astype(int)
+    search_radius = detect_sources.fwhm_search_radius
+    seeing = detect_sources.estimate_seeing(field, x, y, search_radius)
+    radii = {
+        'fixed': [fixed_radius]*len(x),
+        'image': [detect_sources.get_stamp_radius(seeing, fixed_radius)]*len(x),
+        'source': [detect_sources.get_stamp_radius(detect_sources.estimate_fwhm(
+            detect_sources.get_stamp(field, x[n], y[n], search_radius)[0]), fixed_radius)
+            for n in range(len(x))]
+    }
+    result = {}
+    for label, stamp_radii in radii.items():
+        failures = 0
+        pixels = 0
+        offsets = []
+        start = time.time()
+        for n, radius in enumerate(stamp_radii):
+            stamp, xmin, ymin = detect_sources.get_stamp(field, x[n], y[n], radius)
+            pixels += stamp.size
+            best_fit, pcov = fit_func(stamp)
+            if len(best_fit)==0 or not np.all(np.isfinite(best_fit)):
+                failures += 1
+                continue
+            offset = np.hypot(best_fit[1]+xmin-positions[n,0], best_fit[2]+ymin-positions[n,1])
+            if offset>max_offset:
+                failures += 1
+            else:
+                offsets.append(offset)
+        runtime = time.time()-start
+        result[label] = {
+            'pixels': pixels/len(x),
+            'time_per_fit': runtime/len(x),
+            'failure_rate': failures/len(x),
+            'median_offset': np.median(offsets) if len(offsets)>0 else np.nan
+        }
+    return result
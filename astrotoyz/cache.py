@@ -0,0 +1,259 @@
+"""
+Caches shared by the tasks in Astro-Toyz
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    Thread safe dictionary with a maximum number of entries. When the cache is full the
+    least recently used entry is removed.
+
+    Attributes
+    ----------
+    maxsize: int
+        Maximum number of entries in the cache
+    hits, misses: int
+        Number of lookups that did and did not find their key in the cache
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def lookup(self, key):
+        """
+        Get the value for ``key`` and mark it as the most recently used entry.
+
+        Returns
+        -------
+        found: bool
+            Whether or not ``key`` was in the cache (the cached value may be ``None``)
+        value: object
+            The cached value, or ``None`` if the key was not found
+        """
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return True, value
+            self.misses += 1
+            return False, None
+
+    def get(self, key, default=None):
+        """
+        Get the value for ``key``, or ``default`` if it is not in the cache
+        """
+        found, value = self.lookup(key)
+        if found:
+            return value
+        return default
+
+    def set(self, key, value):
+        """
+        Add (or replace) the value for ``key``, removing the least recently used entries
+        if the cache is full
+        """
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = value
+            while len(self.entries)>self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get_or_create(self, key, create):
+        """
+        Get the value for ``key``. If it is not in the cache ``create()`` is called
+        and its result is cached (even if it is ``None``).
+        """
+        found, value = self.lookup(key)
+        if not found:
+            value = create()
+            self.set(key, value)
+        return value
+
+    def remove(self, key):
+        """
+        Remove ``key`` from the cache (if it is present)
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all of the entries and reset the counters
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Get the number of ``hits``, ``misses``, the current ``size`` and ``maxsize``
+        of the cache
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'maxsize': self.maxsize
+            }
+
+def get_mtime(filepath):
+    """
+    Modification time of a file, or ``None`` if the file cannot be accessed. This is
+    included in cache keys so that entries are not reused after a file changes on disk.
+    """
+    try:
+        return os.path.getmtime(filepath)
+    except (OSError, TypeError):
+        return None
+
+def get_file_key(file_info, *args):
+    """
+    Cache key for an image: ``(filepath, mtime, frame)`` followed by any additional ``args``
+    """
+    filepath = file_info['filepath']
+    return (filepath, get_mtime(filepath), int(file_info['frame']))+args
+
+class FileCache(object):
+    """
+    Cache of open files, keyed by filepath and modification time, so that a session does
+    not reopen a file every time it switches between images. Files are closed (least
+    recently used first) when the memory used by the cache exceeds ``max_memory`` or it
+    holds more than ``max_files`` files. The most recently used file is never closed,
+    since it is the one being viewed.
+
+    Toyz runs each session in its own process, so a cache in this module is never shared
+    between sessions. Memory mapped data is still shared by the operating system (all of
+    the processes map the same pages of the file), but each session loads its own copy
+    of scaled (BZERO/BSCALE) data.
+
+    Parameters
+    ----------
+    open_file: function
+        Function that takes a filepath and returns an open file
+    get_size: function
+        Function that takes an open file and returns the number of bytes it holds in memory
+    close_file: function, optional
+        Function used to close a file when it is removed from the cache
+    max_memory: int, optional
+        Memory budget (in bytes) for the cache
+    max_files: int, optional
+        Maximum number of open files
+    """
+    def __init__(self, open_file, get_size, close_file=None, max_memory=2**30, max_files=8):
+        self.open_file = open_file
+        self.get_size = get_size
+        self.close_file = close_file
+        self.max_memory = max_memory
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filepath):
+        """
+        Get an open file, opening it if it is not in the cache (or it changed on disk)
+
+        Returns
+        -------
+        key: tuple
+            ``(filepath, mtime)`` of the file
+        open_file: object
+            The open file
+        """
+        key = (filepath, get_mtime(filepath))
+        with self.lock:
+            if key in self.entries:
+                open_file = self.entries.pop(key)
+                self.hits += 1
+            else:
+                # Close the file if it changed on disk
+                for old_key in [k for k in self.entries if k[0]==filepath]:
+                    self.remove(old_key)
+                open_file = self.open_file(filepath)
+                self.misses += 1
+            self.entries[key] = open_file
+            self.evict()
+            return key, open_file
+
+    def remove(self, key):
+        """
+        Remove a file from the cache and close it
+        """
+        with self.lock:
+            open_file = self.entries.pop(key)
+            if self.close_file is not None:
+                self.close_file(open_file)
+            self.evictions += 1
+
+    def memory(self):
+        """
+        Number of bytes held in memory by all of the files in the cache
+        """
+        with self.lock:
+            return sum([self.get_size(open_file) for open_file in self.entries.values()])
+
+    def evict(self):
+        """
+        Close the least recently used files until the cache is within its memory budget
+        and has at most ``max_files`` files (the most recently used file is kept open)
+        """
+        with self.lock:
+            total = self.memory()
+            while len(self.entries)>1 and (
+                    total>self.max_memory or len(self.entries)>self.max_files):
+                key = next(iter(self.entries))
+                total -= self.get_size(self.entries[key])
+                self.remove(key)
+
+    def stats(self):
+        """
+        Get the number of ``hits``, ``misses``, ``evictions``, open files (``size``) and
+        ``memory`` (in bytes) used by the cache
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'memory': self.memory(),
+                'max_memory': self.max_memory,
+                'max_files': self.max_files
+            }
+
+# Root directory for caches that are stored on disk
+cache_root = os.path.join(os.path.expanduser('~'), '.astrotoyz')
+
+def get_cache_path(*names):
+    """
+    Path to a directory in ``cache_root``, which is created if it does not exist
+    """
+    path = os.path.join(cache_root, *names)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another thread may have created the directory
+            if not os.path.isdir(path):
+                raise
+    return path
@@ -11,6 +11,9 @@ import os
 import pandas
 import numpy as np
 import json
+import threading
+import collections
+import time
 from datetime import datetime
 
 from toyz.web import session_vars
@@ -20,11 +23,123 @@ import astrotoyz.core
 # TODO: Remove this part of the code when a more robust API is created
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index
 from sqlalchemy.orm import relationship, backref
 Base = declarative_base()
 from sqlalchemy.orm import sessionmaker
 
+# Number of log entries written to the database by each ``executemany``
+log_batch_size = 1000
+# Number of edits that can be undone (see ``Catalog.undo``)
+max_undo = 1000
+# Action that reverses each type of log entry
+undo_actions = {
+    'add_src': 'delete_src',
+    'delete_src': 'add_src',
+    'add_rows': 'delete_rows',
+    'delete_rows': 'add_rows'
+}
+# Size of the SQLite page cache (in KiB) used while building R*-trees. Inserting into
+# an R*-tree touches pages all over the tree, so a large cache makes builds much faster
+rtree_cache_size = 200000
+
+class CatalogDatabase(object):
+    """
+    Engine, session factory and list of tables for a catalog database, shared by all
+    of the catalogs stored in it (see :py:func:`get_database`).
+    
+    Parameters
+    ----------
+    connect_str: str
+        SQLAlchemy connection string of the database
+    """
+    def __init__(self, connect_str):
+        from sqlalchemy.engine.url import make_url
+        from sqlalchemy.pool import QueuePool
+        self.connect_str = connect_str
+        url = make_url(connect_str)
+        if url.get_backend_name()=='sqlite' and url.database not in [None, '', ':memory:']:
+            # SQLAlchemy opens a new connection to a SQLite file for every operation
+            # unless it is told to keep a pool (connections are only used by one thread
+            # at a time, even though they are shared by the task queue workers)
+            self.engine = create_engine(connect_str, poolclass=QueuePool,
+                connect_args={'check_same_thread': False})
+        else:
+            self.engine = create_engine(connect_str)
+        self.Session = sessionmaker(bind=self.engine)
+        self.lock = threading.RLock()
+        self.tables = None
+        self.created = False
+    
+    def get_tables(self):
+        """
+        Names of the tables in the database (loaded the first time they are needed)
+        """
+        with self.lock:
+            if self.tables is None:
+                self.tables = set(self.engine.table_names())
+            return self.tables
+    
+    def has_table(self, table):
+        return table in self.get_tables()
+    
+    def create_tables(self):
+        """
+        Create the catalog meta data and log tables if they do not exist
+        """
+        with self.lock:
+            if not self.created:
+                Base.metadata.create_all(self.engine)
+                upgrade_tables(self.engine)
+                self.created = True
+                self.tables = None
+    
+    def invalidate(self):
+        """
+        Reload the list of tables the next time it is needed (after tables are
+        created or replaced)
+        """
+        with self.lock:
+            self.tables = None
+
+# Catalog databases opened by the current process, keyed by connection string
+databases = {}
+databases_lock = threading.Lock()
+
+def get_database(connect_str):
+    """
+    Get the :py:class:`CatalogDatabase` for a connection string, creating it the first
+    time the database is used
+    """
+    with databases_lock:
+        if connect_str not in databases:
+            databases[connect_str] = CatalogDatabase(connect_str)
+        return databases[connect_str]
+
+# Locks for the catalogs in the current session, keyed by catalog id. Catalog tasks run
+# on the main thread and on the task queue workers (see astrotoyz.task_queue), so every
+# task that reads or changes a catalog holds its lock
+catalog_locks = {}
+catalog_locks_lock = threading.Lock()
+
+def get_catalog_lock(cid):
+    """
+    Get the lock for a catalog in the current session
+    """
+    with catalog_locks_lock:
+        if cid not in catalog_locks:
+            catalog_locks[cid] = threading.RLock()
+        return catalog_locks[cid]
+
+def get_session_catalogs():
+    """
+    Get the catalogs loaded in the current session (``session_vars.catalogs``)
+    """
+    with catalog_locks_lock:
+        if not hasattr(session_vars, 'catalogs'):
+            session_vars.catalogs = {}
+        return session_vars.catalogs
+
 def get_catalog(cid, create='yes', **kwargs):
     """
     Get a catalog loaded into session_vars or try to load a saved catalog.
@@ -38,11 +153,9 @@ def get_catalog(cid, create='yes', **kwargs):
             - If ``create='no'`` a None object is returned
             - If ``create='fail'`` an AstroJobError is raised
     """
-    if hasattr(session_vars, 'catalogs'):
-        if cid in session_vars.catalogs:
-            return session_vars.catalogs[cid]
-    else:
-        session_vars.catalogs = {}
+    catalogs = get_session_catalogs()
+    if cid in catalogs:
+        return catalogs[cid]
     # Check the catalogs database for a catalog
     # TODO: change the following lines to:
     # if os.path.exists(os.path.join(settings['file_info']['filepath'])):
@@ -55,9 +168,7 @@ def get_catalog(cid, create='yes', **kwargs):
             "load or create a catalog")
     catalog = None
     if filepath!='':
-        engine = create_engine(filepath) # connects to the db
-        Base.metadata.bind = engine # binds the metadata to the engine
-        if cid in Base.metadata.tables.keys():
+        if get_database(filepath).has_table(cid):
             catalog = load_catalog(settings['file_info'])
     # If the catalog couldn't be loaded, use 'create' to determine what to do
     if catalog is None:
@@ -104,7 +215,7 @@ def build_src_info(catalog, src_info, file_info):
         del src_info['dec']
     if ra_name in src_info and dec_name in src_info:
         from astropy.coordinates import SkyCoord
-        hdulist = toyz.web.viewer.get_file(file_info)
+        hdulist = astrotoyz.viewer.get_file(file_info)
         hdu = hdulist[int(file_info['frame'])]
         coords = SkyCoord(src_info[ra_name], src_info['dec'], unit='deg')
         src_info[id_name] = coords.to_string('hmsdms')
@@ -114,21 +225,39 @@ def build_src_info(catalog, src_info, file_info):
 
 def detect_sources(file_info, cid, settings):
     from astrotoyz.detect_sources import find_stars
+    from astrotoyz.seeing import build_seeing_map, cache_seeing_map, get_cached_seeing_map
     import astrotoyz.viewer
-    session_vars.catalogs[cid] = None
-    hdulist = toyz.web.viewer.get_file(file_info)
-    wcs = astrotoyz.viewer.get_wcs(file_info, hdulist)
+    deduplicate = settings.pop('deduplicate', True)
+    # Detection runs inside the Toyz session process (on a task queue thread), which
+    # must not be forked, so the sources are only fit with threads
+    settings['allow_processes'] = False
+    hdulist = astrotoyz.viewer.get_file(file_info)
     hdu = hdulist[int(file_info['frame'])]
     settings['img_data'] = hdu.data
+    if 'seeing_map' not in settings:
+        settings['seeing_map'] = get_cached_seeing_map(file_info)
     sources = find_stars(**settings)
+    # Map the seeing and PSF shape across the image from the fit results
+    try:
+        seeing_map = build_seeing_map(sources, hdu.data.shape)
+        cache_seeing_map(file_info, seeing_map)
+    except astrotoyz.core.AstroToyzError:
+        # The fit method does not measure the PSF shape
+        seeing_map = None
     catalog = Catalog(cid, file_info=file_info, data=sources)
+    if seeing_map is not None:
+        catalog.settings['seeing_map'] = seeing_map.to_dict()
     catalog.dropna(inplace=True)
-    if wcs is not None:
+    # Merge split maxima and other duplicate detections (in pixels, since the image
+    # might not have a WCS)
+    if deduplicate:
+        catalog.deduplicate(coord_type='px')
+    wcs_array = astrotoyz.viewer.pix2world(file_info, hdulist, catalog['x'], catalog['y'])
+    if wcs_array is not None:
         from astropy.coordinates import SkyCoord
         id_name = catalog.settings['data']['id_name']
         ra_name = catalog.settings['data']['ra_name']
         dec_name = catalog.settings['data']['dec_name']
-        wcs_array = wcs.all_pix2world(catalog['x'], catalog['y'], 1)
         catalog[ra_name] = wcs_array[0]
         catalog[dec_name] = wcs_array[1]
         coords = SkyCoord(ra=wcs_array[0], dec=wcs_array[1], unit='deg')
@@ -140,7 +269,10 @@ def detect_sources(file_info, cid, settings):
         new_id = np.core.defchararray.add(new_id,catalog['y'].values.astype('|S10'))
         catalog[id_name] = new_id
     catalog.set_index(id_name, inplace=True)
-    session_vars.catalogs[cid] = catalog;
+    # The catalog is only stored in the session once it is complete, so other tasks
+    # keep using the previous catalog while the sources are detected
+    with get_catalog_lock(cid):
+        get_session_catalogs()[cid] = catalog
     print('finished detecting sources')
     return catalog
 
@@ -156,22 +288,156 @@ class CatalogMeta(Base):
 
 class CatalogLog(Base):
     """
-    Table containing logs for each catalog in the database
+    Table containing logs for each catalog in the database. Each entry is a JSON
+    encoded ``log`` of an ``action`` made at ``time`` (in seconds since the epoch).
     """
     __tablename__ = 'catalog_logs'
     id = Column(Integer, primary_key=True)
     action = Column(String)
     log = Column(String)
-    cid = Column(Integer, ForeignKey('catalog_meta.cid'), index=True)
+    cid = Column(String, ForeignKey('catalog_meta.cid'), index=True)
+    time = Column(Float)
     catalog_meta = relationship(CatalogMeta, backref=backref('log', uselist=True))
+    __table_args__ = (Index('ix_catalog_logs_cid_time', 'cid', 'time'),)
+
+class CatalogSnapshot(Base):
+    """
+    Table with a snapshot of each saved version of a catalog: the number of sources
+    and the id of the last log entry when it was saved. A catalog is restored to a
+    saved version by reversing the log entries made after its snapshot.
+    """
+    __tablename__ = 'catalog_snapshots'
+    id = Column(Integer, primary_key=True)
+    cid = Column(String, ForeignKey('catalog_meta.cid'), index=True)
+    version = Column(Integer)
+    time = Column(Float)
+    log_id = Column(Integer)
+    length = Column(Integer)
+    __table_args__ = (Index('ix_catalog_snapshots_cid_version', 'cid', 'version'),)
+
+def upgrade_tables(engine):
+    """
+    Add columns (and indexes) that are missing from tables created by older versions
+    of astrotoyz, since ``create_all`` only creates tables that do not exist
+    """
+    from sqlalchemy import inspect
+    inspector = inspect(engine)
+    for table in [CatalogMeta.__table__, CatalogLog.__table__, CatalogSnapshot.__table__]:
+        columns = [col['name'] for col in inspector.get_columns(table.name)]
+        for col in table.columns:
+            if col.name not in columns:
+                engine.execute('ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(
+                    table.name, col.name, col.type.compile(engine.dialect)))
+        indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
+def encode_log_entry(log):
+    """
+    Encode a log entry as a JSON string, converting numpy types to python types
+    """
+    def convert(obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError("{0} is not JSON serializable".format(repr(obj)))
+    return json.dumps(log, default=convert)
+
+def write_log(connect_str, cid, entries):
+    """
+    Append entries (dicts with ``action``, ``log`` and ``time``) to the log of a
+    catalog, in batches of ``log_batch_size``
+    """
+    from sqlalchemy import insert
+    database = get_database(connect_str)
+    database.create_tables()
+    records = [{
+        'cid': cid,
+        'action': entry['action'],
+        'log': encode_log_entry(entry['log']),
+        'time': entry['time']
+    } for entry in entries]
+    with database.engine.begin() as connection:
+        for n in range(0, len(records), log_batch_size):
+            connection.execute(insert(CatalogLog.__table__), records[n:n+log_batch_size])
+
+def read_log(connect_str, cid, start=None, end=None, after=None):
+    """
+    Read the log of a saved catalog, optionally only the entries with
+    ``start<=time<end`` (in seconds since the epoch) or only the entries
+    written after the entry with id ``after``
+    
+    Returns
+    -------
+    log: list
+        Log entries (dicts with ``action``, ``log`` and ``time``) in the order they
+        were made
+    """
+    from sqlalchemy import select
+    database = get_database(connect_str)
+    database.create_tables()
+    table = CatalogLog.__table__
+    query = select([table.c.action, table.c.log, table.c.time]).where(table.c.cid==cid)
+    if start is not None:
+        query = query.where(table.c.time>=start)
+    if end is not None:
+        query = query.where(table.c.time<end)
+    if after is not None:
+        query = query.where(table.c.id>after)
+    entries = database.engine.execute(query.order_by(table.c.id)).fetchall()
+    return [{
+        'action': action,
+        'log': json.loads(log) if log is not None else None,
+        'time': entry_time
+    } for action, log, entry_time in entries]
+
+def write_snapshot(connect_str, cid, version, length):
+    """
+    Record a snapshot of a saved version of a catalog (see :py:class:`CatalogSnapshot`)
+    """
+    from sqlalchemy import select, func, insert
+    database = get_database(connect_str)
+    database.create_tables()
+    logs = CatalogLog.__table__
+    with database.engine.begin() as connection:
+        log_id = connection.execute(
+            select([func.max(logs.c.id)]).where(logs.c.cid==cid)).scalar()
+        connection.execute(insert(CatalogSnapshot.__table__), {
+            'cid': cid,
+            'version': version,
+            'time': time.time(),
+            'log_id': log_id if log_id is not None else 0,
+            'length': length
+        })
+
+def read_snapshots(connect_str, cid, version=None):
+    """
+    Read the snapshots of the saved versions of a catalog (or only ``version``)
+    
+    Returns
+    -------
+    snapshots: list
+        Snapshots (dicts with ``version``, ``time``, ``log_id`` and ``length``) ordered
+        by version
+    """
+    from sqlalchemy import select
+    database = get_database(connect_str)
+    database.create_tables()
+    table = CatalogSnapshot.__table__
+    query = select([table.c.version, table.c.time, table.c.log_id, table.c.length]).where(
+        table.c.cid==cid)
+    if version is not None:
+        query = query.where(table.c.version==version)
+    rows = database.engine.execute(query.order_by(table.c.version)).fetchall()
+    return [dict(zip(['version', 'time', 'log_id', 'length'], row)) for row in rows]
 
 def init_catalog_db(connect_str):
     """
     Use sqlalchemy to connect to the DB specified by ``connect_str``. 
     """
-    engine = create_engine(connect_str) # connects to the db
-    Base.metadata.bind = engine # binds the metadata to the engine
-    Base.metadata.create_all(engine)
+    get_database(connect_str).create_tables()
 
 def load_catalog(file_info, load_log=False):
     """
@@ -185,26 +451,333 @@ def load_catalog(file_info, load_log=False):
     """
     cid = file_info['file_settings']['table']
     connect_str = file_info['filepath']
-    engine = create_engine(connect_str) # connects to the db
-    Base.metadata.bind = engine # binds the metadata to the engine
-    if cid not in Base.metadata.tables.keys():
+    database = get_database(connect_str)
+    engine = database.engine
+    if not database.has_table(cid):
         raise astrotoyz.core.AstroToyzError("Catalog not found in database")
     dataframe = pandas.read_sql_table(cid, engine)
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
-    meta = session.query(CatalogMeta).filter(CatalogMeta.cid==cid).first()
-    if meta is None:
-        raise astrotoyz.core.AstroToyzError("Could not find catalog meta data")
+    if 'sky_cell' in dataframe.columns:
+        # The sky cells are only used to query the saved catalog
+        dataframe.drop('sky_cell', axis=1, inplace=True)
+    meta = load_catalog_meta(connect_str, cid)
     settings = json.loads(meta.settings)
     if load_log:
-        log = pandas.read_sql_query(
-            "SELECT * FROM log WHERE cid='{0}'".format(cid),
-            engine)
+        log = read_log(connect_str, cid)
     else:
         log = None
-    catalog = Catalog(cid, file_info, name=meta.name, log=log, data=dataframe)
+    catalog = Catalog(cid, file_info, name=meta.name, settings=settings, log=log,
+        data=dataframe)
+    catalog.saved_state = {
+        'connect_str': connect_str,
+        'schema': catalog.get_schema(),
+        'length': len(catalog)
+    }
+    return catalog
+
+def load_catalog_meta(connect_str, cid):
+    """
+    Load the meta data (:py:class:`CatalogMeta`) for a saved catalog
+    """
+    session = get_database(connect_str).Session()
+    try:
+        meta = session.query(CatalogMeta).filter(CatalogMeta.cid==cid).first()
+    finally:
+        session.close()
+    if meta is None:
+        raise astrotoyz.core.AstroToyzError("Could not find catalog meta data")
+    return meta
+
+def query_sky_cells(file_info, cells, query_order, max_ranges=200):
+    """
+    Load the rows of a saved catalog in a set of sky cells (see
+    :py:mod:`astrotoyz.sky_cells`). Only the rows in the cells are read from the
+    database, using the index on the catalogs ``sky_cell`` column.
+    
+    Parameters
+    ----------
+    file_info: dict
+        File info of the saved catalog (see :py:func:`load_catalog`)
+    cells: array-like
+        Cells of order ``query_order`` to load
+    query_order: int
+        Order of ``cells``
+    max_ranges: int, optional
+        Maximum number of ranges of cells in a single query
+    
+    Returns
+    -------
+    catalog: :py:class:`Catalog`
+        Catalog with the rows in the cells
+    """
+    from astrotoyz.sky_cells import cell_ranges
+    cid = file_info['file_settings']['table']
+    engine = get_database(file_info['filepath']).engine
+    meta = load_catalog_meta(file_info['filepath'], cid)
+    settings = json.loads(meta.settings)
+    order = settings.get('sky_cell_order')
+    if order is None:
+        raise astrotoyz.core.AstroToyzError(
+            "Catalog was saved without sky cells, save it again with ra and dec columns")
+    ranges = cell_ranges(cells, query_order, order)
+    frames = []
+    for n in range(0, len(ranges), max_ranges):
+        chunk = ranges[n:n+max_ranges]
+        where = ' OR '.join(['(sky_cell>=? AND sky_cell<?)']*len(chunk))
+        args = [cell for cell_range in chunk for cell in cell_range]
+        frames.append(pandas.read_sql_query(
+            'SELECT * FROM "{0}" WHERE {1}'.format(cid, where), engine, params=args))
+    if len(frames)>0:
+        dataframe = pandas.concat(frames, ignore_index=True)
+    else:
+        dataframe = pandas.read_sql_query('SELECT * FROM "{0}" LIMIT 0'.format(cid), engine)
+    dataframe.drop('sky_cell', axis=1, inplace=True)
+    return Catalog(cid, file_info, name=meta.name, settings=settings, data=dataframe)
+
+def query_cone(file_info, ra, dec, radius):
+    """
+    Load the sources in a saved catalog within ``radius`` (in degrees, or an astropy
+    Quantity) of (ra, dec). Only the sky cells that overlap the cone are read.
+    """
+    import astropy.units as u
+    from astrotoyz.sky_cells import cone_cells, angular_separation
+    if hasattr(radius, 'unit'):
+        radius = radius.to(u.deg).value
+    catalog = query_sky_cells(file_info, *cone_cells(ra, dec, radius,
+        get_sky_cell_order(file_info)))
+    ra_name = catalog.settings['data']['ra_name']
+    dec_name = catalog.settings['data']['dec_name']
+    separation = angular_separation(catalog[ra_name].values, catalog[dec_name].values,
+        ra, dec)
+    catalog.drop(catalog.index[~(separation<=radius)], inplace=True)
+    return catalog
+
+def query_box(file_info, ra_min, ra_max, dec_min, dec_max):
+    """
+    Load the sources in a saved catalog inside a box in ra and dec (in degrees). If
+    ``ra_min>ra_max`` the box wraps around ra=0. Only the sky cells that overlap the
+    box are read.
+    """
+    from astrotoyz.sky_cells import box_cells, ra_width
+    catalog = query_sky_cells(file_info, *box_cells(ra_min, ra_max, dec_min, dec_max,
+        get_sky_cell_order(file_info)))
+    ra = catalog[catalog.settings['data']['ra_name']].values
+    dec = catalog[catalog.settings['data']['dec_name']].values
+    width = ra_width(ra_min, ra_max)
+    inside = (np.mod(ra-ra_min, 360.)<=width) & (dec>=dec_min) & (dec<=dec_max)
+    catalog.drop(catalog.index[~inside], inplace=True)
     return catalog
 
+def get_rtree_name(cid, coord_type):
+    """
+    Name of the R*-tree table for a catalog table
+    """
+    return '{0}_rtree_{1}'.format(cid, coord_type)
+
+def create_rtrees(engine, cid, coord_columns, columns):
+    """
+    Create an SQLite R*-tree virtual table for each pair of coordinates in a saved
+    catalog, so that the sources in a region can be found without reading the
+    entire table. The R*-trees reference the rows of the catalog table by their
+    ``rowid``, so they are rebuilt each time the table is rewritten.
+    
+    Parameters
+    ----------
+    engine: `sqlalchemy.engine.Engine`
+        Engine connected to the catalog database
+    cid: str
+        Name of the catalog table
+    coord_columns: dict
+        Names of the coordinate columns for each coordinate type (for example
+        ``{'px': ['x', 'y']}``)
+    columns: list
+        Columns in the catalog
+    
+    Returns
+    -------
+    coord_types: list
+        Coordinate types with an R*-tree (R*-trees are only available in SQLite)
+    """
+    if engine.dialect.name!='sqlite':
+        return []
+    coord_types = []
+    with engine.begin() as connection:
+        connection.execute('PRAGMA cache_size=-{0}'.format(int(rtree_cache_size)))
+        for coord_type, (col1, col2) in sorted(coord_columns.items()):
+            rtree = get_rtree_name(cid, coord_type)
+            connection.execute('DROP TABLE IF EXISTS "{0}"'.format(rtree))
+            if col1 not in columns or col2 not in columns:
+                continue
+            connection.execute(
+                'CREATE VIRTUAL TABLE "{0}" USING rtree(id, min1, max1, min2, max2)'.format(
+                    rtree))
+            connection.execute(
+                'INSERT INTO "{0}" SELECT rowid, "{2}", "{2}", "{3}", "{3}" FROM "{1}" '
+                'WHERE "{2}" IS NOT NULL AND "{3}" IS NOT NULL'.format(rtree, cid, col1, col2))
+            coord_types.append(coord_type)
+    return coord_types
+
+def get_records(table, keys):
+    """
+    Convert the rows of a DataFrame (including its index) to a list of dicts, with
+    the values of each column stored with the names in ``keys`` and missing values
+    set to ``None``, that can be passed to ``executemany``
+    """
+    table = table.reset_index()
+    columns = []
+    for name in table.columns:
+        values = table[name].values
+        column = values.tolist()
+        missing = np.where(pandas.isnull(values))[0]
+        for n in missing:
+            column[n] = None
+        columns.append(column)
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
+def update_table(engine, cid, id_name, deleted, inserted, coord_columns, rtrees):
+    """
+    Apply the changes to a catalog since it was last saved to the saved table (and its
+    R*-trees) in a single transaction. Modified rows are deleted and inserted again.
+    
+    Parameters
+    ----------
+    engine: `sqlalchemy.engine.Engine`
+        Engine connected to the catalog database
+    cid: str
+        Name of the catalog table
+    id_name: str
+        Name of the column with the source ids
+    deleted: list
+        Ids of the rows to delete
+    inserted: `pandas.DataFrame`
+        Rows to insert (indexed by ``id_name``, with the same columns as the saved table)
+    coord_columns: dict
+        Names of the coordinate columns for each coordinate type (see
+        :py:func:`create_rtrees`)
+    rtrees: list
+        Coordinate types with an R*-tree
+    """
+    from sqlalchemy import text
+    keys = ['p{0}'.format(n) for n in range(len(inserted.columns)+1)]
+    columns = ', '.join(['"{0}"'.format(col) for col in [id_name]+list(inserted.columns)])
+    find_rows = 'SELECT rowid FROM "{0}" WHERE "{1}"=:id'.format(cid, id_name)
+    with engine.begin() as connection:
+        if len(deleted)>0:
+            ids = [{'id': src_id} for src_id in deleted]
+            for coord_type in rtrees:
+                connection.execute(text('DELETE FROM "{0}" WHERE id IN ({1})'.format(
+                    get_rtree_name(cid, coord_type), find_rows)), ids)
+            connection.execute(text('DELETE FROM "{0}" WHERE "{1}"=:id'.format(
+                cid, id_name)), ids)
+        if len(inserted)>0:
+            connection.execute(text('INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
+                cid, columns, ', '.join([':'+key for key in keys]))),
+                get_records(inserted, keys))
+            ids = [{'id': src_id} for src_id in inserted.index.tolist()]
+            for coord_type in rtrees:
+                col1, col2 = coord_columns[coord_type]
+                connection.execute(text(
+                    'INSERT INTO "{0}" SELECT rowid, "{2}", "{2}", "{3}", "{3}" FROM "{1}" '
+                    'WHERE "{4}"=:id AND "{2}" IS NOT NULL AND "{3}" IS NOT NULL'.format(
+                        get_rtree_name(cid, coord_type), cid, col1, col2, id_name)), ids)
+
+def query_region(file_info, xmin=None, xmax=None, ymin=None, ymax=None, ra_min=None,
+        ra_max=None, dec_min=None, dec_max=None, ra=None, dec=None, radius=None):
+    """
+    Load the sources in a region of a saved catalog. The region can be a box in pixel
+    coordinates (``xmin``, ``xmax``, ``ymin``, ``ymax``), a box in world coordinates
+    (``ra_min``, ``ra_max``, ``dec_min``, ``dec_max``, which wraps around ra=0 if
+    ``ra_min>ra_max``) or a cone (``ra``, ``dec`` and ``radius``), with all angles in
+    degrees. Only the rows found in the catalogs R*-tree (or sky cells, if the catalog
+    was saved without an R*-tree) are read from the database.
+    
+    Returns
+    -------
+    catalog: :py:class:`Catalog`
+        Catalog with the sources in the region
+    """
+    from astrotoyz.sky_cells import angular_separation, ra_width
+    cid = file_info['file_settings']['table']
+    engine = get_database(file_info['filepath']).engine
+    meta = load_catalog_meta(file_info['filepath'], cid)
+    settings = json.loads(meta.settings)
+    rtrees = settings.get('rtree', [])
+    if xmin is not None:
+        coord_type = 'px'
+        boxes = [(xmin, xmax, ymin, ymax)]
+    elif ra_min is not None:
+        coord_type = 'wcs'
+        width = ra_width(ra_min, ra_max)
+        start = np.mod(ra_min, 360.)
+        if width>=360.:
+            boxes = [(0., 360., dec_min, dec_max)]
+        elif start+width>360.:
+            boxes = [(start, 360., dec_min, dec_max), (0., start+width-360., dec_min, dec_max)]
+        else:
+            boxes = [(start, start+width, dec_min, dec_max)]
+    elif radius is not None:
+        coord_type = 'wcs'
+        dec_min = max(-90., dec-radius)
+        dec_max = min(90., dec+radius)
+        if dec_min==-90. or dec_max==90.:
+            boxes = [(0., 360., dec_min, dec_max)]
+        else:
+            # Half width in ra of the bounding box of the cone
+            cos_dec = np.cos(np.radians(max(abs(dec_min), abs(dec_max))))
+            dra = min(180., radius/cos_dec)
+            if dra>=180.:
+                boxes = [(0., 360., dec_min, dec_max)]
+            else:
+                ra_min = np.mod(ra-dra, 360.)
+                ra_max = np.mod(ra+dra, 360.)
+                if ra_min>ra_max:
+                    boxes = [(ra_min, 360., dec_min, dec_max), (0., ra_max, dec_min, dec_max)]
+                else:
+                    boxes = [(ra_min, ra_max, dec_min, dec_max)]
+    else:
+        raise astrotoyz.core.AstroToyzError(
+            "query_region requires a box in pixel or world coordinates or a cone")
+    
+    if coord_type not in rtrees:
+        if coord_type=='wcs' and settings.get('sky_cell_order') is not None:
+            if radius is not None:
+                return query_cone(file_info, ra, dec, radius)
+            return query_box(file_info, ra_min, ra_max, dec_min, dec_max)
+        raise astrotoyz.core.AstroToyzError(
+            "Catalog does not have a spatial index for '{0}' coordinates".format(coord_type))
+    rtree = get_rtree_name(cid, coord_type)
+    frames = []
+    for box in boxes:
+        frames.append(pandas.read_sql_query(
+            'SELECT t.* FROM "{0}" t JOIN "{1}" r ON t.rowid=r.id '
+            'WHERE r.max1>=? AND r.min1<=? AND r.max2>=? AND r.min2<=?'.format(cid, rtree),
+            engine, params=[float(b) for b in box]))
+    dataframe = pandas.concat(frames, ignore_index=True)
+    if 'sky_cell' in dataframe.columns:
+        dataframe.drop('sky_cell', axis=1, inplace=True)
+    catalog = Catalog(cid, file_info, name=meta.name, settings=settings, data=dataframe)
+    # The R*-tree stores 32 bit bounds, so make an exact cut
+    if coord_type=='px':
+        x = catalog['x'].values
+        y = catalog['y'].values
+        inside = (x>=xmin) & (x<=xmax) & (y>=ymin) & (y<=ymax)
+    else:
+        cat_ra = catalog[catalog.settings['data']['ra_name']].values
+        cat_dec = catalog[catalog.settings['data']['dec_name']].values
+        if radius is not None:
+            inside = angular_separation(cat_ra, cat_dec, ra, dec)<=radius
+        else:
+            inside = ((np.mod(cat_ra-ra_min, 360.)<=ra_width(ra_min, ra_max)) &
+                (cat_dec>=dec_min) & (cat_dec<=dec_max))
+    catalog.drop(catalog.index[~inside], inplace=True)
+    return catalog
+
+def get_sky_cell_order(file_info):
+    """
+    Order of the sky cells stored with a saved catalog
+    """
+    meta = load_catalog_meta(file_info['filepath'], file_info['file_settings']['table'])
+    return json.loads(meta.settings).get('sky_cell_order')
+
 class Catalog(pandas.DataFrame):
     """
     Pandas Dataframe with additional methods to store metadata, log information, and
@@ -259,16 +832,28 @@ class Catalog(pandas.DataFrame):
         if (self.index.name is None and self.index.names[0] is None and 
                 self.settings['data']['id_name'] in self.columns):
             self.set_index(self.settings['data']['id_name'], inplace=True)
-        if log is not None:
-            self.log = log
-        else:
-            log = pandas.DataFrame(columns=['cid', 'action', 'entry'])
-        self.new_log = pandas.DataFrame(columns=['cid', 'action', 'entry'])
+        # Log entries loaded from the database (if any) and entries made since the
+        # catalog was last saved
+        self.saved_log = log
+        self.new_log = []
+        # Edits that can be undone and redone. Each step is a list of log entries
+        self.undo_stack = collections.deque(maxlen=max_undo)
+        self.redo_stack = []
+        # Spatial indexes for 'px' and 'wcs' coordinates, built the first time they are used
+        self.spatial_indexes = {}
+        # Ids of the sources inserted, deleted and modified since the catalog was saved,
+        # and the state of the saved table (``None`` if the catalog has not been saved)
+        self.clear_changes()
+        self.saved_state = None
     
     def save(self, filepath=None):
         """
         Save the catalog. If a filepath is specified that is different than the current
         filepath, update the catalogs settings.
+        
+        If the catalog was already saved to the same file with the same columns, only
+        the sources inserted, deleted and modified since then (see
+        :py:meth:`Catalog.record_changes`) are written, otherwise the table is replaced.
         """
         # TODO: Change the following code to allow for more genral file types
         if filepath is None:
@@ -276,12 +861,59 @@ class Catalog(pandas.DataFrame):
         elif filepath != self.settings['file_info']['filepath']:
             connect_str = filepath
             self.settings['file_info']['filepath'] = connect_str
-        engine = create_engine(connect_str) # connects to the db
-        self.to_sql(self.cid, engine, if_exists='replace', index=False)
+        database = get_database(connect_str)
+        database.create_tables()
+        engine = database.engine
+        ra_name = self.settings['data']['ra_name']
+        dec_name = self.settings['data']['dec_name']
+        coord_columns = {
+            'px': ['x', 'y'],
+            'wcs': [ra_name, dec_name]
+        }
+        schema = self.get_schema()
+        saved_state = self.saved_state
+        if (saved_state is not None and saved_state['connect_str']==connect_str and
+                saved_state['schema']==schema and self.index.name is not None and
+                saved_state['length']+len(self.inserted)-len(self.deleted)==len(self)):
+            deleted = list(self.deleted|self.modified)
+            inserted = pandas.DataFrame(self.loc[list(self.inserted|self.modified)])
+            if 'sky_cell_order' in self.settings:
+                from astrotoyz.sky_cells import radec2cell
+                inserted = inserted.assign(sky_cell=radec2cell(
+                    inserted[ra_name].values, inserted[dec_name].values,
+                    self.settings['sky_cell_order']))
+            update_table(engine, self.cid, self.index.name, deleted, inserted,
+                coord_columns, self.settings.get('rtree', []))
+        else:
+            # Store the index (the source ids) with the table unless it is just the row number
+            index = self.index.name is not None
+            if ra_name in self.columns and dec_name in self.columns:
+                from astrotoyz.sky_cells import radec2cell, cell_order
+                # Store the sky cell of each source (with an index) so that regions of
+                # the saved catalog can be loaded without reading the entire table
+                table = pandas.DataFrame(self).assign(
+                    sky_cell=radec2cell(self[ra_name].values, self[dec_name].values))
+                table.to_sql(self.cid, engine, if_exists='replace', index=index)
+                engine.execute('CREATE INDEX IF NOT EXISTS "{0}_sky_cell" ON "{0}" (sky_cell)'.format(
+                    self.cid))
+                self.settings['sky_cell_order'] = cell_order
+            else:
+                self.to_sql(self.cid, engine, if_exists='replace', index=index)
+                self.settings.pop('sky_cell_order', None)
+            self.settings['rtree'] = create_rtrees(engine, self.cid, coord_columns,
+                self.columns)
+            database.invalidate()
+        self.saved_state = {
+            'connect_str': connect_str,
+            'schema': schema,
+            'length': len(self)
+        }
+        self.clear_changes()
+        
+        self.settings['version'] = self.settings.get('version', 0)+1
         
         # Save meta data and new log entries
-        DBSession = sessionmaker(bind=engine)
-        session = DBSession()
+        session = database.Session()
         # Encode settings dict as a json string
         meta_record = session.query(CatalogMeta).filter(CatalogMeta.cid==self.cid)
         if meta_record.first() is None:
@@ -295,47 +927,105 @@ class Catalog(pandas.DataFrame):
                 'name': self.name,
                 'settings': json.dumps(self.settings)
             })
-        # Save the new log entries, then add them to the (old) log and clear the new log
-        self.new_log.to_sql('log', engine, if_exists='append')
-        self.log.append(self.new_log)
-        self.new_log = pandas.DataFrame(columns=['action', 'cid', 'entry'])
         session.commit()
-        Base.metadata.reflect(engine) # adds the table created by to_sql to the metadata
-        Base.metadata.create_all(engine) # updates the metadata with the new tables
+        # Save the new log entries, then add them to the (old) log and clear the new log
+        self.flush_log()
+        session.close()
+        write_snapshot(connect_str, self.cid, self.settings['version'], len(self))
         return True
     
+    def get_schema(self):
+        """
+        Description of the columns (and index) of the catalog, used to check whether
+        the saved table has to be replaced
+        """
+        return {
+            'index': self.index.name,
+            'columns': [[str(col), str(dtype)] for col, dtype in self.dtypes.iteritems()],
+            'radec': [self.settings['data']['ra_name'], self.settings['data']['dec_name']]
+        }
+    
+    def clear_changes(self):
+        """
+        Clear the record of the sources inserted, deleted and modified since the
+        catalog was saved
+        """
+        self.inserted = set()
+        self.deleted = set()
+        self.modified = set()
+    
+    def record_changes(self, inserted=None, deleted=None, modified=None):
+        """
+        Record the ids of sources inserted, deleted or modified, so that the next
+        :py:meth:`Catalog.save` only writes the changes. ``add_src``, ``delete_src``
+        and ``deduplicate`` record their own changes, other code that edits the rows
+        of a catalog should call this method.
+        """
+        for src_id in inserted if inserted is not None else []:
+            if src_id in self.deleted:
+                # The source was deleted and added again
+                self.deleted.remove(src_id)
+                self.modified.add(src_id)
+            else:
+                self.inserted.add(src_id)
+        for src_id in deleted if deleted is not None else []:
+            if src_id in self.inserted:
+                self.inserted.remove(src_id)
+            else:
+                self.modified.discard(src_id)
+                self.deleted.add(src_id)
+        for src_id in modified if modified is not None else []:
+            if src_id not in self.inserted:
+                self.modified.add(src_id)
+    
     def log(self, action, log):
         """
-        Log changes to catalog
+        Log changes to catalog. Entries are kept in memory until the catalog is saved
+        (see :py:meth:`Catalog.flush_log`).
         """
-        self.new_log.loc[self.new_log.shape[0]] = pandas.Series({
-            'cid': self.cid,
+        entry = {
             'action': action,
-            'log': log
-        })
+            'log': log,
+            'time': time.time()
+        }
+        self.new_log.append(entry)
+        return entry
+    
+    def flush_log(self):
+        """
+        Write the log entries made since the catalog was last saved to its database
+        """
+        if len(self.new_log)==0:
+            return
+        write_log(self.settings['file_info']['filepath'], self.cid, self.new_log)
+        if self.saved_log is not None:
+            self.saved_log.extend(self.new_log)
+        self.new_log = []
     
-    def get_log(self, include_new=True):
+    def get_log(self, include_new=True, start=None, end=None):
         """
-        Get the full log for the catalog from the log file. If ``include_new`` is ``True``,
-        the changes made since the last save are also stored.
+        Get the full log for the catalog from the log file (optionally only the entries
+        with ``start<=time<end``). If ``include_new`` is ``True``, the changes made
+        since the last save are also returned.
         """
         # TODO: make this work for more general log file types
-        engine = create_engine(self.settings['file_info']['filepath']) # connects to the db
-        Base.metadata.bind = engine # binds the metadata to the engine
-        DBSession = sessionmaker(bind=engine)
-        session = DBSession()
-        log = session.query(CatalogLog).filterby(cid=self.cid)
-        log = [{l.action: l.log} for l in log]
-        self.log = log
+        log = []
+        if self.saved_state is not None:
+            log = read_log(self.settings['file_info']['filepath'], self.cid, start, end)
         if include_new:
-            log.extend(self.new_log)
-        return log    
+            log.extend([entry for entry in self.new_log
+                if (start is None or entry['time']>=start) and
+                    (end is None or entry['time']<end)])
+        return log
     
-    def get_min_sep(self):
+    def get_min_sep(self, coord_type='wcs'):
         """
-        Get the minimum separation for a point to be considered a new source
+        Get the minimum separation for a point to be considered a new source. For
+        ``coord_type='px'`` the separation is in pixels.
         """
         import astropy.units as u
+        if coord_type=='px':
+            return self.settings['data'].get('min_sep', {}).get('px', 5)
         # Check to make sure that the source isn't already in the catalog
         if 'min_sep' in self.settings['data']:
             if 'wcs' in self.settings['data']['min_sep']:
@@ -350,6 +1040,74 @@ class Catalog(pandas.DataFrame):
             sep = 1*u.arcsec
         return sep
     
+    def get_coords(self, coords, coord_type=None):
+        """
+        Get the pair of coordinates from a ``coords`` dictionary that contains either
+        the catalogs 'ra_name' and 'dec_name', 'ra' and 'dec', or 'x' and 'y'.
+        
+        Returns
+        -------
+        coord_type: str
+            ``'wcs'`` or ``'px'``
+        coord1, coord2:
+            The coordinates
+        """
+        ra_name = self.settings['data']['ra_name']
+        dec_name = self.settings['data']['dec_name']
+        if ra_name in coords and dec_name in coords and coord_type in [None, 'wcs']:
+            return 'wcs', coords[ra_name], coords[dec_name]
+        elif 'ra' in coords and 'dec' in coords and coord_type in [None, 'wcs']:
+            return 'wcs', coords['ra'], coords['dec']
+        elif 'x' in coords and 'y' in coords and coord_type in [None, 'px']:
+            return 'px', coords['x'], coords['y']
+        raise astrotoyz.core.AstroToyzError(
+            "Adding a source requires a pair of coordinates from 'ra' and 'dec', " +
+            "'x' and 'y', or the catlogs 'ra' and 'dec' fields")
+    
+    def get_spatial_index(self, coord_type):
+        """
+        Get the spatial index (:py:class:`astrotoyz.spatial.SpatialIndex`) of the
+        catalog for ``coord_type`` ('px' or 'wcs'). The index is updated by
+        ``add_src`` and ``delete_src`` and rebuilt if the catalog was changed in any
+        other way.
+        """
+        from astrotoyz.spatial import SpatialIndex
+        if coord_type=='wcs':
+            columns = [self.settings['data']['ra_name'], self.settings['data']['dec_name']]
+        elif coord_type=='px':
+            columns = ['x', 'y']
+        else:
+            raise astrotoyz.core.AstroToyzError("Unrecognized coord_type")
+        if coord_type in self.spatial_indexes:
+            spatial_index, index, length = self.spatial_indexes[coord_type]
+            if index is self.index and length==len(self):
+                return spatial_index
+        if columns[0] not in self.columns or columns[1] not in self.columns:
+            raise astrotoyz.core.AstroToyzError(
+                "Catalog does not have '{0}' and '{1}' columns".format(*columns))
+        spatial_index = SpatialIndex(self[columns[0]].values, self[columns[1]].values,
+            self.index.values, coord_type)
+        self.spatial_indexes[coord_type] = (spatial_index, self.index, len(self))
+        return spatial_index
+    
+    def update_spatial_indexes(self, added=None, removed=None):
+        """
+        Update the spatial indexes after the source ``added`` (a dict of its fields)
+        was added to the catalog or the source with id ``removed`` was deleted
+        """
+        for coord_type, (spatial_index, index, length) in list(self.spatial_indexes.items()):
+            if removed is not None:
+                spatial_index.remove([removed])
+            if added is not None:
+                try:
+                    coord_type, coord1, coord2 = self.get_coords(added, coord_type)
+                except astrotoyz.core.AstroToyzError:
+                    # The new source does not have these coordinates
+                    del self.spatial_indexes[coord_type]
+                    continue
+                spatial_index.add(coord1, coord2, [added[self.settings['data']['id_name']]])
+            self.spatial_indexes[coord_type] = (spatial_index, self.index, len(self))
+    
     def get_src_info(self, **kwargs):
         if (('ra' in kwargs and 'dec' in kwargs) or
                 (self.settings['data']['ra_name'] in kwargs and 
@@ -381,7 +1139,7 @@ class Catalog(pandas.DataFrame):
         """
         kwargs.update(src_info)
         src_info.update(self.get_src_info(file_info=file_info, **kwargs))
-        sep = self.get_min_sep()
+        sep = self.get_min_sep(self.get_coords(src_info)[0])
         idx, d2d, src = self.get_nearest_neighbors(self, coords=src_info)
         if d2d<sep and d2d:
             src = {s: src[n] for n,s in enumerate(src.keys())}
@@ -397,7 +1155,7 @@ class Catalog(pandas.DataFrame):
         """
         kwargs.update(src_info)
         src_info.update(self.get_src_info(file_info=file_info, **kwargs))
-        sep = self.get_min_sep()
+        sep = self.get_min_sep(self.get_coords(src_info)[0])
         if self.shape[0]>0:
             idx, d2d, src = self.get_nearest_neighbors(self, coords=src_info)
         
@@ -410,89 +1168,373 @@ class Catalog(pandas.DataFrame):
                 self.settings['data']['build_src_info']['module'])
             build_func = self.settings['data']['build_src_info']['func']
             src_info = getattr(build_module, build_func)(self, src_info, file_info)
-            print('catalog before', self)
-            # Bad fix for adding a new source, need to change this
-            if self.shape[0]==0:
-                for k,v in src_info.items():
-                    self[k] = [v]
-                print('catalog', self)
-            else:
-                self.loc[src_info[self.settings['data']['id_name']]] = pandas.Series(src_info)
-            self.log('add_src', src_info)
+            self.insert_src(src_info)
+            self.push_undo([self.log('add_src', src_info)])
             return src_info
         return {}
     
+    def insert_src(self, src_info):
+        """
+        Insert a source (a dict with all of its fields, including its id) into the
+        catalog without checking for duplicates
+        """
+        # Bad fix for adding a new source, need to change this
+        if self.shape[0]==0:
+            for k,v in src_info.items():
+                self[k] = [v]
+        else:
+            self.loc[src_info[self.settings['data']['id_name']]] = pandas.Series(src_info)
+        self.update_spatial_indexes(added=src_info)
+        self.record_changes(inserted=[src_info[self.settings['data']['id_name']]])
+    
+    def remove_src(self, ids):
+        """
+        Remove the sources with ``ids`` from the catalog
+        
+        Returns
+        -------
+        rows: list
+            Removed sources (dicts with all of their fields, including their id)
+        """
+        id_name = self.settings['data']['id_name']
+        ids = [src_id for src_id in ids if src_id in self.index]
+        if len(ids)==0:
+            return []
+        rows = pandas.DataFrame(self.loc[ids])
+        rows.index.name = id_name
+        rows = rows.reset_index().to_dict('records')
+        self.drop(ids, inplace=True)
+        for src_id in ids:
+            self.update_spatial_indexes(removed=src_id)
+        self.record_changes(deleted=ids)
+        return rows
+    
     def delete_src(self, src_info):
         """
         Delete a source from the catalog.
         """
         id_name = self.settings['data']['id_name']
-        row = self.loc[src_info[id_name]]
-        self.drop(src_info[id_name], inplace=True)
+        rows = self.remove_src([src_info[id_name]])
         # Notify the user if no matching sources were found
-        #print('catalog after delete', self)
-        if len(row)==0:
+        if len(rows)==0:
             return False
+        self.push_undo([self.log('delete_src', rows[0])])
         return True
     
+    def apply_log_entry(self, action, log):
+        """
+        Apply an ``add_src``, ``delete_src``, ``add_rows`` or ``delete_rows`` log entry
+        to the catalog
+        """
+        id_name = self.settings['data']['id_name']
+        if action=='add_src':
+            self.insert_src(log)
+        elif action=='delete_src':
+            self.remove_src([log[id_name]])
+        elif action=='add_rows':
+            for row in log['rows']:
+                self.insert_src(row)
+        elif action=='delete_rows':
+            self.remove_src([row[id_name] for row in log['rows']])
+        else:
+            raise astrotoyz.core.AstroToyzError(
+                "Log action '{0}' cannot be applied to a catalog".format(action))
+    
+    def push_undo(self, step):
+        """
+        Add a step (a list of log entries) that can be undone. Any steps that were
+        undone can no longer be redone.
+        """
+        self.undo_stack.append(step)
+        self.redo_stack = []
+    
+    def reverse_step(self, step):
+        """
+        Apply the reverse of each log entry in a step (in reverse order)
+        
+        Returns
+        -------
+        step: list
+            Log entries of the changes made
+        """
+        reverse = []
+        for entry in reversed(step):
+            action = undo_actions[entry['action']]
+            self.apply_log_entry(action, entry['log'])
+            reverse.append(self.log(action, entry['log']))
+        return reverse
+    
+    def undo(self):
+        """
+        Undo the last edit (or restore) made to the catalog
+        
+        Returns
+        -------
+        step: list
+            Log entries of the changes made (empty if there is nothing to undo)
+        """
+        if len(self.undo_stack)==0:
+            return []
+        step = self.reverse_step(self.undo_stack.pop())
+        self.redo_stack.append(step)
+        return step
+    
+    def redo(self):
+        """
+        Redo the last edit that was undone
+        
+        Returns
+        -------
+        step: list
+            Log entries of the changes made (empty if there is nothing to redo)
+        """
+        if len(self.redo_stack)==0:
+            return []
+        step = self.reverse_step(self.redo_stack.pop())
+        self.undo_stack.append(step)
+        return step
+    
+    def get_versions(self):
+        """
+        Snapshots of the saved versions of the catalog (see :py:func:`read_snapshots`)
+        """
+        if self.saved_state is None:
+            return []
+        return read_snapshots(self.saved_state['connect_str'], self.cid)
+    
+    def restore(self, version):
+        """
+        Restore the sources in the catalog to a saved version by reversing the log
+        entries made since that version was saved. Only the sources that changed are
+        touched, so the saved table is not read and the next save only writes the
+        changes. The restore is logged and can be undone like any other edit.
+        
+        Returns
+        -------
+        step: list
+            Log entries of the changes made
+        """
+        if self.saved_state is None:
+            raise astrotoyz.core.AstroToyzError("Catalog has not been saved")
+        connect_str = self.saved_state['connect_str']
+        snapshot = read_snapshots(connect_str, self.cid, version)
+        if len(snapshot)==0:
+            raise astrotoyz.core.AstroToyzError(
+                "Catalog does not have a saved version {0}".format(version))
+        id_name = self.settings['data']['id_name']
+        entries = read_log(connect_str, self.cid, after=snapshot[0]['log_id'])+self.new_log
+        # The state of each source in the saved version is given by the first entry
+        # that changed it: it did not exist if it was added and it had the values of
+        # the deleted row if it was deleted
+        first = collections.OrderedDict()
+        for entry in entries:
+            if entry['action'] in ['add_src', 'delete_src']:
+                rows = [entry['log']]
+            elif entry['action'] in ['add_rows', 'delete_rows']:
+                rows = entry['log']['rows']
+            else:
+                continue
+            added = entry['action'] in ['add_src', 'add_rows']
+            for row in rows:
+                if row[id_name] not in first:
+                    first[row[id_name]] = (added, row)
+        remove_ids = [src_id for src_id, (added, row) in first.items() if src_id in self.index]
+        add_rows = [row for src_id, (added, row) in first.items() if not added]
+        step = []
+        removed = self.remove_src(remove_ids)
+        if len(removed)>0:
+            step.append(self.log('delete_rows', {'rows': removed}))
+        for row in add_rows:
+            self.insert_src(row)
+        if len(add_rows)>0:
+            step.append(self.log('add_rows', {'rows': add_rows}))
+        if len(step)>0:
+            self.push_undo(step)
+        return step
+    
     def get_nearest_neighbors(self, coord1=None, coord2=None, coord_type=None, 
             coord_unit=None, coords=None):
         """
-        Calls astrotoyz.catalog.get_nearest_neighbors. Since this method is called from
-        the catalog object, it allows the user to only specify a 'coords' dictionary that
-        contains either 'ra' and 'dec', 'x' and 'y', or the catalogs 'ra_name' and 'dec_name'
-        pairs of coordinates and automatically calculates the other fields necessary.
+        Find the nearest source in the catalog to a position using the catalogs spatial
+        index (see :py:meth:`Catalog.get_spatial_index`). The user can either specify
+        ``coord1``, ``coord2`` and ``coord_type`` or a 'coords' dictionary that
+        contains either 'ra' and 'dec', 'x' and 'y', or the catalogs 'ra_name' and
+        'dec_name' pairs of coordinates.
+        
+        Returns
+        -------
+        idx: int
+            Row of the nearest source (``None`` if the catalog is empty)
+        d2d: `astropy.coordinates.Angle` or float
+            Separation of the nearest source (in pixels if ``coord_type='px'``)
+        src: `pandas.Series`
+            The nearest source
         """
-        from astropy.coordinates import SkyCoord
+        from astropy.coordinates import Angle
+        import astropy.units as u
         if coords is None:
             if coord1 is None or coord2 is None or coord_type is None:
                 raise astrotoyz.core.AstroToyzError(
                     "Must supply either 'coords' or 'coord1' and 'coord2' and 'coord_type")
         else:
-            if (
-                self.settings['data']['ra_name'] in coords and 
-                self.settings['data']['dec_name'] in coords
-            ):
-                coord1 = coords[self.settings['data']['ra_name']]
-                coord2 = coords[self.settings['data']['dec_name']]
-                coord_type = 'wcs'
-            elif ('ra' in src_info and 'dec' in src_info and 
-                    (coord_type is None or coord_type=='wcs')):
-                coord1 = src_info['ra']
-                coord2 = src_info['dec']
+            coord_type, coord1, coord2 = self.get_coords(coords)
+        if coord_type=='wcs' and coord_unit is not None and coord_unit!='deg':
+            coord1 = (np.asarray(coord1, dtype=float)*u.Unit(coord_unit)).to(u.deg).value
+            coord2 = (np.asarray(coord2, dtype=float)*u.Unit(coord_unit)).to(u.deg).value
+        ids, distances = self.get_spatial_index(coord_type).nearest(coord1, coord2)
+        if coord_type=='wcs':
+            distances = Angle(distances, unit='deg')
+        idx = [self.index.get_loc(src_id) if src_id is not None else None for src_id in ids]
+        if np.isscalar(coord1):
+            if idx[0] is None:
+                return None, distances[0], None
+            return idx[0], distances[0], self.iloc[idx[0]]
+        return idx, distances, [self.iloc[n] if n is not None else None for n in idx]
+
+    def crossmatch(self, other, radius, coord_type=None, all_pairs=False, chunk_size=None):
+        """
+        Match every source in the catalog to the sources in ``other`` at once, using the
+        spatial index of ``other``.
+        
+        Parameters
+        ----------
+        other: :py:class:`Catalog`
+            Catalog to match against
+        radius: float or `astropy.units.Quantity`
+            Maximum separation of a match. In pixels if ``coord_type='px'``, otherwise
+            an angle (a float is interpreted as arcseconds)
+        coord_type: str, optional
+            ``'px'`` or ``'wcs'``. By default world coordinates are used if both catalogs
+            have them
+        all_pairs: bool, optional
+            Whether or not to return every pair of sources within ``radius``
+        chunk_size: int, optional
+            Number of sources matched at a time (see
+            :py:meth:`astrotoyz.spatial.SpatialIndex.match`)
+        
+        Returns
+        -------
+        result: dict
+            - ``idx``: row in ``other`` of the nearest match to each source
+              (-1 if there is no match within ``radius``)
+            - ``sep``: separation of each match (in pixels or arcseconds, ``inf`` if there
+              is no match)
+            - ``pairs`` (if ``all_pairs`` is ``True``): dict with the rows ``idx1`` (in
+              this catalog), ``idx2`` (in ``other``) and separations ``sep`` of every pair
+              within ``radius``
+        """
+        import astropy.units as u
+        ra_name = self.settings['data']['ra_name']
+        dec_name = self.settings['data']['dec_name']
+        if coord_type is None:
+            other_wcs = [other.settings['data']['ra_name'], other.settings['data']['dec_name']]
+            if (ra_name in self.columns and dec_name in self.columns and
+                    other_wcs[0] in other.columns and other_wcs[1] in other.columns):
                 coord_type = 'wcs'
-            elif ('x' in src_info and 'y' in src_info and
-                    (coord_type is None or coord_type=='px')):
-                coord1 = src_info['x']
-                coord2 = src_info['y']
+            else:
                 coord_type = 'px'
+        if coord_type=='wcs':
+            columns = [ra_name, dec_name]
+            if hasattr(radius, 'unit'):
+                radius = radius.to(u.arcsec).value
+            index_radius = radius/3600.
+        else:
+            columns = ['x', 'y']
+            index_radius = radius
+        spatial_index = other.get_spatial_index(coord_type)
+        ids, distances, pairs = spatial_index.match(self[columns[0]].values,
+            self[columns[1]].values, index_radius, all_pairs, chunk_size)
+        if coord_type=='wcs':
+            distances = distances*3600.
+        matched = np.array([src_id is not None for src_id in ids], dtype=bool)
+        idx = np.empty(len(ids), dtype=int)
+        idx.fill(-1)
+        if np.any(matched):
+            idx[matched] = other.index.get_indexer(ids[matched])
+        result = {
+            'idx': idx,
+            'sep': distances
+        }
+        if all_pairs:
+            pair_rows, pair_ids, pair_distances = pairs
+            if coord_type=='wcs':
+                pair_distances = pair_distances*3600.
+            result['pairs'] = {
+                'idx1': pair_rows,
+                'idx2': other.index.get_indexer(pair_ids) if len(pair_ids)>0 else
+                    np.array([], dtype=int),
+                'sep': pair_distances
+            }
+        return result
+    
+    def deduplicate(self, min_sep=None, coord_type=None, keep='amplitude'):
+        """
+        Merge duplicate detections (for example split maxima of a single star or sources
+        detected twice where tiles overlap). Sources closer than ``min_sep`` are grouped
+        with a friends-of-friends search (see :py:func:`astrotoyz.spatial.find_groups`)
+        and only one source in each group is kept. The catalog index must be unique.
+        
+        Parameters
+        ----------
+        min_sep: float or `astropy.units.Quantity`, optional
+            Minimum separation between sources (in pixels for ``coord_type='px'``).
+            Defaults to ``settings['data']['min_sep']`` (see :py:meth:`Catalog.get_min_sep`)
+        coord_type: str, optional
+            ``'px'`` or ``'wcs'``. By default world coordinates are used if the catalog
+            has them
+        keep: str, optional
+            Column used to choose the source kept in each group (the source with the
+            largest value is kept). If the column does not exist the first source in each
+            group is kept
+        
+        Returns
+        -------
+        removed: int
+            Number of sources removed from the catalog
+        """
+        import astropy.units as u
+        from astrotoyz.spatial import find_groups
+        ra_name = self.settings['data']['ra_name']
+        dec_name = self.settings['data']['dec_name']
+        if coord_type is None:
+            if ra_name in self.columns and dec_name in self.columns:
+                coord_type = 'wcs'
             else:
-                raise astrotoyz.core.AstroToyzError(
-                    "Adding a source requires a pair of coordinates from 'ra' and 'dec', " +
-                    "'x' and 'y', or the catlogs 'ra' and 'dec' fields")
+                coord_type = 'px'
+        if min_sep is None:
+            min_sep = self.get_min_sep(coord_type)
         if coord_type=='wcs':
-            if coord_unit is None:
-                coord_unit = 'deg'
-            cat1 = self[self.settings['data']['ra_name']]
-            cat2 = self[self.settings['data']['dec_name']]
-            c1 = SkyCoord(ra=coord1, dec=coord2, unit=coord_unit)
-            cat_coords = SkyCoord(ra=cat1, dec=cat2, unit=coord_unit)
-        elif coord_type=='px':
-            coord_unit = 'm' # a unit of length is needed to use astropy's matching function
-            cat1 = self['x'].values
-            cat2 = self['y'].values
-            c1 = SkyCoord(x=coord1, y=coord2, z=0, unit='m', representation='cartesian')
-            cat_coords = SkyCoord(x=cat1, y=cat2, z=0, unit= 'm', representation='cartesian')
+            columns = [ra_name, dec_name]
+            if hasattr(min_sep, 'unit'):
+                min_sep = min_sep.to(u.deg).value
+            else:
+                min_sep = min_sep/3600.
         else:
-            raise astrotoyz.core.AstroToyzError("Unrecognized coord_type")
-        idx, d2d, d3d = c1.match_to_catalog_sky(cat_coords)
-        # Since there is no consistent way to deal with numpy scalars, we 
-        # take the max of the scalar to get its value (ugh)
-        # Good discussion on this at
-# http://stackoverflow.com/questions/773030/why-are-0d-arrays-in-numpy-not-considered-scalar
-        if idx.shape==():
-            idx = idx.max()
-        return idx, d2d, self.loc[self.index[idx]]
+            columns = ['x', 'y']
+        if len(self)<2:
+            return 0
+        labels = find_groups(self[columns[0]].values, self[columns[1]].values,
+            min_sep, coord_type)
+        # Sort each group by ``keep`` (largest first) and keep the first source in each group
+        if keep in self.columns:
+            values = np.nan_to_num(self[keep].values.astype(float))
+            order = np.lexsort((-values, labels))
+        else:
+            order = np.argsort(labels, kind='mergesort')
+        unique_labels, first = np.unique(labels[order], return_index=True)
+        keep_rows = np.zeros(len(self), dtype=bool)
+        keep_rows[order[first]] = True
+        removed = int(np.sum(~keep_rows))
+        if removed>0:
+            ids = self.index[~keep_rows]
+            if self.index.name==self.settings['data']['id_name']:
+                # The sources can only be restored if they are indexed by their ids
+                rows = pandas.DataFrame(self.loc[ids]).reset_index().to_dict('records')
+                self.push_undo([self.log('delete_rows', {'rows': rows})])
+            self.record_changes(deleted=ids)
+            self.drop(ids, inplace=True)
+        return removed
+    
     def get_markers(self):
         data = self.reset_index()[['id','x','y']].fillna('NaN').values.tolist()
         markers = {
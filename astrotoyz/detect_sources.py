@@ -6,11 +6,12 @@ import numpy.lib.recfunctions as rfn
 import scipy.ndimage.filters as filters
 import scipy.ndimage as ndimage
 from scipy.optimize import curve_fit
-import multiprocessing
 
 from toyz.web import session_vars
 import toyz.utils.core as core
 import astrotoyz.core
+from astrotoyz.executors import get_executor, time_job
+from astrotoyz.kernels import get_model
 
 # Format of the output for each fit type
 fit_dtypes={
@@ -205,7 +206,105 @@ def detect_sources(img_data,threshold,aperture_type='radius',size=5,footprint=No
     lbl,nbrLbl=ndimage.label(maxima)
     return maxima
 
-def circular_moffat((x,y),amplitude,x_mean, y_mean,beta,alpha,floor):
+# Fits are constrained to physically meaningful parameters derived from the stamp
+# (see ``get_bounds``) unless ``bounded_fits`` is ``False``
+bounded_fits = True
+# Maximum number of model evaluations before a bounded fit is considered a failure
+max_fit_evaluations = 50
+
+def get_bounds(model_name, data):
+    """
+    Get physically motivated limits for each parameter of a model, derived from the stamp.
+    The amplitude must be positive and less than twice the range of the stamp, the
+    center must lie inside the stamp, widths must be smaller than a few stamp widths and
+    Moffat ``beta`` is restricted to the range seen in real seeing profiles.
+    
+    Parameters
+    ----------
+    model_name: str
+        Name of the model (a key in ``fit_types``)
+    data: 2D numpy array
+        Stamp that will be fit
+    
+    Returns
+    -------
+    bounds: tuple
+        ``(lower, upper)`` lists of limits for each parameter, in the same order as the model
+    """
+    height, width = data.shape
+    data_min = float(data.min())
+    data_max = float(data.max())
+    data_range = max(data_max-data_min, np.finfo(float).eps)
+    size = max(width, height)
+    amplitude = (0., 2*data_range)
+    x_mean = (0., width-1.)
+    y_mean = (0., height-1.)
+    floor = (data_min-data_range, data_max)
+    alpha = (.1, 3.*size)
+    std_dev = (.1, size)
+    beta = (1.01, 20.)
+    angle = (-np.pi, np.pi)
+    limits = {
+        'circular_moffat': [amplitude, x_mean, y_mean, alpha, beta, floor],
+        'elliptical_moffat': [amplitude, x_mean, y_mean, alpha, alpha, beta, angle, floor],
+        'circular_gaussian': [amplitude, x_mean, y_mean, std_dev, floor],
+        'elliptical_gaussian': [amplitude, x_mean, y_mean, std_dev, std_dev, angle, floor]
+    }[model_name]
+    return [l[0] for l in limits], [l[1] for l in limits]
+
+def fit_model(model_name, model_func, data, initial_guess):
+    """
+    Fit a stamp to a model, using a bounded trust region fit if ``bounded_fits`` is ``True``.
+    Bounded fits fail after ``max_fit_evaluations`` evaluations or if the center is pushed
+    to the edge of the stamp.
+    
+    Parameters
+    ----------
+    model_name: str
+        Name of the model (a key in ``fit_types``)
+    model_func: function
+        Numpy implementation of the model
+    data: 2D numpy array
+        Stamp to fit
+    initial_guess: tuple
+        Initial parameters of the model
+    
+    Returns
+    -------
+    fit_result: 1D numpy array
+        Best fit parameters (an empty list if the fit failed)
+    pcov: 2D numpy array
+        Covariance matrix of the fit (an empty list if the fit failed)
+    """
+    x = np.linspace(0, data.shape[1]-1, data.shape[1])
+    y = np.linspace(0, data.shape[0]-1, data.shape[0])
+    x, y = np.meshgrid(x, y)
+    model, jacobian = get_model(model_name, model_func)
+    if not bounded_fits:
+        try:
+            return curve_fit(model,(x,y),data.ravel(),p0=initial_guess,jac=jacobian)
+        except RuntimeError:
+            return [],[]
+    
+    lower, upper = get_bounds(model_name, data)
+    lower = np.array(lower)
+    upper = np.array(upper)
+    # The initial guess must be strictly inside the bounds
+    margin = 1e-6*(upper-lower)
+    initial_guess = np.clip(initial_guess, lower+margin, upper-margin)
+    try:
+        fit_result,pcov=curve_fit(model,(x,y),data.ravel(),p0=initial_guess,jac=jacobian,
+            bounds=(lower, upper), method='trf', x_scale='jac', max_nfev=max_fit_evaluations,
+            ftol=1e-5, xtol=1e-5)
+    except (RuntimeError, ValueError):
+        return [],[]
+    # A center on the edge of the stamp means the source was not found
+    if (fit_result[1]<=lower[1]+.5 or fit_result[1]>=upper[1]-.5 or
+            fit_result[2]<=lower[2]+.5 or fit_result[2]>=upper[2]-.5):
+        return [],[]
+    return fit_result,pcov
+
+def circular_moffat((x,y),amplitude,x_mean, y_mean,alpha,beta,floor):
     """
     Uses 2d array of data to calculate a moffat distribution at the point (x,y), then flattens the data
     into a 1d array for processing.
@@ -252,10 +351,6 @@ def fit_circular_moffat(data,init_params={}):
         Covariant matrix that describes the error in the fit (but in an 'unscientific' way).
         This needs to be improved to get accurate error estimates
     """
-    x = np.linspace(0, data.shape[1]-1, data.shape[1])
-    y = np.linspace(0, data.shape[0]-1, data.shape[0])
-    x, y = np.meshgrid(x, y)
-    
     # Guess initial parameters
     floor = np.median(data)
     amplitude=data.max()-floor
@@ -264,14 +359,14 @@ def fit_circular_moffat(data,init_params={}):
     fwhm=np.sqrt(np.sum((data>floor+amplitude/2.).flatten()))
     beta=3.5
     alpha = 0.5*fwhm/np.sqrt(2.**(1./beta)-1.)
-    initial_guess=(amplitude,x_mean,y_mean,beta,alpha,floor)
+    initial_guess=(amplitude,x_mean,y_mean,alpha,beta,floor)
     
     # Attempt fit and return empty lists if it does not converge
-    try:
-        fit_result,pcov=curve_fit(circular_moffat,(x,y),data.ravel(),p0=initial_guess)
-    except RuntimeError:
+    fit_result,pcov=fit_model('circular_moffat',circular_moffat,data,initial_guess)
+    if len(fit_result)==0:
         return [],[]
     # Convert alpha into a FWHM
+    beta = fit_result[4]
     fit_result[3]=np.sqrt(2.**(1./beta)-1.)*fit_result[3]*2
     return fit_result,pcov
 
@@ -327,10 +422,6 @@ def fit_elliptical_moffat(data):
         Covariant matrix that describes the error in the fit (but in an 'unscientific' way).
         This needs to be improved to get accurate error estimates
     """
-    x = np.linspace(0, data.shape[1]-1, data.shape[1])
-    y = np.linspace(0, data.shape[0]-1, data.shape[0])
-    x, y = np.meshgrid(x, y)
-    
     # Generate initial guess
     floor = np.median(data)
     amplitude=data.max()-floor
@@ -344,13 +435,12 @@ def fit_elliptical_moffat(data):
     initial_guess=(amplitude,x_mean,y_mean,alpha1,alpha2,beta,angle,floor)
     
     # Attempt fit and return empty lists if it does not converge
-    try:
-        fit_result,pcov=curve_fit(elliptical_moffat,(x,y),data.ravel(),p0=initial_guess)
-    except RuntimeError:
-        # Fit did not converge
+    fit_result,pcov=fit_model('elliptical_moffat',elliptical_moffat,data,initial_guess)
+    if len(fit_result)==0:
         return [],[]
     
     # Convert alpha 1 and 2 into FWHM measurements
+    beta = fit_result[5]
     fit_result[3]=np.sqrt(2.**(1./beta)-1.)*fit_result[3]*2
     fit_result[4]=np.sqrt(2.**(1./beta)-1.)*fit_result[4]*2
     return fit_result,pcov
@@ -360,9 +450,6 @@ def circular_gaussian((x,y), amplitude, x_mean, y_mean, std_dev, floor):
     return gaussian.ravel()
 
 def fit_circular_gaussian(data):
-    x = np.linspace(0, data.shape[1]-1, data.shape[1])
-    y = np.linspace(0, data.shape[0]-1, data.shape[0])
-    x, y = np.meshgrid(x, y)
     # Guess initial parameters
     floor = np.median(data)
     amplitude=data.max()-floor
@@ -373,25 +460,21 @@ def fit_circular_gaussian(data):
     initial_guess=(amplitude,x_mean,y_mean,std_dev,floor)
     
     # Attempt fit and return empty lists if it does not converge
-    try:
-        fit_result,pcov=curve_fit(circular_gaussian,(x,y),data.ravel(),p0=initial_guess)
-    except RuntimeError:
+    fit_result,pcov=fit_model('circular_gaussian',circular_gaussian,data,initial_guess)
+    if len(fit_result)==0:
         return [],[]
     # Convert alpha into a FWHM
     return fit_result,pcov
 
 def elliptical_gaussian((x,y), amplitude, x_mean, y_mean, std_x, std_y, theta, floor):
     a = .5*(np.cos(theta)/std_x)**2 + .5*(np.sin(theta)/std_y)**2
-    b = -np.sin(2*theta)/(4*std_x**2) + np.sin(2*theta)/(4*std_x**2)
+    b = -np.sin(2*theta)/(4*std_x**2) + np.sin(2*theta)/(4*std_y**2)
     c = .5*(np.sin(theta)/std_x)**2 + .5*(np.cos(theta)/std_y)**2
     exp = np.exp(-(a*(x-x_mean)**2 + 2*b*(x-x_mean)*(y-y_mean) + c*(y-y_mean)**2))
     gaussian = floor+amplitude*exp
     return gaussian.ravel()
 
 def fit_elliptical_gaussian(data):
-    x = np.linspace(0, data.shape[1]-1, data.shape[1])
-    y = np.linspace(0, data.shape[0]-1, data.shape[0])
-    x, y = np.meshgrid(x, y)
     # Guess initial parameters
     floor = np.median(data)
     amplitude = data.max()-floor
@@ -403,9 +486,8 @@ def fit_elliptical_gaussian(data):
     theta = 0
     initial_guess=(amplitude, x_mean, y_mean, std_x, std_y, theta, 0)
     # Attempt fit and return empty lists if it does not converge
-    try:
-        fit_result,pcov=curve_fit(elliptical_gaussian,(x,y),data.ravel(),p0=initial_guess)
-    except RuntimeError:
+    fit_result,pcov=fit_model('elliptical_gaussian',elliptical_gaussian,data,initial_guess)
+    if len(fit_result)==0:
         return [],[]
     # Convert alpha into a FWHM
     return fit_result,pcov
@@ -431,60 +513,141 @@ fit_types={
     'no_fit': get_centroid
 }
 
-# Multiprocessing base on PyMOTW by Doug Hellmann:
-# http://pymotw.com/2/multiprocessing/communication.html
-class FitWorker(multiprocessing.Process):
-    def __init__(self, task_queue, result_queue, data, radius, fit_method):
-        multiprocessing.Process.__init__(self)
-        self.task_queue = task_queue
-        self.result_queue = result_queue
-        self.data = data
-        self.radius = radius
-        self.fit_method = fit_method
-    
-    def run(self):
-        print('running',self.name)
-        fit_func=fit_types[self.fit_method]
-        columns = fit_columns[self.fit_method]
-        radius = self.radius
-        data = self.data
-        while True:
-            params = self.task_queue.get()
-            try:
-                if params is not None:
-                    x = params['x']
-                    y = params['y']
-                    xmin=max(x-radius,0)
-                    xmax=min(x+radius+1,data.shape[1])
-                    ymin=max(y-radius,0)
-                    ymax=min(y+radius+1,data.shape[0])
-                    best_fit,pcov=fit_func(data[ymin:ymax,xmin:xmax])
-                    if len(best_fit)==0:
-                        self.task_queue.task_done()
-                        self.result_queue.put(tuple([np.nan for i in range(len(columns))]))
-                    else:
-                        best_fit[1] += x
-                        best_fit[2] += y
-                        self.task_queue.task_done()
-                        self.result_queue.put(tuple(best_fit))
-                else:
-                    print(self.name,'received exit')
-                    self.task_queue.task_done()
-                    break
-            except Exception as e:
-                import traceback
-                print('exception in fitting:')
-                print(traceback.format_exc())
-                print('\n\n\n')
-                self.task_queue.task_done()
-                self.result_queue.put(tuple([np.nan for i in range(len(columns))]))
-        print(self.name,'finished')
-        return
+def get_stamp(data, x, y, radius):
+    """
+    Cut out a square stamp centered on pixel (x,y), clipped at the edges of the image
+    
+    Returns
+    -------
+    stamp: 2D numpy array
+        Pixels in the stamp
+    xmin, ymin: int
+        Position of the lower left pixel of the stamp in ``data``
+    """
+    xmin=max(x-radius,0)
+    xmax=min(x+radius+1,data.shape[1])
+    ymin=max(y-radius,0)
+    ymax=min(y+radius+1,data.shape[0])
+    return data[ymin:ymax,xmin:xmax], xmin, ymin
+
+# Stamps used to fit a source extend ``stamp_fwhm_scale`` times the FWHM from its center
+stamp_fwhm_scale = 2.
+min_stamp_radius = 3
+max_stamp_radius = 25
+# Radius of the stamp used to estimate the FWHM of a source
+fwhm_search_radius = 10
+
+def estimate_fwhm(data):
+    """
+    Quickly estimate the FWHM of the source at the peak of a stamp (without fitting)
+    from the area of the connected pixels around the peak that are above half of the
+    peak value.
+    
+    Parameters
+    ----------
+    data: 2D numpy array
+        Stamp containing a single source
+    
+    Returns
+    -------
+    fwhm: float
+        Approximate FWHM (in pixels) of the source, or NaN if the stamp has no peak
+    """
+    background = np.median(data)
+    amplitude = data.max()-background
+    if not amplitude>0:
+        return np.nan
+    # Only use the pixels connected to the peak, so that neighbors are not included
+    lbl, nbr_lbl = ndimage.label(data>background+amplitude/2.)
+    area = np.sum(lbl==lbl.flat[data.argmax()])
+    return 2*np.sqrt(area/np.pi)
+
+def estimate_seeing(img_data, x, y, radius, num_stars=50, saturate=None):
+    """
+    Estimate the seeing of an image from the median FWHM of the brightest sources.
+    
+    Parameters
+    ----------
+    img_data: 2D numpy array
+        Image data
+    x,y: 1D numpy arrays
+        Pixel positions of the sources
+    radius: int
+        Radius of the stamp used to estimate the FWHM of each source
+    num_stars: int, optional
+        Maximum number of sources used to estimate the seeing
+    saturate: float, optional
+        Sources with pixels above ``saturate`` are ignored
+    
+    Returns
+    -------
+    fwhm: float
+        Median FWHM (in pixels) of the brightest sources, or NaN if none are available
+    """
+    if len(x)==0:
+        return np.nan
+    peaks = img_data[y,x]
+    if saturate is not None:
+        good = peaks<saturate
+        x, y, peaks = x[good], y[good], peaks[good]
+    bright = np.argsort(peaks)[::-1][:num_stars]
+    fwhm = [estimate_fwhm(get_stamp(img_data, x[n], y[n], radius)[0]) for n in bright]
+    fwhm = np.array(fwhm)
+    fwhm = fwhm[np.isfinite(fwhm)]
+    if len(fwhm)==0:
+        return np.nan
+    return np.median(fwhm)
+
+def get_stamp_radius(fwhm, default=None):
+    """
+    Radius of the stamp needed to fit a source with a given FWHM. If ``fwhm`` is NaN
+    ``default`` is used (or ``max_stamp_radius`` if no default is given).
+    """
+    if not np.isfinite(fwhm):
+        if default is not None:
+            return default
+        return max_stamp_radius
+    radius = int(np.ceil(stamp_fwhm_scale*fwhm))
+    return min(max(radius, min_stamp_radius), max_stamp_radius)
+
+def fit_source(params):
+    """
+    Fit a single source. This is run by the executors in ``find_stars``, so it
+    takes a single picklable argument.
+    
+    Parameters
+    ----------
+    params: tuple
+        ``(stamp, xmin, ymin, fit_method)``, where ``stamp`` is the 2D array to fit
+        and ``(xmin,ymin)`` is the position of its lower left pixel in the image
+    
+    Returns
+    -------
+    result: tuple
+        Best fit parameters (in the order given by ``fit_columns[fit_method]``),
+        with positions in image coordinates. If the fit fails all of the values are NaN
+    """
+    stamp, xmin, ymin, fit_method = params
+    columns = fit_columns[fit_method]
+    try:
+        best_fit,pcov=fit_types[fit_method](stamp)
+    except Exception:
+        import traceback
+        print('exception in fitting:')
+        print(traceback.format_exc())
+        best_fit = []
+    if len(best_fit)==0:
+        return tuple([np.nan for i in range(len(columns))])
+    best_fit = list(best_fit)
+    best_fit[columns.index('x')] += xmin
+    best_fit[columns.index('y')] += ymin
+    return tuple(best_fit)
 
 def find_stars(img_data, aperture_type='radius', maxima_size=5, 
         maxima_sigma=2, maxima_footprint=None, aperture_radii=[], threshold=None,
         saturate=None, margin=None, bin_struct=None, fit_method='elliptical moffat',
-        wcs=None):
+        wcs=None, backend='auto', workers=None, allow_processes=True, stamp_radius=None,
+        seeing_map=None):
     """
     Detect possible sources in an image and attempt to fit them to a specified profile.
     
@@ -513,6 +676,8 @@ def find_stars(img_data, aperture_type='radius', maxima_size=5,
             centered on a given pixel
     aperture_radii: list,optional
         List of radii to use to fit the source. In general this should be 5 times the fwhm of the source.
+        If ``aperture_radii`` is specified and ``stamp_radius`` is ``None``, the first
+        radius is used for the stamp of each source.
     threshold: float,optional
         Minimum pixel value above the background noise
     saturate: float, optional
@@ -524,6 +689,26 @@ def find_stars(img_data, aperture_type='radius', maxima_size=5,
     fit_method: str
         Type of fit to use to get centroid positions and approximate photometric parameters.
         This step can be skipped by choosing fit_method='no fit'.
+    backend: str, optional
+        Backend used to run the fits: 'serial', 'thread', 'process' or 'auto'.
+        If ``backend='auto'`` the first source is fit inline to measure the cost of a
+        single fit, which is used to choose the fastest backend for the rest
+        (see :py:func:`astrotoyz.executors.choose_backend`)
+    workers: int, optional
+        Number of threads or processes used to fit sources. Defaults to the number of cpus
+    allow_processes: bool, optional
+        If ``False`` the process backend is never used (this must be ``False`` when
+        forking the current process is unsafe, for example in a Toyz session process)
+    stamp_radius: int or str, optional
+        Radius of the stamp used to fit each source. This can either be an integer or
+            'image': the radius is calculated from the seeing of the image,
+                estimated from the FWHM of the brightest sources (see :py:func:`estimate_seeing`)
+            'source': the radius is calculated from the estimated FWHM of each source
+            'map': the radius is calculated from the FWHM at each source in ``seeing_map``
+        If ``stamp_radius`` is ``None`` then ``aperture_radii[0]`` is used if available,
+        otherwise ``stamp_radius='map'`` if a ``seeing_map`` is given or ``stamp_radius='image'``
+    seeing_map: :py:class:`astrotoyz.seeing.SeeingMap`, optional
+        Map of the seeing from a previous detection on the same image
     
     Returns
     -------
@@ -569,44 +754,66 @@ def find_stars(img_data, aperture_type='radius', maxima_size=5,
     #core.progress_log('Fitting points')
     fit_func=fit_types[fit_method]
     step=0
-    if len(aperture_radii)==0:
-        radius=int(maxima_size*3/4)
+    if stamp_radius is None:
+        if len(aperture_radii)>0:
+            stamp_radius = aperture_radii[0]
+        elif seeing_map is not None:
+            stamp_radius = 'map'
+        else:
+            stamp_radius = 'image'
+    # Radius used to estimate the FWHM of the sources when choosing the stamp sizes
+    search_radius = max(int(maxima_size*3/4), fwhm_search_radius)
+    if stamp_radius=='image':
+        fwhm = estimate_seeing(img_data, src_indices[1], src_indices[0], search_radius,
+            saturate=saturate)
+        radius = get_stamp_radius(fwhm, int(maxima_size*3/4))
+        #core.progress_log('Estimated seeing: {0} px, stamp radius: {1}'.format(fwhm, radius))
+    elif stamp_radius=='source':
+        radius = None
+    elif stamp_radius=='map':
+        if seeing_map is None:
+            raise astrotoyz.core.AstroToyzError(
+                "A seeing_map is required to use stamp_radius='map'")
+        src_fwhm = seeing_map.fwhm_at(src_indices[1], src_indices[0])
+        radius = None
     else:
-        radius=aperture_radii[0]
+        radius = int(stamp_radius)
     
-    tasks = multiprocessing.JoinableQueue()
-    results = multiprocessing.Queue()
-
-    # Start processes
-    num_processes = multiprocessing.cpu_count()
-    print('Creating {0} processes'.format(num_processes))
-    processes = [FitWorker(tasks, results, img_data, radius, fit_method) 
-                    for i in xrange(num_processes)]
-    for p in processes:
-        p.start()
     num_sources = len(src_indices[0])
-    # TODO: use this to test detect sources: 
-    num_sources = 5
+    jobs = []
     for i in range(num_sources):
         x=src_indices[1][i]
         y=src_indices[0][i]
-        tasks.put({'x': x,'y': y})
-    
-    # Add a poison pill for each process
-    for p in range(num_processes):
-        tasks.put(None)
-    # Wait for all of the tasks to finish
-    tasks.join()
+        if stamp_radius=='source':
+            stamp = get_stamp(img_data, x, y, search_radius)[0]
+            src_radius = get_stamp_radius(estimate_fwhm(stamp), int(maxima_size*3/4))
+        elif stamp_radius=='map':
+            src_radius = get_stamp_radius(src_fwhm[i], int(maxima_size*3/4))
+        else:
+            src_radius = radius
+        stamp, xmin, ymin = get_stamp(img_data, x, y, src_radius)
+        jobs.append((stamp, xmin, ymin, fit_method))
     
     # Initialize the array to save computation time
     # and initialize to NaN in case of any bad rows
     sources = np.zeros(shape=(num_sources,), dtype=fit_dtypes[fit_method])
     sources.fill(np.nan)
-    # get the results
-    print('num sources', num_sources)
-    for i in xrange(num_sources):
-        print('i', i)
-        result = results.get()
-        #print('i', i, result)
+    if num_sources==0:
+        return sources
+    
+    results = []
+    if backend=='auto':
+        # Fit the first source inline to measure the cost of a single fit
+        result, fit_cost = time_job(fit_source, jobs[0])
+        results.append(result)
+        jobs = jobs[1:]
+    else:
+        fit_cost = None
+    executor = get_executor(backend, len(jobs), fit_cost, workers, allow_processes)
+    #core.progress_log('Fitting {0} sources using the {1} backend'.format(
+    #    num_sources, executor.backend))
+    with executor:
+        results.extend(executor.map(fit_source, jobs))
+    for i, result in enumerate(results):
         sources[i] = result
     return sources
\ No newline at end of file
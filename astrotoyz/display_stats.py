@@ -0,0 +1,172 @@
+"""
+Statistics used to scale FITS images for display (zscale limits, percentile cuts and a
+histogram). The statistics are calculated once for each HDU from a subsample of the
+image and stored in a small sidecar file, so reopening a frame does not read its pixels.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import json
+import hashlib
+import numpy as np
+
+from astrotoyz.cache import LRUCache, get_cache_path, get_mtime
+
+# Maximum number of pixels sampled from an image
+max_samples = 100000
+# Number of pixels used for the zscale fit
+zscale_samples = 1000
+# Percentile cuts stored for each image
+percentiles = [.5, 1., 2., 5., 95., 98., 99., 99.5]
+# Number of bins in the histogram
+histogram_bins = 256
+# Increment this when the statistics change so that old sidecar files are ignored
+stats_version = 2
+# Bytes read from the end of the file to fingerprint files without a DATASUM
+fingerprint_size = 65536
+
+# Statistics loaded in the current process, keyed by the HDU checksum
+stats_cache = LRUCache(maxsize=64)
+
+def zscale(samples, contrast=.25, max_reject=.5, min_npixels=5, krej=2.5, max_iterations=5):
+    """
+    IRAF zscale limits: fit a line to the sorted samples (rejecting outliers) and
+    use the slope, scaled by ``contrast``, around the median. This gives the same limits
+    as `astropy.visualization.ZScaleInterval` for the same samples.
+
+    Returns
+    -------
+    vmin, vmax: float
+        Display limits
+    """
+    samples = np.sort(samples[np.isfinite(samples)])
+    npix = len(samples)
+    if npix==0:
+        return np.nan, np.nan
+    vmin, vmax = samples[0], samples[-1]
+    center = (npix-1)//2
+    median = np.median(samples)
+    min_good = max(min_npixels, int(npix*max_reject))
+    ngrow = max(1, int(npix*.01))
+    x = np.arange(npix)
+    # Pixels rejected in any iteration stay rejected
+    bad = np.zeros(npix, dtype=bool)
+    ngood = npix
+    last_ngood = npix+1
+    slope = 0.
+    for n in range(max_iterations):
+        if ngood>=last_ngood or ngood<min_good:
+            break
+        good = ~bad
+        slope, intercept = np.polyfit(x[good], samples[good], 1)
+        flat = samples-(slope*x+intercept)
+        threshold = krej*flat[good].std()
+        bad[(flat<-threshold) | (flat>threshold)] = True
+        # Also reject the neighbors of each rejected pixel
+        bad = np.convolve(bad, np.ones(ngrow), mode='same')>0
+        last_ngood = ngood
+        ngood = npix-np.sum(bad)
+    if ngood>=min_good:
+        if contrast>0:
+            slope = slope/contrast
+        vmin = max(vmin, median-(center-1)*slope)
+        vmax = min(vmax, median+(npix-center)*slope)
+    return float(vmin), float(vmax)
+
+def sample_image(hdu, num_samples=None):
+    """
+    Sample pixels from evenly spaced rows and columns of an image. Only the sampled rows
+    are read from the file.
+    """
+    if num_samples is None:
+        num_samples = max_samples
+    height, width = hdu.header['NAXIS2'], hdu.header['NAXIS1']
+    num_rows = int(min(height, max(1, np.sqrt(num_samples*height/width))))
+    step = max(1, int(width*num_rows/num_samples))
+    rows = np.unique(np.linspace(0, height-1, num_rows).astype(int))
+    try:
+        section = hdu.section
+    except AttributeError:
+        section = hdu.data
+    sample = [np.asarray(section[row:row+1,:])[0,::step] for row in rows]
+    sample = np.concatenate(sample).astype(float)
+    return sample[np.isfinite(sample)]
+
+def compute_display_stats(hdu):
+    """
+    Calculate the display statistics for an image HDU from a subsample of its pixels
+
+    Returns
+    -------
+    stats: dict
+        ``zscale`` limits, a dict of ``percentiles``, the sample ``min`` and ``max``, the
+        ``histogram`` (``counts`` and bin ``edges`` between the 0.5 and 99.5 percentiles)
+        and the number of pixels sampled (``num_samples``)
+    """
+    sample = sample_image(hdu)
+    stats = {'num_samples': len(sample), 'version': stats_version}
+    if len(sample)==0:
+        stats.update({'zscale': None, 'percentiles': {}, 'min': None, 'max': None,
+            'histogram': None})
+        return stats
+    cuts = np.percentile(sample, percentiles)
+    zscale_sample = sample[np.linspace(0, len(sample)-1,
+        min(zscale_samples, len(sample))).astype(int)]
+    hist_range = (cuts[0], cuts[-1]) if cuts[-1]>cuts[0] else (sample.min(), sample.max()+1)
+    counts, edges = np.histogram(sample, bins=histogram_bins, range=hist_range)
+    stats.update({
+        'zscale': list(zscale(zscale_sample)),
+        'percentiles': {str(p): float(cut) for p, cut in zip(percentiles, cuts)},
+        'min': float(sample.min()),
+        'max': float(sample.max()),
+        'histogram': {
+            'counts': counts.tolist(),
+            'edges': edges.tolist()
+        }
+    })
+    return stats
+
+def get_hdu_checksum(filepath, frame, header):
+    """
+    Checksum that identifies the contents of an HDU. If the header has CHECKSUM and
+    DATASUM keywords these (and the rest of the header) identify the data, otherwise
+    the size, modification time and the end of the file are included so that the
+    pixels do not have to be read.
+    """
+    md5 = hashlib.md5()
+    md5.update(header.tostring().encode('utf-8'))
+    md5.update(str(int(frame)).encode('utf-8'))
+    if 'CHECKSUM' not in header or 'DATASUM' not in header:
+        size = os.path.getsize(filepath)
+        md5.update(repr((size, get_mtime(filepath))).encode('utf-8'))
+        with open(filepath, 'rb') as f:
+            f.seek(max(0, size-fingerprint_size))
+            md5.update(f.read())
+    return md5.hexdigest()
+
+def get_display_stats(filepath, frame, hdu):
+    """
+    Get the display statistics for an HDU, loading them from the sidecar cache if they
+    have already been calculated (see :py:func:`compute_display_stats`)
+    """
+    checksum = get_hdu_checksum(filepath, frame, hdu.header)
+    def load_stats():
+        sidecar = os.path.join(get_cache_path('stats'), checksum+'.json')
+        if os.path.isfile(sidecar):
+            try:
+                with open(sidecar) as f:
+                    stats = json.load(f)
+                if stats.get('version')==stats_version:
+                    return stats
+            except ValueError:
+                # The file is corrupt, so recalculate the statistics
+                pass
+        stats = compute_display_stats(hdu)
+        # Write to a temporary file first so that other processes never read a partial file
+        temp_file = sidecar+'.tmp{0}'.format(os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(stats, f)
+        os.rename(temp_file, sidecar)
+        return stats
+    return stats_cache.get_or_create(checksum, load_stats)
@@ -0,0 +1,201 @@
+"""
+Execution backends for Astro-Toyz. Batches of independent jobs (like fitting every
+source detected in an image) can be run serially, on a pool of threads or on a pool
+of processes through the same interface.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import time
+import multiprocessing
+import multiprocessing.pool
+
+import astrotoyz.core
+
+# Approximate cost (in seconds) of starting a single worker and of sending a job
+# to a worker and receiving its result. These are used to decide when it is
+# worth paying the overhead of running jobs in parallel
+startup_cost = {
+    'serial': 0.,
+    'thread': 0.001,
+    'process': 0.05
+}
+dispatch_cost = {
+    'serial': 0.,
+    'thread': 0.0001,
+    'process': 0.001
+}
+
+class SerialExecutor(object):
+    """
+    Run all of the jobs inline in the current thread, with no IPC overhead
+    """
+    backend = 'serial'
+    def __init__(self, workers=1):
+        self.workers = 1
+
+    def map(self, func, iterable, chunksize=None):
+        """
+        Apply ``func`` to each item in ``iterable`` and return a list of the results
+        """
+        return [func(item) for item in iterable]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class PoolExecutor(SerialExecutor):
+    """
+    Base class for executors that distribute jobs to a pool of workers
+    """
+    backend = None
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.pool = self.create_pool(workers)
+
+    def create_pool(self, workers):
+        raise NotImplementedError()
+
+    def map(self, func, iterable, chunksize=None):
+        """
+        Apply ``func`` to each item in ``iterable`` using the pool of workers and
+        return a list of the results (in the same order as ``iterable``)
+        """
+        items = list(iterable)
+        if chunksize is None:
+            # Send jobs in chunks to reduce the number of round trips to each worker
+            chunksize = max(1, len(items)//(4*self.workers))
+        return self.pool.map(func, items, chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class ThreadExecutor(PoolExecutor):
+    """
+    Run jobs on a pool of threads. Jobs share memory with the current process, so no
+    data is copied, but only code that releases the GIL will run concurrently.
+    """
+    backend = 'thread'
+    def create_pool(self, workers):
+        return multiprocessing.pool.ThreadPool(workers)
+
+class ProcessExecutor(PoolExecutor):
+    """
+    Run jobs on a pool of processes. Both ``func`` and each item must be picklable.
+    """
+    backend = 'process'
+    def create_pool(self, workers):
+        return multiprocessing.Pool(workers)
+
+executors = {
+    'serial': SerialExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor
+}
+
+def estimate_runtime(backend, num_jobs, job_cost, workers):
+    """
+    Estimate the time needed to run ``num_jobs`` jobs that each take ``job_cost``
+    seconds using a given ``backend`` with ``workers`` workers.
+    """
+    if backend == 'serial':
+        return num_jobs*job_cost
+    workers = max(1, min(workers, num_jobs))
+    if backend == 'thread':
+        # Most of the time spent in a fit is in python code that holds the GIL,
+        # so threads only give a modest speedup
+        speedup = min(workers, 2)
+    else:
+        speedup = workers
+    return (startup_cost[backend]*workers + num_jobs*dispatch_cost[backend] +
+        num_jobs*job_cost/speedup)
+
+def choose_backend(num_jobs, job_cost, workers=None, allow_processes=True):
+    """
+    Choose the fastest backend to run ``num_jobs`` jobs, each taking approximately
+    ``job_cost`` seconds.
+
+    Parameters
+    ----------
+    num_jobs: int
+        Number of jobs to run
+    job_cost: float
+        Estimated time (in seconds) to run a single job
+    workers: int, optional
+        Number of workers available to a pool. Defaults to the number of cpus
+    allow_processes: bool, optional
+        If ``False`` the process backend will not be used (for example when forking
+        the current process is unsafe)
+
+    Returns
+    -------
+    backend: str
+        Name of the backend in ``executors``
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if num_jobs<=1 or workers<=1:
+        return 'serial'
+    backends = ['serial', 'thread']
+    if allow_processes:
+        backends.append('process')
+    runtimes = [estimate_runtime(backend, num_jobs, job_cost, workers) for backend in backends]
+    return backends[runtimes.index(min(runtimes))]
+
+def get_executor(backend='auto', num_jobs=None, job_cost=None, workers=None,
+        allow_processes=True):
+    """
+    Create an executor.
+
+    Parameters
+    ----------
+    backend: str, optional
+        Either a key in ``executors`` or ``'auto'``, in which case the backend is chosen
+        using ``num_jobs`` and ``job_cost`` (see :py:func:`choose_backend`)
+    num_jobs: int, optional
+        Number of jobs that will be run (required if ``backend='auto'``)
+    job_cost: float, optional
+        Estimated time (in seconds) for a single job (required if ``backend='auto'``)
+    workers: int, optional
+        Number of workers to use in a pool. Defaults to the number of cpus
+    allow_processes: bool, optional
+        If ``False`` the process backend is not considered when ``backend='auto'`` and
+        requesting it raises an error
+
+    Returns
+    -------
+    executor: :py:class:`SerialExecutor`, :py:class:`ThreadExecutor` or
+    :py:class:`ProcessExecutor`
+    """
+    if backend == 'auto':
+        if num_jobs is None or job_cost is None:
+            raise astrotoyz.core.AstroToyzError(
+                "You must supply 'num_jobs' and 'job_cost' to automatically choose a backend")
+        backend = choose_backend(num_jobs, job_cost, workers, allow_processes)
+    if backend=='process' and not allow_processes:
+        raise astrotoyz.core.AstroToyzError(
+            "The process backend cannot be used here, choose 'serial' or 'thread'")
+    if backend not in executors:
+        raise astrotoyz.core.AstroToyzError(
+            "Invalid backend, please choose from 'auto','"+"','".join(executors))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if num_jobs is not None:
+        workers = max(1, min(workers, num_jobs))
+    return executors[backend](workers)
+
+def time_job(func, item):
+    """
+    Run a single job and return its result and the time (in seconds) it took to run
+    """
+    start = time.time()
+    result = func(item)
+    return result, time.time()-start
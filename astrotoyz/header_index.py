@@ -0,0 +1,268 @@
+"""
+Persistent index of selected FITS header keywords for each extension of a file, so that
+metadata (like the detector section or filter of every frame in a directory) can be
+looked up without opening and parsing FITS headers.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from astrotoyz.cache import get_cache_path, get_mtime
+
+# Keywords stored in the index for each extension
+index_keywords = ['EXTNAME', 'XTENSION', 'NAXIS', 'NAXIS1', 'NAXIS2', 'BITPIX', 'CTYPE1',
+    'CTYPE2', 'DETSEC', 'DATASEC', 'EXPTIME', 'FILTER', 'FILTER1', 'FILTER2', 'OBJECT',
+    'DATE-OBS', 'MJD-OBS', 'AIRMASS']
+# Extensions of files added when indexing a directory
+fits_extensions = ('.fits', '.fit', '.fts', '.fits.fz', '.fits.gz')
+
+def in_directory(path):
+    """
+    SQL condition (and its arguments) that selects the files in a directory or its
+    subdirectories. The prefix is compared exactly, since ``LIKE`` treats ``_`` and
+    ``%`` in paths as wildcards and ignores case.
+    """
+    prefix = os.path.join(os.path.abspath(path), '')
+    return "substr(filepath, 1, length(?))=?", [prefix, prefix]
+
+class HeaderIndex(object):
+    """
+    Index of header keywords stored in an SQLite database. Each file is re-indexed
+    when its modification time changes.
+
+    Parameters
+    ----------
+    path: str, optional
+        Path to the database. Defaults to ``headers.db`` in the Astro-Toyz cache directory
+    keywords: list, optional
+        Keywords to store for each extension. Defaults to ``index_keywords``
+    """
+    def __init__(self, path=None, keywords=None):
+        if path is None:
+            path = os.path.join(get_cache_path(), 'headers.db')
+        if keywords is None:
+            keywords = index_keywords
+        self.path = path
+        self.keywords = keywords
+        self.lock = threading.RLock()
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                filepath TEXT PRIMARY KEY, mtime REAL, num_hdus INTEGER)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS keywords (
+                filepath TEXT, hdu INTEGER, keyword TEXT, value,
+                PRIMARY KEY (filepath, hdu, keyword))""")
+            connection.execute("""CREATE INDEX IF NOT EXISTS keyword_values
+                ON keywords (keyword, value)""")
+
+    @contextmanager
+    def connect(self):
+        """
+        Open a connection to the database, which is committed and closed when the
+        context exits. Connections are not shared between threads.
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def read_headers(self, filepath):
+        """
+        Read the indexed keywords from each header in a file (the data is not read)
+
+        Returns
+        -------
+        headers: list
+            Dictionary of keywords for each HDU
+        """
+        import astropy.io.fits as pyfits
+        headers = []
+        hdulist = pyfits.open(filepath, mode='readonly')
+        try:
+            for hdu in hdulist:
+                header = hdu.header
+                values = {}
+                for keyword in self.keywords:
+                    if keyword in header:
+                        value = header[keyword]
+                        if isinstance(value, bool):
+                            value = int(value)
+                        elif not isinstance(value, (int, float)):
+                            value = str(value)
+                        values[keyword] = value
+                headers.append(values)
+        finally:
+            hdulist.close()
+        return headers
+
+    def update_file(self, filepath, force=False):
+        """
+        Index a file if it has not been indexed or has been modified since it was indexed
+
+        Returns
+        -------
+        updated: bool
+            Whether or not the file was (re)indexed
+        """
+        filepath = os.path.abspath(filepath)
+        mtime = get_mtime(filepath)
+        with self.lock:
+            with self.connect() as connection:
+                row = connection.execute("SELECT mtime FROM files WHERE filepath=?",
+                    (filepath,)).fetchone()
+                if not force and row is not None and mtime is not None and row[0]==mtime:
+                    return False
+                connection.execute("DELETE FROM keywords WHERE filepath=?", (filepath,))
+                connection.execute("DELETE FROM files WHERE filepath=?", (filepath,))
+                if mtime is None:
+                    # The file has been removed
+                    return True
+                headers = self.read_headers(filepath)
+                connection.executemany(
+                    "INSERT INTO keywords (filepath, hdu, keyword, value) VALUES (?,?,?,?)",
+                    [(filepath, n, keyword, value) for n, header in enumerate(headers)
+                        for keyword, value in header.items()])
+                connection.execute(
+                    "INSERT INTO files (filepath, mtime, num_hdus) VALUES (?,?,?)",
+                    (filepath, mtime, len(headers)))
+        return True
+
+    def update_directory(self, path, recursive=False):
+        """
+        Index all of the FITS files in a directory and remove files that no longer exist
+        from the index
+
+        Returns
+        -------
+        updated: list
+            Files that were (re)indexed
+        """
+        path = os.path.abspath(path)
+        updated = []
+        filepaths = set()
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                if filename.lower().endswith(fits_extensions):
+                    filepaths.add(os.path.join(root, filename))
+            if not recursive:
+                break
+        for filepath in sorted(filepaths):
+            try:
+                if self.update_file(filepath):
+                    updated.append(filepath)
+            except (IOError, OSError):
+                # Skip files that are not valid FITS files
+                pass
+        # Remove files that have been deleted
+        with self.lock:
+            with self.connect() as connection:
+                condition, args = in_directory(path)
+                rows = connection.execute(
+                    "SELECT filepath FROM files WHERE "+condition, args).fetchall()
+                for (filepath,) in rows:
+                    if not os.path.isfile(filepath):
+                        connection.execute("DELETE FROM keywords WHERE filepath=?",
+                            (filepath,))
+                        connection.execute("DELETE FROM files WHERE filepath=?", (filepath,))
+        return updated
+
+    def get_keywords(self, filepath, hdu=None, update=True):
+        """
+        Get the indexed keywords for a file.
+
+        Parameters
+        ----------
+        filepath: str
+            Path to the FITS file
+        hdu: int, optional
+            Index of the HDU. If ``hdu`` is ``None`` the keywords for all of the HDUs
+            are returned. If the index does not have the HDU the file is re-indexed,
+            and if the file still does not have the HDU an empty dict is returned.
+        update: bool, optional
+            Re-index the file first if it has been modified
+
+        Returns
+        -------
+        keywords: dict or list
+            Dictionary of keywords for the HDU, or a list of dictionaries for each HDU
+        """
+        filepath = os.path.abspath(filepath)
+        if update:
+            self.update_file(filepath)
+        headers = self.read_keywords(filepath)
+        if hdu is None:
+            return headers
+        if int(hdu)>=len(headers) and update:
+            # The index is out of date (for example the file was rewritten without
+            # changing its modification time)
+            self.update_file(filepath, force=True)
+            headers = self.read_keywords(filepath)
+        if int(hdu)>=len(headers):
+            return {}
+        return headers[int(hdu)]
+
+    def read_keywords(self, filepath):
+        """
+        Read the keywords for each HDU of a file from the index (without updating it)
+        """
+        with self.connect() as connection:
+            num_hdus = connection.execute("SELECT num_hdus FROM files WHERE filepath=?",
+                (filepath,)).fetchone()
+            rows = connection.execute(
+                "SELECT hdu, keyword, value FROM keywords WHERE filepath=?",
+                (filepath,)).fetchall()
+        headers = [{} for n in range(num_hdus[0] if num_hdus is not None else 0)]
+        for n, keyword, value in rows:
+            headers[n][keyword] = value
+        return headers
+
+    def query(self, path=None, **conditions):
+        """
+        Find the extensions whose keywords match all of the ``conditions``, for example
+        ``index.query('/data/night1', FILTER='r')``. Only files that have already been
+        indexed are searched.
+
+        Parameters
+        ----------
+        path: str, optional
+            Only return files in this directory (or its subdirectories)
+        conditions: dict
+            Keywords and their required values
+
+        Returns
+        -------
+        result: list
+            ``(filepath, hdu)`` for each matching extension
+        """
+        queries = []
+        args = []
+        for keyword, value in conditions.items():
+            queries.append("SELECT filepath, hdu FROM keywords WHERE keyword=? AND value=?")
+            args += [keyword, value]
+        if len(queries)==0:
+            queries.append("SELECT filepath, hdu FROM keywords")
+        sql = " INTERSECT ".join(queries)
+        if path is not None:
+            condition, path_args = in_directory(path)
+            sql = "SELECT * FROM ({0}) WHERE {1}".format(sql, condition)
+            args += path_args
+        with self.connect() as connection:
+            return sorted(set(connection.execute(sql, args).fetchall()))
+
+_header_index = None
+_header_index_lock = threading.Lock()
+
+def get_header_index():
+    """
+    Get the header index shared by the current process
+    """
+    global _header_index
+    with _header_index_lock:
+        if _header_index is None:
+            _header_index = HeaderIndex()
+    return _header_index
@@ -0,0 +1,290 @@
+"""
+Model and Jacobian kernels used by the fitting functions in
+:py:mod:`astrotoyz.detect_sources`.
+
+If `Numba <http://numba.pydata.org>`_ is installed each model is evaluated, along with
+its Jacobian, in a single compiled loop over the pixels, which avoids creating the
+temporary arrays needed by the numpy versions. Otherwise the pure numpy Jacobians
+defined here are used.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Use the compiled kernels whenever they are available. This can be set to ``False``
+# to force the numpy implementations (for example to benchmark the two)
+use_compiled = numba is not None
+
+def jit(func):
+    """
+    Compile ``func`` with numba (if it is installed), otherwise return ``func`` unchanged
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+#####################
+# Numpy Jacobians   #
+#####################
+
+def circular_moffat_jacobian((x,y), amplitude, x_mean, y_mean, alpha, beta, floor):
+    """
+    Jacobian of :py:func:`astrotoyz.detect_sources.circular_moffat` with respect to
+    each of its parameters, as an array with shape ``(x.size, 6)``
+    """
+    dx = (x-x_mean).ravel()
+    dy = (y-y_mean).ravel()
+    r2 = dx**2+dy**2
+    d = 1.+r2/alpha**2
+    u = d**-beta
+    g = -2.*beta*amplitude*u/(d*alpha**2)
+    return np.column_stack([u, -g*dx, -g*dy, -g*r2/alpha,
+        -amplitude*u*np.log(d), np.ones(dx.shape)])
+
+def elliptical_moffat_jacobian((x,y), amplitude, x_mean, y_mean, alpha1, alpha2,
+        beta, angle, floor):
+    """
+    Jacobian of :py:func:`astrotoyz.detect_sources.elliptical_moffat` with respect to
+    each of its parameters, as an array with shape ``(x.size, 8)``
+    """
+    cos = np.cos(angle)
+    sin = np.sin(angle)
+    dx = (x-x_mean).ravel()
+    dy = (y-y_mean).ravel()
+    a = cos*dx+sin*dy
+    b = sin*dx-cos*dy
+    p = a/alpha1**2
+    q = b/alpha2**2
+    d = 1.+p*a+q*b
+    u = d**-beta
+    g = -2.*beta*amplitude*u/d
+    return np.column_stack([
+        u,
+        -g*(p*cos+q*sin),
+        -g*(p*sin-q*cos),
+        -g*p**2*alpha1,
+        -g*q**2*alpha2,
+        -amplitude*u*np.log(d),
+        g*p*q*(alpha1**2-alpha2**2),
+        np.ones(dx.shape)
+    ])
+
+def circular_gaussian_jacobian((x,y), amplitude, x_mean, y_mean, std_dev, floor):
+    """
+    Jacobian of :py:func:`astrotoyz.detect_sources.circular_gaussian` with respect to
+    each of its parameters, as an array with shape ``(x.size, 5)``
+    """
+    dx = (x-x_mean).ravel()
+    dy = (y-y_mean).ravel()
+    r2 = dx**2+dy**2
+    e = np.exp(-r2/(2*std_dev**2))
+    g = amplitude*e/std_dev**2
+    return np.column_stack([e, g*dx, g*dy, g*r2/std_dev, np.ones(dx.shape)])
+
+def elliptical_gaussian_jacobian((x,y), amplitude, x_mean, y_mean, std_x, std_y,
+        theta, floor):
+    """
+    Jacobian of :py:func:`astrotoyz.detect_sources.elliptical_gaussian` with respect to
+    each of its parameters, as an array with shape ``(x.size, 7)``
+    """
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    dx = (x-x_mean).ravel()
+    dy = (y-y_mean).ravel()
+    p = (cos*dx-sin*dy)/std_x
+    q = (sin*dx+cos*dy)/std_y
+    e = np.exp(-.5*(p**2+q**2))
+    g = amplitude*e
+    return np.column_stack([
+        e,
+        g*(p*cos/std_x+q*sin/std_y),
+        g*(q*cos/std_y-p*sin/std_x),
+        g*p**2/std_x,
+        g*q**2/std_y,
+        g*p*q*(std_y/std_x-std_x/std_y),
+        np.ones(dx.shape)
+    ])
+
+#####################
+# Compiled kernels  #
+#####################
+# Each kernel fills ``model`` and ``jac`` for the pixels at (x,y) in a single loop.
+
+@jit
+def _circular_moffat_kernel(x, y, params, model, jac):
+    amplitude = params[0]
+    x_mean = params[1]
+    y_mean = params[2]
+    alpha = params[3]
+    beta = params[4]
+    floor = params[5]
+    inv_alpha2 = 1./(alpha*alpha)
+    for i in range(x.shape[0]):
+        dx = x[i]-x_mean
+        dy = y[i]-y_mean
+        r2 = dx*dx+dy*dy
+        d = 1.+r2*inv_alpha2
+        u = d**-beta
+        g = -2.*beta*amplitude*u*inv_alpha2/d
+        model[i] = floor+amplitude*u
+        jac[i,0] = u
+        jac[i,1] = -g*dx
+        jac[i,2] = -g*dy
+        jac[i,3] = -g*r2/alpha
+        jac[i,4] = -amplitude*u*math.log(d)
+        jac[i,5] = 1.
+
+@jit
+def _elliptical_moffat_kernel(x, y, params, model, jac):
+    amplitude = params[0]
+    x_mean = params[1]
+    y_mean = params[2]
+    alpha1 = params[3]
+    alpha2 = params[4]
+    beta = params[5]
+    angle = params[6]
+    floor = params[7]
+    cos = math.cos(angle)
+    sin = math.sin(angle)
+    inv_alpha1 = 1./(alpha1*alpha1)
+    inv_alpha2 = 1./(alpha2*alpha2)
+    for i in range(x.shape[0]):
+        dx = x[i]-x_mean
+        dy = y[i]-y_mean
+        a = cos*dx+sin*dy
+        b = sin*dx-cos*dy
+        p = a*inv_alpha1
+        q = b*inv_alpha2
+        d = 1.+p*a+q*b
+        u = d**-beta
+        g = -2.*beta*amplitude*u/d
+        model[i] = floor+amplitude*u
+        jac[i,0] = u
+        jac[i,1] = -g*(p*cos+q*sin)
+        jac[i,2] = -g*(p*sin-q*cos)
+        jac[i,3] = -g*p*p*alpha1
+        jac[i,4] = -g*q*q*alpha2
+        jac[i,5] = -amplitude*u*math.log(d)
+        jac[i,6] = g*p*q*(alpha1*alpha1-alpha2*alpha2)
+        jac[i,7] = 1.
+
+@jit
+def _circular_gaussian_kernel(x, y, params, model, jac):
+    amplitude = params[0]
+    x_mean = params[1]
+    y_mean = params[2]
+    std_dev = params[3]
+    floor = params[4]
+    inv_var = 1./(std_dev*std_dev)
+    for i in range(x.shape[0]):
+        dx = x[i]-x_mean
+        dy = y[i]-y_mean
+        r2 = dx*dx+dy*dy
+        e = math.exp(-.5*r2*inv_var)
+        g = amplitude*e*inv_var
+        model[i] = floor+amplitude*e
+        jac[i,0] = e
+        jac[i,1] = g*dx
+        jac[i,2] = g*dy
+        jac[i,3] = g*r2/std_dev
+        jac[i,4] = 1.
+
+@jit
+def _elliptical_gaussian_kernel(x, y, params, model, jac):
+    amplitude = params[0]
+    x_mean = params[1]
+    y_mean = params[2]
+    std_x = params[3]
+    std_y = params[4]
+    theta = params[5]
+    floor = params[6]
+    cos = math.cos(theta)
+    sin = math.sin(theta)
+    for i in range(x.shape[0]):
+        dx = x[i]-x_mean
+        dy = y[i]-y_mean
+        p = (cos*dx-sin*dy)/std_x
+        q = (sin*dx+cos*dy)/std_y
+        e = math.exp(-.5*(p*p+q*q))
+        g = amplitude*e
+        model[i] = floor+g
+        jac[i,0] = e
+        jac[i,1] = g*(p*cos/std_x+q*sin/std_y)
+        jac[i,2] = g*(q*cos/std_y-p*sin/std_x)
+        jac[i,3] = g*p*p/std_x
+        jac[i,4] = g*q*q/std_y
+        jac[i,5] = g*p*q*(std_y/std_x-std_x/std_y)
+        jac[i,6] = 1.
+
+class FusedModel(object):
+    """
+    Wrap a compiled kernel so that it can be used by ``scipy.optimize.curve_fit``.
+    The model and Jacobian are calculated together, and the Jacobian is cached
+    until it is requested for the same set of parameters.
+    """
+    def __init__(self, kernel, nparams):
+        self.kernel = kernel
+        self.nparams = nparams
+        self.params = None
+        self.jac = None
+
+    def evaluate(self, xy, params):
+        x = np.ascontiguousarray(xy[0], dtype=float).ravel()
+        y = np.ascontiguousarray(xy[1], dtype=float).ravel()
+        params = np.array(params, dtype=float)
+        # New arrays are created for each call since the optimizer may keep
+        # references to previous results
+        model = np.empty(x.shape)
+        jac = np.empty((x.shape[0], self.nparams))
+        self.kernel(x, y, params, model, jac)
+        self.params = params
+        self.jac = jac
+        return model
+
+    def model(self, xy, *params):
+        return self.evaluate(xy, params)
+
+    def jacobian(self, xy, *params):
+        if self.params is None or not np.array_equal(self.params, params):
+            self.evaluate(xy, params)
+        return self.jac
+
+# Map each model to its numpy Jacobian, compiled kernel and number of parameters
+kernels = {
+    'circular_moffat': (circular_moffat_jacobian, _circular_moffat_kernel, 6),
+    'elliptical_moffat': (elliptical_moffat_jacobian, _elliptical_moffat_kernel, 8),
+    'circular_gaussian': (circular_gaussian_jacobian, _circular_gaussian_kernel, 5),
+    'elliptical_gaussian': (elliptical_gaussian_jacobian, _elliptical_gaussian_kernel, 7)
+}
+
+def get_model(model_name, numpy_model):
+    """
+    Get the functions used to fit a model.
+
+    Parameters
+    ----------
+    model_name: str
+        Name of the model (a key in ``kernels``)
+    numpy_model: function
+        Numpy implementation of the model, used when the compiled kernels are not available
+
+    Returns
+    -------
+    model: function
+        Function with the signature ``model((x,y), *params)`` that returns the flattened model
+    jacobian: function
+        Function with the signature ``jacobian((x,y), *params)`` that returns the Jacobian
+        of the model with shape ``(x.size, len(params))``
+    """
+    numpy_jacobian, kernel, nparams = kernels[model_name]
+    if use_compiled and numba is not None:
+        fused = FusedModel(kernel, nparams)
+        return fused.model, fused.jacobian
+    return numpy_model, numpy_jacobian
@@ -0,0 +1,185 @@
+"""
+Multiresolution pyramids for large FITS images. Each level of a pyramid is the image
+binned by a factor of 2 from the previous level, stored as a memory mapped numpy array
+in the cache directory, so that tiles at any zoom level only read a bounded number of
+pixels.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+from astrotoyz.cache import LRUCache, get_cache_path, get_mtime
+
+# Only build pyramids for images with at least this many pixels along one axis
+min_pyramid_size = 2048
+# Stop adding levels once both axes are smaller than this
+min_level_size = 512
+# Number of rows of the previous level read at a time while building a level
+strip_rows = 1024
+
+# Pyramids currently being built, keyed by their cache path
+builds = {}
+builds_lock = threading.Lock()
+# Pyramids that could not be built (these are not retried)
+failed_builds = set()
+# Pyramids that have been opened, keyed by their cache path
+pyramid_cache = LRUCache(maxsize=16)
+
+def downsample(data):
+    """
+    Bin an image by a factor of 2 along each axis (by averaging each 2x2 block). If the
+    image has an odd number of rows or columns the last row or column is repeated.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if data.shape[0]%2==1:
+        data = np.vstack([data, data[-1:]])
+    if data.shape[1]%2==1:
+        data = np.hstack([data, data[:,-1:]])
+    return .25*(data[0::2,0::2]+data[1::2,0::2]+data[0::2,1::2]+data[1::2,1::2])
+
+def get_level_shapes(shape):
+    """
+    Shape of each level of a pyramid for an image with a given ``shape`` (level 0 is
+    the full image)
+    """
+    shapes = [tuple(shape)]
+    while max(shapes[-1])>min_level_size:
+        height, width = shapes[-1]
+        shapes.append(((height+1)//2, (width+1)//2))
+    return shapes
+
+def get_pyramid_path(filepath, frame):
+    """
+    Cache directory for the pyramid of an image. The path includes the modification time
+    of the file, so a new pyramid is built if the file changes.
+    """
+    filepath = os.path.abspath(filepath)
+    key = repr((filepath, get_mtime(filepath), int(frame)))
+    return os.path.join(get_cache_path('pyramids'), hashlib.md5(key.encode('utf-8')).hexdigest())
+
+class Pyramid(object):
+    """
+    A multiresolution pyramid that has been built in the cache directory
+
+    Attributes
+    ----------
+    path: str
+        Directory containing the pyramid
+    shapes: list
+        Shape of each level (level 0 is the full resolution image, which is not stored)
+    levels: list
+        Memory mapped array for each level. ``levels[0]`` is ``None``
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'pyramid.json')) as f:
+            meta = json.load(f)
+        self.shapes = [tuple(shape) for shape in meta['shapes']]
+        self.levels = [None]+[np.load(os.path.join(path, 'level{0}.npy'.format(n)),
+            mmap_mode='r') for n in range(1, len(self.shapes))]
+
+    def get_level(self, scale):
+        """
+        Get the coarsest level with at least ``scale`` pixels per image pixel, so that
+        the level never has to be upsampled to display the image at ``scale``
+        """
+        if scale>=1:
+            return 0
+        level = int(np.floor(np.log2(1/scale)))
+        return min(level, len(self.levels)-1)
+
+    def read(self, level, ymin, ymax, xmin, xmax):
+        """
+        Read the section of a level that covers the full resolution pixels
+        ``[ymin:ymax, xmin:xmax]``
+        """
+        factor = 2**level
+        return self.levels[level][ymin//factor:-(-ymax//factor), xmin//factor:-(-xmax//factor)]
+
+def build_pyramid(filepath, frame, path):
+    """
+    Build the pyramid for an image. The levels are written to a temporary directory
+    that is renamed to ``path`` once all of the levels are complete.
+    """
+    import astropy.io.fits as pyfits
+    temp_path = path+'.tmp{0}'.format(threading.current_thread().ident)
+    if not os.path.isdir(temp_path):
+        os.makedirs(temp_path)
+    try:
+        # Use a separate file handle, since this runs in a background thread
+        hdulist = pyfits.open(filepath, mode='readonly')
+        try:
+            hdu = hdulist[int(frame)]
+            shapes = get_level_shapes((hdu.header['NAXIS2'], hdu.header['NAXIS1']))
+            source = hdu.section
+            for n in range(1, len(shapes)):
+                level = np.lib.format.open_memmap(
+                    os.path.join(temp_path, 'level{0}.npy'.format(n)),
+                    mode='w+', dtype=np.float32, shape=shapes[n])
+                # Build the level from strips of the previous level to limit the memory used
+                for row in range(0, shapes[n-1][0], strip_rows):
+                    strip = source[row:min(row+strip_rows, shapes[n-1][0]), :]
+                    level[row//2:row//2+(strip.shape[0]+1)//2] = downsample(strip)
+                level.flush()
+                source = level
+            del source
+        finally:
+            hdulist.close()
+        with open(os.path.join(temp_path, 'pyramid.json'), 'w') as f:
+            json.dump({'filepath': filepath, 'frame': int(frame), 'shapes': shapes}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(temp_path)
+        else:
+            os.rename(temp_path, path)
+    except Exception:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        with builds_lock:
+            failed_builds.add(path)
+        raise
+    finally:
+        with builds_lock:
+            builds.pop(path, None)
+
+def get_pyramid(filepath, frame, shape, background=True):
+    """
+    Get the pyramid for an image.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the FITS file
+    frame: int
+        HDU of the image
+    shape: tuple
+        Shape ``(height, width)`` of the image
+    background: bool, optional
+        If the pyramid has not been built, build it in a background thread (``True``)
+        or build it before returning (``False``)
+
+    Returns
+    -------
+    pyramid: :py:class:`Pyramid`
+        The pyramid, or ``None`` if the image is too small to need a pyramid or the
+        pyramid is still being built
+    """
+    if max(shape)<min_pyramid_size:
+        return None
+    path = get_pyramid_path(filepath, frame)
+    if os.path.isfile(os.path.join(path, 'pyramid.json')):
+        return pyramid_cache.get_or_create(path, lambda: Pyramid(path))
+    if not background:
+        build_pyramid(filepath, frame, path)
+        return pyramid_cache.get_or_create(path, lambda: Pyramid(path))
+    with builds_lock:
+        if path not in builds and path not in failed_builds:
+            thread = threading.Thread(target=build_pyramid, args=(filepath, frame, path))
+            thread.daemon = True
+            builds[path] = thread
+            thread.start()
+    return None
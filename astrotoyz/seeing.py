@@ -0,0 +1,247 @@
+"""
+Maps of the seeing and PSF shape across an image, built from the fits to the sources
+detected by :py:func:`astrotoyz.detect_sources.find_stars`.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import scipy.ndimage as ndimage
+
+import astrotoyz.core
+
+# Conversion from the standard deviation of a gaussian to its FWHM
+std2fwhm = 2*np.sqrt(2*np.log(2))
+
+def get_psf_shape(sources):
+    """
+    Get the FWHM of the major and minor axes and the position angle of the major axis
+    for each source, from any of the fit types in
+    :py:data:`astrotoyz.detect_sources.fit_dtypes`.
+
+    Parameters
+    ----------
+    sources: numpy structured array or `pandas.DataFrame`
+        Fit results for each source
+
+    Returns
+    -------
+    major, minor, angle: 1D numpy arrays
+        FWHM (in pixels) along the major and minor axes and the angle (in radians) of
+        the major axis, in the range ``[-pi/2, pi/2)``
+    """
+    def column(name):
+        return np.asarray(sources[name], dtype=float)
+    if hasattr(sources, 'columns'):
+        names = list(sources.columns)
+    else:
+        names = list(sources.dtype.names)
+    if 'fwhm1' in names:
+        fwhm1 = column('fwhm1')
+        fwhm2 = column('fwhm2')
+        angle = column('angle')
+    elif 'std_x' in names:
+        fwhm1 = std2fwhm*np.abs(column('std_x'))
+        fwhm2 = std2fwhm*np.abs(column('std_y'))
+        angle = column('angle')
+    elif 'fwhm' in names:
+        fwhm1 = column('fwhm')
+        fwhm2 = fwhm1
+        angle = np.zeros(fwhm1.shape)
+    elif 'std_dev' in names:
+        fwhm1 = std2fwhm*np.abs(column('std_dev'))
+        fwhm2 = fwhm1
+        angle = np.zeros(fwhm1.shape)
+    else:
+        raise astrotoyz.core.AstroToyzError(
+            "Sources must contain FWHM or standard deviation columns to build a seeing map")
+    fwhm1 = np.abs(fwhm1)
+    fwhm2 = np.abs(fwhm2)
+    major = np.maximum(fwhm1, fwhm2)
+    minor = np.minimum(fwhm1, fwhm2)
+    # If the second axis is the larger one the major axis is rotated by 90 degrees
+    angle = np.where(fwhm2>fwhm1, angle+np.pi/2, angle)
+    angle = np.mod(angle+np.pi/2, np.pi)-np.pi/2
+    return major, minor, angle
+
+class SeeingMap(object):
+    """
+    Seeing (FWHM), ellipticity and PSF position angle binned on a grid across an image.
+
+    Attributes
+    ----------
+    shape: tuple
+        Shape of the image ``(height, width)``
+    bins: tuple
+        Number of bins along the y and x axes
+    fwhm, ellipticity, angle: 2D numpy arrays
+        Smoothed value of each quantity in each bin
+    counts: 2D numpy array
+        Number of sources used in each bin
+    """
+    def __init__(self, shape, bins, fwhm, ellipticity, angle, counts):
+        self.shape = tuple(shape)
+        self.bins = tuple(bins)
+        self.fwhm = np.asarray(fwhm, dtype=float)
+        self.ellipticity = np.asarray(ellipticity, dtype=float)
+        self.angle = np.asarray(angle, dtype=float)
+        self.counts = np.asarray(counts, dtype=int)
+
+    def get_bin_coords(self, x, y):
+        """
+        Convert pixel coordinates into (fractional) bin coordinates, where the center
+        of the first bin is 0
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        bin_x = (x+.5)*self.bins[1]/self.shape[1]-.5
+        bin_y = (y+.5)*self.bins[0]/self.shape[0]-.5
+        return bin_x, bin_y
+
+    def at(self, x, y):
+        """
+        Interpolate the map at pixel positions (x,y)
+
+        Returns
+        -------
+        result: dict
+            ``fwhm``, ``ellipticity`` and ``angle`` at each position
+        """
+        bin_x, bin_y = self.get_bin_coords(x, y)
+        coords = np.array([np.atleast_1d(bin_y), np.atleast_1d(bin_x)])
+        result = {}
+        for name in ['fwhm', 'ellipticity']:
+            result[name] = ndimage.map_coordinates(
+                getattr(self, name), coords, order=1, mode='nearest')
+        # Angles are axial, so they are interpolated as vectors at twice the angle
+        cos2 = ndimage.map_coordinates(np.cos(2*self.angle), coords, order=1, mode='nearest')
+        sin2 = ndimage.map_coordinates(np.sin(2*self.angle), coords, order=1, mode='nearest')
+        result['angle'] = .5*np.arctan2(sin2, cos2)
+        if np.isscalar(x) and np.isscalar(y):
+            result = {k: v[0] for k,v in result.items()}
+        return result
+
+    def fwhm_at(self, x, y):
+        """
+        Interpolate the FWHM at pixel positions (x,y)
+        """
+        return self.at(x, y)['fwhm']
+
+    def to_dict(self):
+        """
+        Convert the map into a dict that can be encoded as JSON (NaN values are
+        converted to the string 'NaN', as the client expects)
+        """
+        def to_list(arr):
+            return np.where(np.isfinite(arr), arr.astype(object), 'NaN').tolist()
+        return {
+            'shape': list(self.shape),
+            'bins': list(self.bins),
+            'fwhm': to_list(self.fwhm),
+            'ellipticity': to_list(self.ellipticity),
+            'angle': to_list(self.angle),
+            'counts': self.counts.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, seeing_map):
+        """
+        Load a map created by :py:meth:`SeeingMap.to_dict`
+        """
+        return cls(seeing_map['shape'], seeing_map['bins'], seeing_map['fwhm'],
+            seeing_map['ellipticity'], seeing_map['angle'], seeing_map['counts'])
+
+def build_seeing_map(sources, shape, bin_size=256, smoothing=1., clip=3.):
+    """
+    Bin the PSF shapes of fit sources on a grid and build a smooth map of the seeing,
+    ellipticity and PSF position angle. All of the operations are vectorized over the
+    sources and bins, so no additional passes are made over the image pixels.
+
+    Parameters
+    ----------
+    sources: numpy structured array or `pandas.DataFrame`
+        Output from :py:func:`astrotoyz.detect_sources.find_stars` (or any fit results
+        with ``x`` and ``y`` columns and FWHM or standard deviation columns)
+    shape: tuple
+        Shape of the image ``(height, width)``
+    bin_size: int, optional
+        Approximate width (in pixels) of each bin
+    smoothing: float, optional
+        Standard deviation (in bins) of the gaussian kernel used to smooth the map
+        and fill bins that do not contain any sources
+    clip: float, optional
+        Sources more than ``clip`` standard deviations from the mean FWHM of their bin
+        are rejected (for example blends and cosmic rays)
+
+    Returns
+    -------
+    seeing_map: :py:class:`SeeingMap`
+    """
+    height, width = shape
+    bins = (max(1, int(round(height/bin_size))), max(1, int(round(width/bin_size))))
+    x = np.asarray(sources['x'], dtype=float)
+    y = np.asarray(sources['y'], dtype=float)
+    major, minor, angle = get_psf_shape(sources)
+    good = (np.isfinite(x) & np.isfinite(y) & np.isfinite(major) & np.isfinite(minor) &
+        np.isfinite(angle) & (minor>0))
+    x, y, major, minor, angle = x[good], y[good], major[good], minor[good], angle[good]
+    fwhm = np.sqrt(major*minor)
+    ellipticity = 1-minor/major
+
+    # Index of the bin containing each source
+    col = np.clip((x*bins[1]/width).astype(int), 0, bins[1]-1)
+    row = np.clip((y*bins[0]/height).astype(int), 0, bins[0]-1)
+    idx = row*bins[1]+col
+    nbins = bins[0]*bins[1]
+
+    def bin_sum(values, weights):
+        return np.bincount(idx, weights=values*weights, minlength=nbins)
+
+    # Reject outliers in each bin using the mean and standard deviation of the FWHM
+    weights = np.ones(fwhm.shape)
+    if clip is not None and len(fwhm)>0:
+        counts = np.bincount(idx, minlength=nbins).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = bin_sum(fwhm, weights)/counts
+            std = np.sqrt(bin_sum(fwhm**2, weights)/counts-mean**2)
+        deviation = np.abs(fwhm-mean[idx])
+        weights[(deviation>clip*std[idx]) & (std[idx]>0)] = 0
+
+    # Smooth each sum (normalized convolution), which also fills in empty bins
+    def smooth(values):
+        values = values.reshape(bins)
+        if smoothing>0:
+            values = ndimage.gaussian_filter(values, smoothing, mode='nearest')
+        return values
+    counts = smooth(np.bincount(idx, weights=weights, minlength=nbins))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fwhm_map = smooth(bin_sum(fwhm, weights))/counts
+        ellipticity_map = smooth(bin_sum(ellipticity, weights))/counts
+        # Average the axial angles as vectors at twice the angle
+        cos2 = smooth(bin_sum(np.cos(2*angle), weights))
+        sin2 = smooth(bin_sum(np.sin(2*angle), weights))
+    angle_map = .5*np.arctan2(sin2, cos2)
+    num_sources = np.bincount(idx, weights=weights, minlength=nbins).reshape(bins)
+    return SeeingMap(shape, bins, fwhm_map, ellipticity_map, angle_map, num_sources)
+
+def cache_seeing_map(file_info, seeing_map):
+    """
+    Store a seeing map for an image in the current session, so that it can be used
+    (for example to choose stamp sizes) without re-measuring the image
+    """
+    from toyz.web import session_vars
+    if not hasattr(session_vars, 'seeing_maps'):
+        session_vars.seeing_maps = {}
+    key = (file_info['filepath'], int(file_info['frame']))
+    session_vars.seeing_maps[key] = seeing_map
+
+def get_cached_seeing_map(file_info):
+    """
+    Get the seeing map for an image stored in the current session, or ``None`` if the
+    image does not have a seeing map
+    """
+    from toyz.web import session_vars
+    if not hasattr(session_vars, 'seeing_maps'):
+        return None
+    key = (file_info['filepath'], int(file_info['frame']))
+    return session_vars.seeing_maps.get(key, None)
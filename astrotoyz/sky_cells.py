@@ -0,0 +1,231 @@
+"""
+Hierarchical sky cells used to partition large catalogs. Cells are numbered with the
+HEALPix nested scheme: the sky is split into 12 base cells and each cell of order ``k``
+is split into 4 cells of order ``k+1``, so the cell of order ``k-1`` that contains a cell
+is ``cell>>2``. All of the cells of order ``K`` inside a cell of order ``k`` form a single
+range of numbers, which allows saved catalogs to look up a region of the sky with an
+index on a single integer column.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+
+# Order of the cells stored with saved catalogs (cells are about 26 arcsec across)
+cell_order = 13
+# Maximum order supported (cell numbers must fit in a 64 bit integer)
+max_order = 29
+# Number of sample points across a cell used to find the cells that overlap a region
+samples_per_cell = 8
+
+def cell_size(order):
+    """
+    Approximate size of a cell (the square root of its area) in degrees
+    """
+    return np.degrees(np.sqrt(4*np.pi/(12*4**order)))
+
+def interleave_bits(ix, iy, order):
+    """
+    Interleave the bits of ``ix`` (even bits) and ``iy`` (odd bits)
+    """
+    result = np.zeros(ix.shape, dtype=np.int64)
+    for bit in range(order):
+        result |= ((ix>>bit)&1)<<(2*bit)
+        result |= ((iy>>bit)&1)<<(2*bit+1)
+    return result
+
+def radec2cell(ra, dec, order=None):
+    """
+    Get the number of the cell (in the HEALPix nested scheme) that contains each position.
+
+    Parameters
+    ----------
+    ra, dec: array-like
+        Positions in degrees
+    order: int, optional
+        Order of the cells (there are ``12*4**order`` cells). Defaults to ``cell_order``
+
+    Returns
+    -------
+    cells: numpy array
+        Cell number of each position (-1 for positions that are not finite)
+    """
+    if order is None:
+        order = cell_order
+    nside = 2**order
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    finite = np.isfinite(ra) & np.isfinite(dec)
+    z = np.sin(np.radians(np.where(finite, dec, 0)))
+    za = np.abs(z)
+    # Longitude in units of 90 degrees, in [0,4)
+    tt = np.mod(np.where(finite, ra, 0), 360.)/90.
+    face = np.zeros(ra.shape, dtype=np.int64)
+    ix = np.zeros(ra.shape, dtype=np.int64)
+    iy = np.zeros(ra.shape, dtype=np.int64)
+
+    # Equatorial region
+    eq = za<=2/3
+    temp1 = nside*(.5+tt[eq])
+    temp2 = nside*.75*z[eq]
+    jp = (temp1-temp2).astype(np.int64)
+    jm = (temp1+temp2).astype(np.int64)
+    ifp = jp>>order
+    ifm = jm>>order
+    face[eq] = np.where(ifp==ifm, ifp|4, np.where(ifp<ifm, ifp, ifm+8))
+    ix[eq] = jm&(nside-1)
+    iy[eq] = nside-(jp&(nside-1))-1
+
+    # Polar caps
+    polar = ~eq
+    ntt = np.minimum(3, tt[polar].astype(np.int64))
+    tp = tt[polar]-ntt
+    tmp = nside*np.sqrt(3*(1-za[polar]))
+    jp = np.minimum((tp*tmp).astype(np.int64), nside-1)
+    jm = np.minimum(((1-tp)*tmp).astype(np.int64), nside-1)
+    north = z[polar]>=0
+    face[polar] = np.where(north, ntt, ntt+8)
+    ix[polar] = np.where(north, nside-jm-1, jp)
+    iy[polar] = np.where(north, nside-jp-1, jm)
+
+    cells = face*nside*nside+interleave_bits(ix, iy, order)
+    cells[~finite] = -1
+    return cells
+
+def get_query_order(size, order=None):
+    """
+    Order of the cells used to cover a region of a given ``size`` (in degrees): the
+    largest order (up to ``order``) with cells at least a quarter of ``size``
+    """
+    if order is None:
+        order = cell_order
+    query_order = 0
+    while query_order<order and cell_size(query_order+1)>=size/4:
+        query_order += 1
+    return query_order
+
+def sample_cells(ra, dec, query_order):
+    """
+    Unique cells of order ``query_order`` that contain the sample points
+    """
+    cells = radec2cell(ra, dec, query_order)
+    return np.unique(cells[cells>=0])
+
+def cone_cells(ra, dec, radius, order=None):
+    """
+    Find the cells that overlap a cone.
+
+    The cone (plus a margin of one cell) is sampled with a grid of angular offsets
+    spaced ``1/samples_per_cell`` of a cell apart, at an order chosen so that the cone is
+    only a few cells across. Each offset is rotated onto the sphere about the center of the
+    cone (an azimuthal equidistant projection), which never spreads the samples further
+    apart than the grid, so cones of any radius are covered.
+
+    Parameters
+    ----------
+    ra, dec: float
+        Center of the cone (in degrees)
+    radius: float
+        Radius of the cone (in degrees)
+    order: int, optional
+        Order of the cells stored with the catalog. Defaults to ``cell_order``
+
+    Returns
+    -------
+    cells: numpy array
+        Cells of order ``query_order`` that overlap the cone
+    query_order: int
+        Order of the cells
+    """
+    query_order = get_query_order(2*radius, order)
+    size = cell_size(query_order)
+    extent = radius+size
+    spacing = size/samples_per_cell
+    offsets = np.arange(-extent, extent+spacing, spacing)
+    xi, eta = np.meshgrid(offsets, offsets)
+    inside = np.hypot(xi, eta)<=extent
+    if extent>=180:
+        return np.arange(12*4**query_order, dtype=np.int64), query_order
+    xi = xi[inside]
+    eta = eta[inside]
+    # Move each sample a distance ``rho`` from the center at position angle ``theta``
+    rho = np.radians(np.hypot(xi, eta))
+    theta = np.arctan2(xi, eta)
+    dec0 = np.radians(dec)
+    sin_dec = np.sin(dec0)*np.cos(rho)+np.cos(dec0)*np.sin(rho)*np.cos(theta)
+    sample_dec = np.degrees(np.arcsin(np.clip(sin_dec, -1, 1)))
+    sample_ra = ra+np.degrees(np.arctan2(np.sin(theta)*np.sin(rho)*np.cos(dec0),
+        np.cos(rho)-np.sin(dec0)*sin_dec))
+    return sample_cells(sample_ra, sample_dec, query_order), query_order
+
+def ra_width(ra_min, ra_max):
+    """
+    Width in ra (in degrees) of a box from ``ra_min`` to ``ra_max``, which wraps around
+    ra=0 if ``ra_min>ra_max``. Boxes with different limits at the same angle (for
+    example 0 to 360) cover the full circle.
+    """
+    width = np.mod(ra_max-ra_min, 360.)
+    if width==0 and ra_max!=ra_min:
+        width = 360.
+    return width
+
+def box_cells(ra_min, ra_max, dec_min, dec_max, order=None):
+    """
+    Find the cells that overlap a box in ra and dec (in degrees). If ``ra_min>ra_max``
+    the box wraps around ra=0. See :py:func:`cone_cells` for the return values.
+    """
+    width = ra_width(ra_min, ra_max)
+    max_cos = max(np.cos(np.radians(dec_min)), np.cos(np.radians(dec_max)))
+    if dec_min<=0<=dec_max:
+        max_cos = 1.
+    query_order = get_query_order(max(width*max_cos, dec_max-dec_min), order)
+    size = cell_size(query_order)
+    spacing = size/samples_per_cell
+    dec_samples = np.arange(max(-90., dec_min-size), min(90., dec_max+size)+spacing, spacing)
+    dec_samples = np.clip(dec_samples, -90., 90.)
+    sample_ra = []
+    sample_dec = []
+    for dec in dec_samples:
+        # Keep the spacing in ra about the same on the sky at each declination
+        cos_dec = max(np.cos(np.radians(dec)), 1e-6)
+        ra_margin = min(size/cos_dec, 180.)
+        ra_spacing = min(spacing/cos_dec, 360.)
+        ra_samples = np.arange(-ra_margin, width+ra_margin+ra_spacing, ra_spacing)
+        sample_ra.append(ra_min+ra_samples)
+        sample_dec.append(np.ones(ra_samples.shape)*dec)
+    return sample_cells(np.concatenate(sample_ra), np.concatenate(sample_dec),
+        query_order), query_order
+
+def cell_ranges(cells, query_order, order=None):
+    """
+    Convert cells of order ``query_order`` to ranges of cells of order ``order``
+
+    Returns
+    -------
+    ranges: list
+        ``(start, stop)`` of each range of cells (``stop`` is not included).
+        Adjacent ranges are merged.
+    """
+    if order is None:
+        order = cell_order
+    shift = 2*(order-query_order)
+    ranges = []
+    for cell in np.sort(cells):
+        start = int(cell)<<shift
+        stop = (int(cell)+1)<<shift
+        if len(ranges)>0 and ranges[-1][1]==start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    Angular separation (in degrees) between positions (in degrees)
+    """
+    ra1, dec1, ra2, dec2 = [np.radians(np.asarray(x, dtype=float))
+        for x in [ra1, dec1, ra2, dec2]]
+    sin_ddec = np.sin((dec2-dec1)/2)
+    sin_dra = np.sin((ra2-ra1)/2)
+    a = sin_ddec**2+np.cos(dec1)*np.cos(dec2)*sin_dra**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(a, 0, 1))))
@@ -0,0 +1,340 @@
+"""
+Spatial indexes for catalogs. Pixel coordinates are indexed with a KD-tree on (x,y)
+and sky coordinates with a KD-tree on the unit vectors of (ra, dec), so nearest
+neighbor and radius queries take O(log N) instead of comparing against every source.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+from scipy.spatial import cKDTree
+
+# The tree is rebuilt when the number of sources added or removed since it was built is
+# larger than ``rebuild_fraction`` of the sources in the tree (and at least ``min_rebuild``)
+rebuild_fraction = .1
+min_rebuild = 64
+# Number of neighbors requested in the first nearest neighbor query. Removed sources are
+# still in the tree, so the query is repeated with more neighbors for any position whose
+# neighbors have all been removed
+initial_neighbors = 4
+# Number of positions matched at a time by ``SpatialIndex.match``, which bounds the
+# memory used when cross matching large catalogs
+match_chunk_size = 100000
+
+def radec2xyz(ra, dec):
+    """
+    Convert ra and dec (in degrees) to unit vectors
+
+    Returns
+    -------
+    xyz: numpy array
+        ``(N, 3)`` array of unit vectors
+    """
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=float)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=float)))
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)])
+
+def chord2angle(chord):
+    """
+    Convert the distance between two unit vectors to the angle between them (in degrees)
+    """
+    return np.degrees(2*np.arcsin(np.clip(np.asarray(chord)/2, 0, 1)))
+
+def angle2chord(angle):
+    """
+    Convert an angle (in degrees) to the distance between two unit vectors
+    """
+    return 2*np.sin(np.radians(np.minimum(angle, 180.))/2)
+
+def find_groups(coord1, coord2, radius, coord_type='px'):
+    """
+    Friends-of-friends grouping: sources closer than ``radius`` (in pixels or degrees)
+    are linked, and each group is the set of sources connected by links.
+
+    Returns
+    -------
+    labels: numpy array
+        Group number of each source. Sources with non-finite coordinates are each put
+        in their own group.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    if coord_type=='wcs':
+        points = radec2xyz(coord1, coord2)
+        radius = angle2chord(radius)
+    else:
+        points = np.column_stack([np.atleast_1d(np.asarray(coord1, dtype=float)),
+            np.atleast_1d(np.asarray(coord2, dtype=float))])
+    num = len(points)
+    finite = np.where(np.all(np.isfinite(points), axis=1))[0]
+    pairs = cKDTree(points[finite]).query_pairs(radius, output_type='ndarray')
+    pairs = finite[pairs] if len(pairs)>0 else np.zeros((0, 2), dtype=int)
+    links = coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:,0], pairs[:,1])),
+        shape=(num, num))
+    num_groups, labels = connected_components(links, directed=False)
+    return labels
+
+class SpatialIndex(object):
+    """
+    KD-tree of source positions that can be updated as sources are added and removed.
+    New sources are kept in a small list that is searched directly and removed sources
+    are masked, so the tree is only rebuilt after a significant number of changes.
+
+    Parameters
+    ----------
+    coord1, coord2: array-like
+        Positions of the sources, either x and y (``coord_type='px'``) or ra and dec
+        in degrees (``coord_type='wcs'``)
+    ids: array-like
+        Identifier of each source (for example the catalog index)
+    coord_type: str, optional
+        ``'px'`` or ``'wcs'``. Distances are in pixels for ``'px'`` and degrees for ``'wcs'``
+    """
+    def __init__(self, coord1, coord2, ids, coord_type='px'):
+        self.coord_type = coord_type
+        self.build(self.get_points(coord1, coord2), np.asarray(ids, dtype=object))
+
+    def get_points(self, coord1, coord2):
+        """
+        Convert coordinates to the points stored in the tree
+        """
+        if self.coord_type=='wcs':
+            return radec2xyz(coord1, coord2)
+        return np.column_stack([np.atleast_1d(np.asarray(coord1, dtype=float)),
+            np.atleast_1d(np.asarray(coord2, dtype=float))])
+
+    def to_distance(self, tree_distance):
+        """
+        Convert distances in the tree to pixels or degrees
+        """
+        tree_distance = np.asarray(tree_distance, dtype=float)
+        if self.coord_type=='wcs':
+            # Missing matches (infinite distances) stay infinite
+            return np.where(np.isinf(tree_distance), np.inf, chord2angle(tree_distance))
+        return tree_distance
+
+    def to_tree_distance(self, distance):
+        """
+        Convert a distance in pixels or degrees to a distance in the tree
+        """
+        if self.coord_type=='wcs':
+            return angle2chord(distance)
+        return distance
+
+    def build(self, points, ids):
+        """
+        Build the tree from all of the current sources
+        """
+        finite = np.all(np.isfinite(points), axis=1)
+        self.points = points[finite]
+        self.ids = ids[finite]
+        self.tree = cKDTree(self.points) if len(self.points)>0 else None
+        self.alive = np.ones(len(self.points), dtype=bool)
+        self.positions = {source_id: n for n, source_id in enumerate(self.ids)}
+        self.new_points = []
+        self.new_ids = []
+        self.num_removed = 0
+
+    def rebuild(self):
+        """
+        Rebuild the tree including the new sources and without the removed sources
+        """
+        points = [self.points[self.alive]]+[np.atleast_2d(p) for p in self.new_points]
+        ids = np.concatenate([self.ids[self.alive], np.array(self.new_ids, dtype=object)])
+        self.build(np.vstack(points), ids)
+
+    def check_rebuild(self):
+        changes = self.num_removed+len(self.new_ids)
+        if changes>max(min_rebuild, rebuild_fraction*len(self.points)):
+            self.rebuild()
+
+    def __len__(self):
+        return int(np.sum(self.alive))+len(self.new_ids)
+
+    def add(self, coord1, coord2, ids):
+        """
+        Add sources to the index
+        """
+        points = self.get_points(coord1, coord2)
+        for point, source_id in zip(points, np.atleast_1d(ids)):
+            if np.all(np.isfinite(point)):
+                self.new_points.append(point)
+                self.new_ids.append(source_id)
+        self.check_rebuild()
+
+    def remove(self, ids):
+        """
+        Remove sources from the index
+        """
+        for source_id in np.atleast_1d(np.asarray(ids, dtype=object)):
+            if source_id in self.positions and self.alive[self.positions[source_id]]:
+                self.alive[self.positions[source_id]] = False
+                self.num_removed += 1
+            elif source_id in self.new_ids:
+                n = self.new_ids.index(source_id)
+                del self.new_ids[n]
+                del self.new_points[n]
+        self.check_rebuild()
+
+    def query_points(self, points):
+        """
+        Nearest neighbor of each point (in tree coordinates)
+
+        Returns
+        -------
+        ids: numpy array
+            Identifier of the nearest source (``None`` if the index is empty)
+        distances: numpy array
+            Distance (in the tree) to the nearest source (``inf`` if the index is empty)
+        """
+        num = len(points)
+        distances = np.empty(num)
+        distances.fill(np.inf)
+        ids = np.empty(num, dtype=object)
+        if self.tree is not None and np.any(self.alive):
+            # Removed sources are still in the tree, so the nearest source that has not
+            # been removed is found by widening the search only for the positions where
+            # all of the neighbors found so far have been removed
+            pending = np.arange(num)
+            k = min(len(self.points), initial_neighbors)
+            while len(pending)>0:
+                tree_dist, tree_idx = self.tree.query(points[pending], k=k)
+                if k==1:
+                    tree_dist = tree_dist[:,None]
+                    tree_idx = tree_idx[:,None]
+                alive = self.alive[tree_idx]
+                first = np.argmax(alive, axis=1)
+                rows = np.arange(len(pending))
+                found = alive[rows, first]
+                distances[pending[found]] = tree_dist[rows, first][found]
+                ids[pending[found]] = self.ids[tree_idx[rows, first][found]]
+                if k==len(self.points):
+                    break
+                pending = pending[~found]
+                k = min(len(self.points), 4*k)
+        if len(self.new_ids)>0:
+            new_points = np.vstack(self.new_points)
+            for n in range(num):
+                new_dist = np.sqrt(np.sum((new_points-points[n])**2, axis=1))
+                nearest = np.argmin(new_dist)
+                if new_dist[nearest]<distances[n]:
+                    distances[n] = new_dist[nearest]
+                    ids[n] = self.new_ids[nearest]
+        return ids, distances
+
+    def nearest(self, coord1, coord2):
+        """
+        Find the nearest source to each position.
+
+        Returns
+        -------
+        ids: numpy array
+            Identifier of the nearest source (``None`` if the index is empty)
+        distances: numpy array
+            Distance to the nearest source, in pixels or degrees (``inf`` if the
+            index is empty)
+        """
+        ids, distances = self.query_points(self.get_points(coord1, coord2))
+        return ids, self.to_distance(distances)
+
+    def query_radius(self, coord1, coord2, radius):
+        """
+        Find all of the sources within ``radius`` (in pixels or degrees) of each position
+
+        Returns
+        -------
+        result: list
+            List of the identifiers of the sources near each position
+        """
+        points = self.get_points(coord1, coord2)
+        tree_radius = self.to_tree_distance(radius)
+        result = [[] for n in range(len(points))]
+        if self.tree is not None:
+            for n, neighbors in enumerate(self.tree.query_ball_point(points, tree_radius)):
+                result[n] = [self.ids[m] for m in neighbors if self.alive[m]]
+        if len(self.new_ids)>0:
+            new_points = np.vstack(self.new_points)
+            for n in range(len(points)):
+                new_dist = np.sqrt(np.sum((new_points-points[n])**2, axis=1))
+                result[n] += [self.new_ids[m] for m in np.where(new_dist<=tree_radius)[0]]
+        return result
+
+    def match(self, coord1, coord2, radius, all_pairs=False, chunk_size=None):
+        """
+        Match a list of positions to the sources in the index. The positions are matched
+        in chunks of ``chunk_size``, so the memory used (apart from the matched pairs)
+        does not depend on the number of positions.
+
+        Parameters
+        ----------
+        coord1, coord2: array-like
+            Positions to match (x and y or ra and dec in degrees)
+        radius: float
+            Maximum separation of a match (in pixels or degrees)
+        all_pairs: bool, optional
+            Whether or not to return every source within ``radius`` of each position
+        chunk_size: int, optional
+            Number of positions matched at a time. Defaults to ``match_chunk_size``
+
+        Returns
+        -------
+        ids: numpy array
+            Identifier of the nearest source within ``radius`` of each position
+            (``None`` if there is no match)
+        distances: numpy array
+            Separation of the nearest source (``inf`` if there is no match)
+        pairs: tuple
+            If ``all_pairs`` is ``True``, arrays with the position number, the source
+            identifier and the separation of each pair, otherwise ``None``
+        """
+        if chunk_size is None:
+            chunk_size = match_chunk_size
+        # Match against a tree without removed or new sources, so that all of the
+        # queries can be vectorized
+        if self.num_removed>0 or len(self.new_ids)>0:
+            self.rebuild()
+        coord1 = np.atleast_1d(np.asarray(coord1, dtype=float))
+        coord2 = np.atleast_1d(np.asarray(coord2, dtype=float))
+        num = len(coord1)
+        tree_radius = self.to_tree_distance(radius)
+        ids = np.empty(num, dtype=object)
+        distances = np.empty(num)
+        distances.fill(np.inf)
+        pair_rows = []
+        pair_sources = []
+        pair_distances = []
+        for start in range(0, num, chunk_size):
+            if self.tree is None:
+                break
+            points = self.get_points(coord1[start:start+chunk_size],
+                coord2[start:start+chunk_size])
+            finite = np.all(np.isfinite(points), axis=1)
+            points = points[finite]
+            rows = np.arange(start, start+len(finite))[finite]
+            tree_dist, tree_idx = self.tree.query(points, k=1,
+                distance_upper_bound=tree_radius)
+            found = np.isfinite(tree_dist)
+            distances[rows[found]] = tree_dist[found]
+            ids[rows[found]] = self.ids[tree_idx[found]]
+            if all_pairs:
+                neighbors = self.tree.query_ball_point(points, tree_radius)
+                counts = np.array([len(neighbor) for neighbor in neighbors], dtype=int)
+                if np.sum(counts)==0:
+                    continue
+                sources = np.concatenate([neighbor for neighbor in neighbors
+                    if len(neighbor)>0]).astype(int)
+                point_idx = np.repeat(np.arange(len(points)), counts)
+                pair_rows.append(rows[point_idx])
+                pair_sources.append(self.ids[sources])
+                pair_distances.append(np.sqrt(np.sum(
+                    (points[point_idx]-self.points[sources])**2, axis=1)))
+        pairs = None
+        if all_pairs:
+            if len(pair_rows)>0:
+                pairs = (np.concatenate(pair_rows), np.concatenate(pair_sources),
+                    self.to_distance(np.concatenate(pair_distances)))
+            else:
+                pairs = (np.array([], dtype=int), np.array([], dtype=object),
+                    np.array([], dtype=float))
+        return ids, self.to_distance(distances), pairs
@@ -440,7 +440,6 @@ Toyz.Astro.Viewer.Controls = function(options){
                                 aperture_type: 'radius',
                                 maxima_size: 5,
                                 maxima_sigma: 2,
-                                aperture_radii: [5],
                                 threshold: 19,
                                 saturate: 40000,
                                 fit_method: 'elliptical_moffat'
@@ -567,7 +566,9 @@ Toyz.Astro.Viewer.Contents.prototype.onmousemove = function(event){
                         file_info: file_info,
                         img_info: img_info,
                         x: x,
-                        y: y
+                        y: y,
+                        // Only the latest hover request from this viewer is answered
+                        viewer_id: this.tile.id
                     }
                 },
                 callback: function(result){
@@ -595,13 +596,81 @@ Toyz.Astro.Viewer.Contents.prototype.get_img_tiles = function(viewer_frame, file
             callback: function(viewer_frame, file_frame, tiles, result){
                 var file_info = this.frames[viewer_frame].file_info;
                 file_info.images[file_frame] = result.img_info;
-                var temp = new Toyz.Viewer.Contents();
-                temp.get_img_tiles.call(this, viewer_frame, file_frame, tiles);
+                this.send_tile_requests(viewer_frame, file_frame, tiles);
             }.bind(this, viewer_frame, file_frame, tiles)
         })
     }else{
+        this.send_tile_requests(viewer_frame, file_frame, tiles);
+    };
+};
+// Load the cached display statistics for a frame before loading the frame, so that
+// the color scale limits do not have to be calculated from the full image
+Toyz.Astro.Viewer.Contents.prototype.get_img_info = function(viewer_frame, file_frame){
+    var file_info = $.extend(true, {}, this.frames[viewer_frame].file_info);
+    var img_info = file_info.images[file_frame];
+    if(file_info.ext!='fits' || (img_info!==undefined && img_info.hasOwnProperty('colormap'))){
         var temp = new Toyz.Viewer.Contents();
-        temp.get_img_tiles.call(this, viewer_frame, file_frame, tiles);
+        temp.get_img_info.call(this, viewer_frame, file_frame);
+        return;
+    };
+    delete file_info.images;
+    file_info.frame = file_frame;
+    websocket.send_task({
+        task: {
+            module: 'astrotoyz.tasks',
+            task: 'get_display_stats',
+            parameters: {
+                file_info: file_info
+            }
+        },
+        callback: function(viewer_frame, file_frame, result){
+            var file_info = this.frames[viewer_frame].file_info;
+            if(!file_info.images.hasOwnProperty(file_frame)){
+                file_info.images[file_frame] = {};
+            };
+            var img_info = file_info.images[file_frame];
+            img_info.display_stats = result.stats;
+            if(!file_info.colormap.set_bounds && result.stats.zscale!==null){
+                img_info.colormap = $.extend(true, {}, file_info.colormap, {
+                    px_min: result.stats.zscale[0],
+                    px_max: result.stats.zscale[1]
+                });
+            };
+            var temp = new Toyz.Viewer.Contents();
+            temp.get_img_info.call(this, viewer_frame, file_frame);
+        }.bind(this, viewer_frame, file_frame)
+    });
+};
+// Same as Toyz.Viewer.Contents.get_img_tiles but tiles are created by Astro-Toyz,
+// which uses image pyramids for large FITS images
+Toyz.Astro.Viewer.Contents.prototype.send_tile_requests = function(
+        viewer_frame, file_frame, tiles){
+    var file_info = $.extend(true, {}, this.frames[viewer_frame].file_info);
+    var img_info = file_info.images[file_frame];
+    // No need to send a large json object with unnecessary data
+    delete file_info['images'];
+    delete img_info['tiles'];
+    
+    if(this.viewer_frame==viewer_frame){
+        this.$tile_div.scrollTop(img_info.viewer.top);
+        this.$tile_div.scrollLeft(img_info.viewer.left);
+    };
+    
+    for(var tile_idx in tiles){
+        if(tiles.hasOwnProperty(tile_idx)){
+            websocket.send_task({
+                task: {
+                    module: 'astrotoyz.tasks',
+                    task: 'get_img_tile',
+                    parameters: {
+                        file_info: file_info,
+                        img_info: img_info,
+                        tile_info: tiles[tile_idx]
+                    }
+                },
+                callback: this.rx_tile_info.bind(this, viewer_frame, file_frame, tile_idx)
+            });
+        }
     };
 };
 
@@ -1159,6 +1228,7 @@ Toyz.Astro.Viewer.SurfaceDialog.prototype.update = function(update){
                     file_info: file_info,
                     img_info: img_info,
                     data_type: 'data',
+                    viewer_id: this.parent.tile.id,
                     fit_type: params.conditions.fit_type,
                     x: this.cursor.x/img_info.viewer.scale,
                     y: this.cursor.y/img_info.viewer.scale,
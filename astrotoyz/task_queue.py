@@ -0,0 +1,355 @@
+"""
+Run slow Astro-Toyz tasks on a pool of worker threads in the session process, so that a
+fit or source detection does not block the other requests from the same session.
+Jobs are run in order of priority (cheap interactive requests first) and their
+responses are sent to the client when they finish. Only the main thread of the session
+process writes to the pipe to the web application (see :py:class:`SessionPipe`). (Batches of jobs inside a single
+task, like fitting every detected source, use :py:mod:`astrotoyz.executors`.)
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import sys
+import fcntl
+import errno
+import select
+import heapq
+import itertools
+import threading
+import traceback
+import time
+from functools import wraps
+
+from toyz.web import session_vars
+from toyz.utils.errors import ToyzJobError
+import toyz.utils.core
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Priorities of jobs (lower values are run first)
+priorities = {
+    'interactive': 0,
+    'normal': 1,
+    'background': 2
+}
+# Number of worker threads in each session process
+num_workers = 3
+# Number of the workers that only run interactive jobs, so that hover and coordinate
+# requests are never stuck behind long running jobs
+reserved_workers = 1
+# Set to ``False`` to run all of the tasks synchronously
+async_tasks = True
+
+class PriorityExecutor(object):
+    """
+    Pool of worker threads that run jobs in order of priority. Jobs with the same
+    priority are run in the order they were submitted.
+
+    Parameters
+    ----------
+    num_workers: int, optional
+        Number of worker threads
+    reserved_workers: int, optional
+        Number of the workers that only run jobs with priority ``priorities['interactive']``
+    """
+    def __init__(self, num_workers=num_workers, reserved_workers=reserved_workers):
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.workers = []
+        for n in range(num_workers):
+            if n<reserved_workers:
+                max_priority = priorities['interactive']
+            else:
+                max_priority = None
+            worker = threading.Thread(target=self.run_worker, args=(max_priority,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, priority, func, *args, **kwargs):
+        """
+        Add a job to the queue. ``func(*args, **kwargs)`` is called by the first
+        available worker once all of the jobs with a higher priority have started.
+        """
+        with self.condition:
+            heapq.heappush(self.queue, (priority, next(self.counter), func, args, kwargs))
+            self.condition.notify_all()
+
+    def run_worker(self, max_priority):
+        """
+        Run jobs from the queue. If ``max_priority`` is not ``None`` the worker only runs
+        jobs with a priority less than or equal to ``max_priority``.
+        """
+        while True:
+            with self.condition:
+                while (len(self.queue)==0 or
+                        (max_priority is not None and self.queue[0][0]>max_priority)):
+                    self.condition.wait()
+                priority, count, func, args, kwargs = heapq.heappop(self.queue)
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                # Errors are sent to the client by the job, so this should never happen
+                print(traceback.format_exc())
+
+    def pending(self):
+        """
+        Number of jobs waiting in the queue for each priority
+        """
+        with self.condition:
+            queued = [job[0] for job in self.queue]
+        return {name: queued.count(value) for name, value in priorities.items()}
+
+_task_queue = None
+_task_queue_lock = threading.Lock()
+
+def get_task_queue():
+    """
+    Get the task queue for the current session process (the workers are started the first
+    time it is used)
+    """
+    global _task_queue
+    with _task_queue_lock:
+        if _task_queue is None:
+            _task_queue = PriorityExecutor()
+    return _task_queue
+
+class SessionPipe(object):
+    """
+    Thread safe stand-in for the pipe from the session process to the web application.
+
+    A ``multiprocessing`` pipe is not thread safe: two threads sending large messages at
+    the same time can interleave their writes and corrupt the pipe. Since the job loop in
+    Toyz (``toyz.web.app.job_process``) sends the result of each job from the main thread
+    without a lock, the workers cannot write to the pipe directly. Instead
+    :py:meth:`SessionPipe.send` adds a message to a queue and :py:meth:`SessionPipe.serve`,
+    which replaces the Toyz job loop on the main thread, is the only code that writes to
+    the pipe.
+
+    Parameters
+    ----------
+    pipe: `multiprocessing.Connection`
+        Pipe to the web application
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.messages = queue.Queue()
+        # Writing to this pipe wakes up the main thread when a message is queued
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        flags = fcntl.fcntl(self.wakeup_write, fcntl.F_GETFL)
+        fcntl.fcntl(self.wakeup_write, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def send(self, message):
+        """
+        Queue a message to be sent by the main thread (this can be called from any thread)
+        """
+        self.messages.put(message)
+        try:
+            os.write(self.wakeup_write, b'x')
+        except OSError as error:
+            # If the wakeup pipe is full the main thread is already going to wake up
+            if error.errno!=errno.EAGAIN:
+                raise
+
+    def flush(self):
+        """
+        Send all of the queued messages to the web application
+        """
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                return
+            self.pipe.send(message)
+
+    def serve(self):
+        """
+        Run jobs received from the web application and send their results and the queued
+        messages, until the web application closes the pipe. This is the same loop as
+        ``toyz.web.app.job_process``, except that it also wakes up to send the responses
+        of the workers.
+        """
+        while True:
+            readable = select.select([self.pipe, self.wakeup_read], [], [])[0]
+            if self.wakeup_read in readable:
+                os.read(self.wakeup_read, 4096)
+            self.flush()
+            if self.pipe not in readable:
+                continue
+            try:
+                msg = self.pipe.recv()
+            except EOFError:
+                break
+            result = toyz.utils.core.run_job(msg['toyz_settings'], self, msg['job'])
+            # Messages sent by the job are sent before its result
+            self.flush()
+            self.pipe.send(result)
+
+def start_session_pipe():
+    """
+    Replace the pipe of the current session with a :py:class:`SessionPipe`. Returns
+    ``True`` if the pipe was replaced, so the caller has to run
+    :py:meth:`SessionPipe.serve`, and ``False`` if the session already uses one.
+    """
+    if isinstance(session_vars.pipe, SessionPipe):
+        return False
+    session_vars.pipe = SessionPipe(session_vars.pipe)
+    return True
+
+def send_response(tid, response):
+    """
+    Send the response to a job to the client, using the same format as
+    ``toyz.utils.core.run_job``. The response is queued and sent by the main thread
+    (see :py:class:`SessionPipe`).
+    """
+    response['request_id'] = tid['request_id']
+    session_vars.pipe.send({
+        'id': tid,
+        'response': response
+    })
+
+class TaskStats(object):
+    """
+    Counters and timing for the jobs submitted for each task
+
+    Attributes
+    ----------
+    tasks: dict
+        For each task name the number of jobs ``submitted``, ``completed`` and ``dropped``
+        (because a newer request superseded them) and the total ``latency`` (time from
+        submission to the response) and ``run_time`` of the completed jobs (in seconds)
+    """
+    def __init__(self):
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def add(self, task_name, **counts):
+        """
+        Add ``counts`` to the counters for a task
+        """
+        with self.lock:
+            if task_name not in self.tasks:
+                self.tasks[task_name] = {'submitted': 0, 'completed': 0, 'dropped': 0,
+                    'latency': 0., 'run_time': 0.}
+            for key, value in counts.items():
+                self.tasks[task_name][key] += value
+
+    def get(self):
+        """
+        Get the counters for each task, including the mean latency and run time
+        """
+        with self.lock:
+            result = {}
+            for task_name, counts in self.tasks.items():
+                result[task_name] = dict(counts)
+                if counts['completed']>0:
+                    result[task_name]['mean_latency'] = counts['latency']/counts['completed']
+                    result[task_name]['mean_run_time'] = (
+                        counts['run_time']/counts['completed'])
+            return result
+
+task_stats = TaskStats()
+
+# Number of the most recent job submitted with each coalescing key
+latest_jobs = {}
+latest_jobs_lock = threading.Lock()
+job_counter = itertools.count()
+
+def is_superseded(key, job_number):
+    """
+    Whether or not a newer job has been submitted with the same coalescing ``key``
+    """
+    if key is None:
+        return False
+    with latest_jobs_lock:
+        return latest_jobs.get(key, job_number)!=job_number
+
+def run_job(task, toyz_settings, tid, params, key=None, job_number=None, submitted=None):
+    """
+    Run a task on a worker and send its response (or error) to the client.
+
+    If the job has a coalescing ``key`` and a newer job with the same key is submitted
+    before this job starts the job is dropped, and if the newer job is submitted while
+    this job is running its response is dropped.
+    """
+    task_name = task.__name__
+    if is_superseded(key, job_number):
+        task_stats.add(task_name, dropped=1)
+        return
+    start = time.time()
+    try:
+        response = task(toyz_settings, tid, params)
+    except ToyzJobError as error:
+        response = {
+            'id': 'ERROR',
+            'error': error.msg,
+            'traceback': traceback.format_exc()
+        }
+    except Exception as error:
+        response = {
+            'id': 'ERROR',
+            'error': 'PYTHON ERROR:'+type(error).__name__+str(error.args),
+            'traceback': traceback.format_exc()
+        }
+        print(traceback.format_exc())
+    if is_superseded(key, job_number) and response.get('id')!='ERROR':
+        task_stats.add(task_name, dropped=1)
+        return
+    if response!={}:
+        send_response(tid, response)
+    end = time.time()
+    task_stats.add(task_name, completed=1, run_time=end-start,
+        latency=end-(submitted if submitted is not None else start))
+
+def run_async(priority, coalesce=None):
+    """
+    Decorator for tasks that are run on the session task queue with a given ``priority``
+    (a key in ``priorities``). The task returns an empty response immediately (which the
+    client ignores) and its actual response is sent when the job finishes.
+
+    If ``async_tasks`` is ``False``, or the task is not called from a Toyz job process,
+    the task is run synchronously. The first asynchronous task in a session process
+    takes over the job loop of the process (see :py:class:`SessionPipe`), so that only
+    the main thread writes to the pipe, and it does not return until the session ends.
+
+    Parameters
+    ----------
+    priority: str
+        Priority of the task
+    coalesce: function, optional
+        Function that takes the task parameters and returns a key (or ``None``). Only the
+        most recent request with each key is answered, so for example a stream of hover
+        requests only runs for the latest mouse position (see :py:func:`run_job`).
+    """
+    def decorator(task):
+        @wraps(task)
+        def submit_task(toyz_settings, tid, params):
+            if not async_tasks or getattr(session_vars, 'pipe', None) is None:
+                return task(toyz_settings, tid, params)
+            key = None
+            job_number = next(job_counter)
+            if coalesce is not None:
+                key = coalesce(params)
+                if key is not None:
+                    key = (task.__name__, key)
+                    with latest_jobs_lock:
+                        latest_jobs[key] = job_number
+            task_stats.add(task.__name__, submitted=1)
+            serve = start_session_pipe()
+            get_task_queue().submit(priorities[priority], run_job, task,
+                toyz_settings, tid, params, key, job_number, time.time())
+            if serve:
+                session_vars.pipe.serve()
+                # The web application closed the session. Returning would make Toyz send
+                # a result to the closed pipe, so the session process exits here (the
+                # workers are daemon threads)
+                print('job_process finished')
+                sys.exit(0)
+            return {}
+        return submit_task
+    return decorator
@@ -10,6 +10,7 @@ from toyz.utils import core
 from toyz.utils.errors import ToyzJobError
 import astrotoyz as astro
 from toyz.web import session_vars
+from astrotoyz.task_queue import run_async
 
 def get_img_info(toyz_settings, tid, params):
     """
@@ -22,14 +23,129 @@ def get_img_info(toyz_settings, tid, params):
     }
     return response
 
+def get_display_stats(toyz_settings, tid, params):
+    """
+    Get the statistics used to scale an image for display (zscale limits, percentile
+    cuts and a histogram), which are cached after the first time they are calculated
+    """
+    core.check4keys(params, ['file_info'])
+    file_info = params['file_info']
+    hdulist = astro.viewer.get_file(file_info)
+    hdu = hdulist[int(file_info['frame'])]
+    response = {
+        'id': 'display_stats',
+        'stats': astro.display_stats.get_display_stats(
+            file_info['filepath'], file_info['frame'], hdu)
+    }
+    return response
+
+def _check_read_permission(toyz_settings, tid, path):
+    """
+    Raise an error if the user does not have permission to read from ``path``
+    """
+    from toyz.utils import file_access
+    if tid['user_id']!='admin':
+        permissions = file_access.get_parent_permissions(
+            toyz_settings.db, path, user_id=tid['user_id'])
+        if 'r' not in permissions:
+            raise ToyzJobError(
+                'You do not have permission to view the requested file.'
+                'Please contact your network administrator if you believe this is an error.')
+
+def get_header_index(toyz_settings, tid, params):
+    """
+    Get the indexed header keywords for each extension of a FITS file, or of every
+    FITS file in a directory. Files are only read if they are new or have been modified
+    since they were indexed.
+
+    Params
+        - path (*string* ): path to a FITS file or directory
+        - recursive (*bool*, optional): whether or not to include subdirectories
+    """
+    core.check4keys(params, ['path'])
+    path = params['path']
+    _check_read_permission(toyz_settings, tid, path)
+    recursive = params.get('recursive', False)
+    index = astro.header_index.get_header_index()
+    if os.path.isdir(path):
+        index.update_directory(path, recursive)
+        filepaths = sorted(set([filepath for filepath, hdu in index.query(path)]))
+        if not recursive:
+            filepaths = [filepath for filepath in filepaths
+                if os.path.dirname(filepath)==os.path.abspath(path)]
+        headers = {filepath: index.get_keywords(filepath, update=False)
+            for filepath in filepaths}
+    else:
+        headers = {os.path.abspath(path): index.get_keywords(path)}
+    response = {
+        'id': 'header_index',
+        'headers': headers
+    }
+    return response
+
+def query_headers(toyz_settings, tid, params):
+    """
+    Find the extensions of indexed FITS files whose header keywords match a set of values
+
+    Params
+        - conditions (*dict* ): keywords and their required values (for example
+          ``{'FILTER': 'r'}``)
+        - path (*string*, optional): only search files in this directory. If ``path``
+          is given the directory is indexed before it is searched.
+        - recursive (*bool*, optional): whether or not to index subdirectories of ``path``
+    """
+    core.check4keys(params, ['conditions'])
+    index = astro.header_index.get_header_index()
+    path = params.get('path', None)
+    if path is not None:
+        _check_read_permission(toyz_settings, tid, path)
+        index.update_directory(path, params.get('recursive', False))
+    elif tid['user_id']!='admin':
+        raise ToyzJobError('Only the admin can search the headers of all indexed files')
+    matches = index.query(path, **params['conditions'])
+    response = {
+        'id': 'query_headers',
+        'matches': [{'filepath': filepath, 'frame': hdu} for filepath, hdu in matches]
+    }
+    return response
+
+def _viewer_request_key(params):
+    """
+    Requests from a viewer that sends its ``viewer_id`` (for example hover datapoints)
+    are coalesced, so only the most recent request of each ``data_type`` is answered
+    """
+    if 'viewer_id' not in params:
+        return None
+    return (params['viewer_id'], params.get('data_type'))
+
+@run_async('interactive', coalesce=_viewer_request_key)
 def get_img_data(toyz_settings, tid, params):
     """
     Get data from an image or FITS file
     """
     core.check4keys(params, ['data_type', 'file_info', 'img_info'])
+    params = dict(params)
+    params.pop('viewer_id', None)
     response = astro.viewer.get_img_data(**params)
     return response
 
+def get_img_tile(toyz_settings, tid, params):
+    """
+    Load a tile from a larger image and notify the client it has been created. Tiles
+    from large, zoomed out FITS images are created from the image pyramid.
+    """
+    core.check4keys(params, ['img_info', 'file_info', 'tile_info'])
+    _check_read_permission(toyz_settings, tid, params['file_info']['filepath'])
+    created, tile_info = astro.viewer.create_tile(
+        params['file_info'], params['img_info'], params['tile_info'])
+    response = {
+        'id': 'tile created',
+        'success': created,
+        'tile_info': tile_info
+    }
+    return response
+
+@run_async('normal')
 def get_2d_fit(toyz_settings, tid, params):
     """
     Get desired fit for 2d data array
@@ -44,18 +160,19 @@ def create_catalog(toyz_settings, tid, params):
     Save a catalog
     """
     core.check4keys(params, ['settings', 'cid'])
-    catalog = astro.catalog.get_catalog(create='yes', **params)
-    # Store the catalog in the session for future use
-    session_vars.catalogs[catalog.cid] = catalog
-    # Translate the dataframe to a format that can be JSON encoded
-    # (this includes translating NaN values to strings that will be
-    # translated back to NaN in the client)
-    index = list(catalog.index.names)
-    dataframe = {
-        'columns': index+catalog.columns.values.tolist(),
-        'index': index,
-        'data': catalog.astype(object).fillna('NaN').values.tolist()
-    }
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(create='yes', **params)
+        # Store the catalog in the session for future use
+        astro.catalog.get_session_catalogs()[catalog.cid] = catalog
+        # Translate the dataframe to a format that can be JSON encoded
+        # (this includes translating NaN values to strings that will be
+        # translated back to NaN in the client)
+        index = list(catalog.index.names)
+        dataframe = {
+            'columns': index+catalog.columns.values.tolist(),
+            'index': index,
+            'data': catalog.astype(object).fillna('NaN').values.tolist()
+        }
     cat_info = {
         'cid': catalog.cid,
         'name': catalog.name,
@@ -68,16 +185,36 @@ def create_catalog(toyz_settings, tid, params):
     }
     return response
 
+@run_async('normal')
+def query_region(toyz_settings, tid, params):
+    """
+    Load the sources in a region of a saved catalog
+    """
+    core.check4keys(params, ['file_info', 'region'])
+    catalog = astro.catalog.query_region(params['file_info'], **params['region'])
+    dataframe = {
+        'columns': catalog.columns.values.tolist(),
+        'data': catalog.astype(object).fillna('NaN').values.tolist()
+    }
+    response = {
+        'id': 'query_region',
+        'cid': catalog.cid,
+        'dataframe': dataframe
+    }
+    return response
+
+@run_async('background')
 def save_catalog(toyz_settings, tid, params):
     """
     Save a catalog
     """
     core.check4keys(params, ['cid'])
-    catalog = astro.catalog.get_catalog(params['cid'], create='fail')
-    if 'filepath' in params:
-        catalog.save(params['filepath'])
-    else:
-        catalog.save()
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+        if 'filepath' in params:
+            catalog.save(params['filepath'])
+        else:
+            catalog.save()
     response = {
         'id': 'save_catalog',
         'status': 'success'
@@ -89,8 +226,9 @@ def select_src(toyz_settings, tid, params):
     Get the nearest source to a given point
     """
     core.check4keys(params, ['cid'])
-    catalog = astro.catalog.get_catalog(params['cid'], create='fail')
-    src = catalog.select_src(**params)
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+        src = catalog.select_src(**params)
     if len(src)>0:
         status = 'success'
     else:
@@ -107,9 +245,10 @@ def add_src(toyz_settings, tid, params):
     Add a source to the catalog
     """
     core.check4keys(params, ['cid', 'file_info', 'src_info'])
-    catalog = astro.catalog.get_catalog(params['cid'], create='fail')
-    del params['cid']
-    src = catalog.add_src(**params)
+    cid = params.pop('cid')
+    with astro.catalog.get_catalog_lock(cid):
+        catalog = astro.catalog.get_catalog(cid, create='fail')
+        src = catalog.add_src(**params)
     response = {
         'id': 'add_src',
         'src': src
@@ -127,8 +266,9 @@ def delete_src(toyz_settings, tid, params):
     Delete a source from the catalog
     """
     core.check4keys(params, ['cid', 'src_info'])
-    catalog = astro.catalog.get_catalog(params['cid'], create='fail')
-    status = catalog.delete_src(params['src_info'])
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+        status = catalog.delete_src(params['src_info'])
     response = {'id': 'delete_src'}
     if status is True:
         response['status'] = 'success'
@@ -136,6 +276,63 @@ def delete_src(toyz_settings, tid, params):
         response['status'] = 'failed'
     return response
 
+def _catalog_step_response(task, catalog, step):
+    """
+    Response for a task that changed the sources in a catalog (log entries are
+    converted to JSON compatible types)
+    """
+    import json
+    return {
+        'id': task,
+        'status': 'success' if len(step)>0 else 'failed: no changes',
+        'changes': json.loads(astro.catalog.encode_log_entry(step)),
+        'version': catalog.settings.get('version', 0)
+    }
+
+def undo_catalog(toyz_settings, tid, params):
+    """
+    Undo the last edit to a catalog
+    """
+    core.check4keys(params, ['cid'])
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+        return _catalog_step_response('undo_catalog', catalog, catalog.undo())
+
+def redo_catalog(toyz_settings, tid, params):
+    """
+    Redo the last edit to a catalog that was undone
+    """
+    core.check4keys(params, ['cid'])
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+        return _catalog_step_response('redo_catalog', catalog, catalog.redo())
+
+def get_catalog_versions(toyz_settings, tid, params):
+    """
+    Get the saved versions of a catalog
+    """
+    core.check4keys(params, ['cid'])
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+        versions = catalog.get_versions()
+    response = {
+        'id': 'get_catalog_versions',
+        'versions': versions
+    }
+    return response
+
+@run_async('normal')
+def restore_catalog(toyz_settings, tid, params):
+    """
+    Restore the sources in a catalog to a saved version
+    """
+    core.check4keys(params, ['cid', 'version'])
+    with astro.catalog.get_catalog_lock(params['cid']):
+        catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+        step = catalog.restore(int(params['version']))
+        return _catalog_step_response('restore_catalog', catalog, step)
+
+@run_async('background')
 def detect_sources(toyz_settings, tid, params):
     """
     Detect sources and create an object catalog in the current session
@@ -153,32 +350,115 @@ def detect_sources(toyz_settings, tid, params):
     print('response', response)
     return response
 
+def get_seeing_map(toyz_settings, tid, params):
+    """
+    Get the map of the seeing and PSF shape created when sources were detected for a catalog
+    """
+    core.check4keys(params, ['cid'])
+    catalog = astro.catalog.get_catalog(params['cid'], create='fail')
+    if 'seeing_map' not in catalog.settings:
+        raise astro.core.AstroToyzError(
+            'No seeing map available for catalog '+str(params['cid']))
+    response = {
+        'id': 'get_seeing_map',
+        'cid': params['cid'],
+        'seeing_map': catalog.settings['seeing_map']
+    }
+    return response
+
+@run_async('interactive')
 def wcs2px(toyz_Settings, tid, params):
     """
     Align all images in the viewer with the world coordinates of the current image
     """
-    import toyz.web
-    from astrotoyz.viewer import get_wcs
-    import numpy as np
-    print('filepath:', params['file_info']['filepath'],'\n\n')
     core.check4keys(params, ['file_info', 'img_info', 'ra', 'dec'])
-    hdulist = toyz.web.viewer.get_file(params['file_info'])
-    wcs = get_wcs(params['file_info'], hdulist)
-    if wcs is None:
-        raise astrotoyz.core.AstroToyzError('Unable to load WCS for the current image')
-    data = hdulist[int(params['file_info']['frame'])].data
-    ra = params['ra']
-    dec = params['dec']
-    wcs_array = wcs.wcs_world2pix(np.array([[ra, dec]]), 1)
+    hdulist = astro.viewer.get_file(params['file_info'])
+    pixels = astro.viewer.world2pix(params['file_info'], hdulist, [params['ra']],
+        [params['dec']])
+    if pixels is None:
+        raise astro.core.AstroToyzError('Unable to load WCS for the current image')
     response = {
         'id': 'wcs2px',
-        'x': int(round(wcs_array[0][0])),
-        'y': int(round(wcs_array[0][1])),
-        # next two lines for testing
-        'ra': ra,
-        'dec': dec
+        'x': int(round(pixels[0][0])),
+        'y': int(round(pixels[1][0]))
+    }
+    return response
+
+def _coord_list(coords):
+    """
+    Convert an array of coordinates to a list that can be sent to the client
+    (NaN values are sent as 'NaN')
+    """
+    import numpy as np
+    coords = np.asarray(coords, dtype=float)
+    return np.where(np.isfinite(coords), coords.astype(object), 'NaN').tolist()
+
+@run_async('interactive')
+def px2wcs_batch(toyz_settings, tid, params):
+    """
+    Convert a list of pixel coordinates in an image to world coordinates in a
+    single vectorized transformation
+    """
+    core.check4keys(params, ['file_info', 'x', 'y'])
+    if len(params['x'])!=len(params['y']):
+        raise astro.core.AstroToyzError("'x' and 'y' must have the same length")
+    hdulist = astro.viewer.get_file(params['file_info'])
+    world = astro.viewer.pix2world(params['file_info'], hdulist, params['x'], params['y'],
+        params.get('origin', 1), params.get('tolerance', None))
+    if world is None:
+        raise astro.core.AstroToyzError('Unable to load WCS for the current image')
+    response = {
+        'id': 'px2wcs_batch',
+        'ra': _coord_list(world[0]),
+        'dec': _coord_list(world[1])
+    }
+    return response
+
+@run_async('interactive')
+def wcs2px_batch(toyz_settings, tid, params):
+    """
+    Convert a list of world coordinates to pixel coordinates in an image in a
+    single vectorized transformation
+    """
+    core.check4keys(params, ['file_info', 'ra', 'dec'])
+    if len(params['ra'])!=len(params['dec']):
+        raise astro.core.AstroToyzError("'ra' and 'dec' must have the same length")
+    hdulist = astro.viewer.get_file(params['file_info'])
+    pixels = astro.viewer.world2pix(params['file_info'], hdulist, params['ra'], params['dec'],
+        params.get('origin', 1), params.get('tolerance', None))
+    if pixels is None:
+        raise astro.core.AstroToyzError('Unable to load WCS for the current image')
+    response = {
+        'id': 'wcs2px_batch',
+        'x': _coord_list(pixels[0]),
+        'y': _coord_list(pixels[1])
+    }
+    return response
+
+def get_cache_stats(toyz_settings, tid, params):
+    """
+    Get the hit/miss counters and size of the caches shared by the Astro-Toyz tasks
+    """
+    response = {
+        'id': 'cache_stats',
+        'wcs': astro.viewer.wcs_cache.stats(),
+        'wcs_grid': astro.viewer.wcs_grid_cache.stats(),
+        'fits': astro.viewer.fits_cache.stats(),
+        'display_stats': astro.display_stats.stats_cache.stats(),
+        'fit': astro.viewer.fit_cache.stats()
+    }
+    return response
+
+def get_task_stats(toyz_settings, tid, params):
+    """
+    Get the number of jobs submitted, completed and dropped (superseded by a newer
+    request) and their mean latency and run time for each task run on the task queue
+    """
+    response = {
+        'id': 'task_stats',
+        'tasks': astro.task_queue.task_stats.get(),
+        'pending': astro.task_queue.get_task_queue().pending()
     }
-    print('px coords response', response)
     return response
 
 def load_sextractor(toyz_settings, tid, params):
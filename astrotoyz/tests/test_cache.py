@@ -0,0 +1,135 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import numpy as np
+import astropy.io.fits as pyfits
+
+from astrotoyz import cache, viewer
+
+def make_fits(filepath, crval1=10.):
+    header = pyfits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = crval1
+    header['CRVAL2'] = 20.
+    header['CRPIX1'] = 50.
+    header['CRPIX2'] = 50.
+    header['CD1_1'] = -1e-4
+    header['CD2_2'] = 1e-4
+    pyfits.PrimaryHDU(np.zeros((100,100), dtype=np.float32), header).writeto(
+        filepath, overwrite=True)
+
+def test_lru_eviction():
+    lru = cache.LRUCache(maxsize=3)
+    for n in range(3):
+        lru.set(n, str(n))
+    # Using 0 makes 1 the least recently used entry
+    assert lru.get(0)=='0'
+    lru.set(3, '3')
+    assert 1 not in lru
+    assert sorted(lru.entries.keys())==[0, 2, 3]
+    assert lru.get(1, 'missing')=='missing'
+    # Replacing an entry does not evict anything
+    lru.set(2, 'two')
+    assert len(lru)==3 and lru.get(2)=='two'
+    assert lru.stats()=={'hits': 2, 'misses': 1, 'size': 3, 'maxsize': 3}
+
+def test_get_or_create_caches_none():
+    lru = cache.LRUCache()
+    calls = []
+    def create():
+        calls.append(1)
+        return None
+    assert lru.get_or_create('bad', create) is None
+    assert lru.get_or_create('bad', create) is None
+    assert len(calls)==1
+
+def test_file_key_mtime(tmpdir):
+    filepath = str(tmpdir.join('img.fits'))
+    make_fits(filepath)
+    file_info = {'filepath': filepath, 'frame': '0'}
+    key = cache.get_file_key(file_info)
+    assert key==(filepath, os.path.getmtime(filepath), 0)
+    os.utime(filepath, (0, key[1]+10))
+    assert cache.get_file_key(file_info)!=key
+    assert cache.get_file_key({'filepath': str(tmpdir.join('missing')), 'frame': 1},
+        'x')[1:]==(None, 1, 'x')
+
+def test_get_wcs_invalidated_by_mtime(tmpdir, monkeypatch):
+    monkeypatch.setattr(viewer, 'wcs_cache', cache.LRUCache(maxsize=2))
+    filepath = str(tmpdir.join('img.fits'))
+    make_fits(filepath, 10.)
+    file_info = {'filepath': filepath, 'frame': 0}
+    hdulist = pyfits.open(filepath)
+    wcs = viewer.get_wcs(file_info, hdulist)
+    assert viewer.get_wcs(file_info, hdulist) is wcs
+    assert wcs.wcs.crval[0]==10.
+    hdulist.close()
+
+    # Rewrite the file with a different WCS
+    mtime = os.path.getmtime(filepath)
+    make_fits(filepath, 30.)
+    os.utime(filepath, (mtime+10, mtime+10))
+    hdulist = pyfits.open(filepath)
+    assert viewer.get_wcs(file_info, hdulist).wcs.crval[0]==30.
+    hdulist.close()
+    assert viewer.wcs_cache.stats()['misses']==2
+
+def test_get_wcs_invalid_header(tmpdir, monkeypatch):
+    monkeypatch.setattr(viewer, 'wcs_cache', cache.LRUCache())
+    monkeypatch.setattr(viewer, 'load_wcs', lambda header: None)
+    filepath = str(tmpdir.join('img.fits'))
+    make_fits(filepath)
+    hdulist = pyfits.open(filepath)
+    assert viewer.get_wcs({'filepath': filepath, 'frame': 0}, hdulist) is None
+    assert viewer.get_wcs({'filepath': filepath, 'frame': 0}, hdulist) is None
+    assert viewer.wcs_cache.stats()['hits']==1
+    hdulist.close()
+
+class FakeFile(object):
+    def __init__(self, filepath, size):
+        self.filepath = filepath
+        self.size = size
+        self.closed = False
+
+def make_file_cache(tmpdir, sizes, **kwargs):
+    filepaths = []
+    for n in range(len(sizes)):
+        filepath = str(tmpdir.join('{0}.fits'.format(n)))
+        open(filepath, 'w').close()
+        filepaths.append(filepath)
+    def open_file(filepath):
+        return FakeFile(filepath, sizes[filepaths.index(filepath)])
+    def close_file(f):
+        f.closed = True
+    file_cache = cache.FileCache(open_file, lambda f: f.size, close_file, **kwargs)
+    return file_cache, filepaths
+
+def test_file_cache_max_files(tmpdir):
+    file_cache, filepaths = make_file_cache(tmpdir, [0]*4, max_files=2)
+    files = [file_cache.get(filepath)[1] for filepath in filepaths[:2]]
+    assert file_cache.get(filepaths[0])[1] is files[0]
+    file_cache.get(filepaths[2])
+    # filepaths[1] was the least recently used file
+    assert files[1].closed and not files[0].closed
+    assert file_cache.stats()['evictions']==1
+    assert file_cache.stats()['size']==2
+
+def test_file_cache_memory(tmpdir):
+    file_cache, filepaths = make_file_cache(tmpdir, [60, 60, 200], max_memory=100)
+    f0 = file_cache.get(filepaths[0])[1]
+    f1 = file_cache.get(filepaths[1])[1]
+    assert f0.closed and not f1.closed
+    # The current file is never closed, even if it is over the budget
+    f2 = file_cache.get(filepaths[2])[1]
+    assert f1.closed and not f2.closed
+    assert file_cache.memory()==200
+
+def test_file_cache_mtime(tmpdir):
+    file_cache, filepaths = make_file_cache(tmpdir, [0])
+    key, f0 = file_cache.get(filepaths[0])
+    os.utime(filepaths[0], (0, key[1]+10))
+    key, f1 = file_cache.get(filepaths[0])
+    assert f1 is not f0 and f0.closed
+    assert file_cache.stats()['misses']==2
@@ -0,0 +1,402 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import json
+import threading
+import numpy as np
+import pytest
+
+from toyz.web import session_vars
+import astrotoyz.core
+from astrotoyz import catalog, tasks
+
+class Stop(Exception):
+    pass
+
+@pytest.fixture
+def enlarge(monkeypatch):
+    """
+    Newer versions of pandas create a new frame with ``cls(data)`` when rows are added
+    with ``loc``, which the Catalog constructor does not support, so these frames are
+    created as DataFrames
+    """
+    import pandas
+    monkeypatch.setattr(catalog.Catalog, '_from_axes', classmethod(
+        lambda cls, data, axes, **kwargs: pandas.DataFrame._from_axes.im_func(
+            pandas.DataFrame, data, axes, **kwargs)))
+
+def test_detect_sources_keeps_previous_catalog(monkeypatch):
+    import astrotoyz.detect_sources
+    import astrotoyz.viewer
+    class HDU(object):
+        data = np.zeros((10, 10))
+    previous = object()
+    def find_stars(**settings):
+        # Other tasks can still use the previous catalog during the detection
+        assert catalog.get_session_catalogs()['cat'] is previous
+        raise Stop()
+    monkeypatch.setattr(astrotoyz.viewer, 'get_file', lambda file_info: [HDU()])
+    monkeypatch.setattr(astrotoyz.detect_sources, 'find_stars', find_stars)
+    monkeypatch.setattr(session_vars, 'catalogs', {'cat': previous}, raising=False)
+    with pytest.raises(Stop):
+        catalog.detect_sources({'frame': 0}, 'cat', {'seeing_map': None})
+    assert session_vars.catalogs['cat'] is previous
+
+def test_catalog_tasks_hold_lock(monkeypatch):
+    """
+    A catalog edit on the main thread waits for a save running on a worker
+    """
+    events = []
+    saving = threading.Event()
+    finish_save = threading.Event()
+    class FakeCatalog(object):
+        settings = {}
+        def save(self):
+            saving.set()
+            finish_save.wait()
+            events.append('saved')
+        def delete_src(self, src_info):
+            events.append('deleted')
+            return True
+    monkeypatch.setattr(session_vars, 'catalogs', {'cat': FakeCatalog()}, raising=False)
+    monkeypatch.setattr(session_vars, 'pipe', None, raising=False)
+    assert catalog.get_catalog_lock('cat') is catalog.get_catalog_lock('cat')
+    save = threading.Thread(target=tasks.save_catalog, args=(None, {}, {'cid': 'cat'}))
+    save.start()
+    saving.wait()
+    delete = threading.Thread(target=tasks.delete_src,
+        args=(None, {}, {'cid': 'cat', 'src_info': {}}))
+    delete.start()
+    delete.join(.2)
+    assert events==[]
+    finish_save.set()
+    save.join()
+    delete.join()
+    assert events==['saved', 'deleted']
+
+def make_catalog(cid, num_sources, seed, size=100., **columns):
+    rand = np.random.RandomState(seed)
+    data = {
+        'id': ['{0}{1}'.format(cid, n) for n in range(num_sources)],
+        'x': rand.uniform(0, size, num_sources),
+        'y': rand.uniform(0, size, num_sources),
+        'ra': rand.uniform(-.05, .05, num_sources)%360,
+        'dec': rand.uniform(-.05, .05, num_sources)
+    }
+    data.update(columns)
+    return catalog.Catalog(cid, file_info={}, data=data)
+
+def separations(cat1, cat2, coord_type):
+    """
+    Brute force separations (in pixels or arcseconds) between every pair of sources
+    """
+    if coord_type=='px':
+        return np.hypot(cat1['x'].values[:,None]-cat2['x'].values[None,:],
+            cat1['y'].values[:,None]-cat2['y'].values[None,:])
+    from astropy.coordinates import SkyCoord
+    coords1 = SkyCoord(cat1['ra'].values, cat1['dec'].values, unit='deg')
+    coords2 = SkyCoord(cat2['ra'].values, cat2['dec'].values, unit='deg')
+    return np.array([coords1[n].separation(coords2).arcsec for n in range(len(cat1))])
+
+@pytest.mark.parametrize('coord_type, radius', [('px', 2.), ('wcs', 10.)])
+def test_crossmatch(coord_type, radius):
+    cat1 = make_catalog('a', 300, 11)
+    cat2 = make_catalog('b', 400, 12)
+    result = cat1.crossmatch(cat2, radius, coord_type=coord_type, all_pairs=True,
+        chunk_size=64)
+    sep = separations(cat1, cat2, coord_type)
+    nearest = np.argmin(sep, axis=1)
+    matched = sep[np.arange(len(cat1)), nearest]<=radius
+    assert np.any(matched) and not np.all(matched)
+    np.testing.assert_array_equal(result['idx'], np.where(matched, nearest, -1))
+    np.testing.assert_allclose(result['sep'][matched], sep[matched, nearest[matched]],
+        rtol=1e-6)
+    assert np.all(np.isinf(result['sep'][~matched]))
+    idx1, idx2 = np.where(sep<=radius)
+    pairs = result['pairs']
+    assert sorted(zip(pairs['idx1'], pairs['idx2']))==sorted(zip(idx1, idx2))
+    np.testing.assert_allclose(pairs['sep'], sep[pairs['idx1'], pairs['idx2']], rtol=1e-6)
+
+def test_deduplicate(enlarge):
+    rand = np.random.RandomState(13)
+    cat = make_catalog('c', 400, 14, amplitude=rand.uniform(0, 1, 400))
+    # Sources split into several detections, including chains of friends
+    x = cat['x'].values.copy()
+    y = cat['y'].values.copy()
+    amplitude = cat['amplitude'].values.copy()
+    min_sep = 3.
+    sep = separations(cat, cat, 'px')
+    # Brute force friends-of-friends groups
+    labels = np.arange(len(cat))
+    changed = True
+    while changed:
+        changed = False
+        for i, j in zip(*np.where(sep<min_sep)):
+            if labels[i]!=labels[j]:
+                labels[labels==max(labels[i], labels[j])] = min(labels[i], labels[j])
+                changed = True
+    expected = set()
+    for label in np.unique(labels):
+        members = np.where(labels==label)[0]
+        expected.add(cat.index[members[np.argmax(amplitude[members])]])
+    assert len(expected)<len(cat)
+    removed = cat.deduplicate(min_sep, coord_type='px')
+    assert removed==400-len(expected)
+    assert set(cat.index)==expected
+    # The removed sources can be restored
+    cat.undo()
+    assert len(cat)==400
+
+def save_catalog(cat, tmpdir):
+    """
+    Save a catalog to an SQLite file and return the file info used to load it
+    """
+    connect_str = 'sqlite:///'+str(tmpdir.join('catalogs.db'))
+    cat.save(connect_str)
+    return {'filepath': connect_str, 'file_settings': {'table': cat.cid}}
+
+@pytest.mark.parametrize('ra_min, ra_max', [(0., 360.), (359.98, .01), (.01, .04)])
+def test_query_box(tmpdir, ra_min, ra_max):
+    from astrotoyz.sky_cells import ra_width
+    cat = make_catalog('box', 1000, 23)
+    file_info = save_catalog(cat, tmpdir)
+    result = catalog.query_box(file_info, ra_min, ra_max, -.03, .02)
+    inside = (((cat['ra']-ra_min)%360<=ra_width(ra_min, ra_max)) &
+        (cat['dec']>=-.03) & (cat['dec']<=.02))
+    assert 0<np.sum(inside)
+    assert sorted(result.index)==sorted(cat.index[inside])
+    if ra_max-ra_min==360:
+        # A full circle in ra only cuts in dec
+        assert len(result)==np.sum((cat['dec']>=-.03) & (cat['dec']<=.02))
+
+@pytest.mark.parametrize('region', [
+    {'xmin': 20., 'xmax': 45., 'ymin': 60., 'ymax': 90.},
+    {'ra_min': 359.98, 'ra_max': .01, 'dec_min': -.02, 'dec_max': .03},
+    {'ra_min': .01, 'ra_max': .04, 'dec_min': -.05, 'dec_max': 0.},
+    {'ra': 359.99, 'dec': .01, 'radius': .02},
+    {'ra_min': 0., 'ra_max': 360., 'dec_min': -90., 'dec_max': .03},
+    {'ra_min': -180., 'ra_max': 180., 'dec_min': -.01, 'dec_max': 90.},
+])
+def test_query_region(tmpdir, region):
+    from astrotoyz.sky_cells import angular_separation, ra_width
+    cat = make_catalog('region', 2000, 15)
+    file_info = save_catalog(cat, tmpdir)
+    assert sorted(cat.settings['rtree'])==['px', 'wcs']
+    result = catalog.query_region(file_info, **region)
+    if 'xmin' in region:
+        inside = ((cat['x']>=region['xmin']) & (cat['x']<=region['xmax']) &
+            (cat['y']>=region['ymin']) & (cat['y']<=region['ymax']))
+    elif 'radius' in region:
+        inside = angular_separation(cat['ra'].values, cat['dec'].values,
+            region['ra'], region['dec'])<=region['radius']
+    else:
+        width = ra_width(region['ra_min'], region['ra_max'])
+        inside = (((cat['ra']-region['ra_min'])%360<=width) &
+            (cat['dec']>=region['dec_min']) & (cat['dec']<=region['dec_max']))
+    expected = cat[inside]
+    assert 0<len(expected)<len(cat)
+    assert sorted(result.index)==sorted(expected.index)
+    np.testing.assert_allclose(result.loc[expected.index, 'x'], expected['x'])
+
+def test_query_region_sky_cells(tmpdir):
+    """
+    Catalogs without an R*-tree are queried with their sky cells
+    """
+    cat = make_catalog('cells', 1000, 16)
+    file_info = save_catalog(cat, tmpdir)
+    meta = catalog.load_catalog_meta(file_info['filepath'], 'cells')
+    settings = json.loads(meta.settings)
+    settings['rtree'] = []
+    catalog.get_database(file_info['filepath']).engine.execute(
+        'UPDATE catalog_meta SET settings=? WHERE cid=?', json.dumps(settings), 'cells')
+    result = catalog.query_region(file_info, ra=0., dec=0., radius=.03)
+    expected = catalog.query_cone(file_info, 0., 0., .03)
+    assert 0<len(result)<len(cat)
+    assert sorted(result.index)==sorted(expected.index)
+    with pytest.raises(astrotoyz.core.AstroToyzError):
+        catalog.query_region(file_info, xmin=0, xmax=10, ymin=0, ymax=10)
+
+def test_incremental_save(tmpdir, monkeypatch, enlarge):
+    cat = make_catalog('inc', 200, 17)
+    file_info = save_catalog(cat, tmpdir)
+    updates = []
+    update_table = catalog.update_table
+    def record_update(engine, cid, id_name, deleted, inserted, *args):
+        updates.append((sorted(deleted), sorted(inserted.index)))
+        update_table(engine, cid, id_name, deleted, inserted, *args)
+    monkeypatch.setattr(catalog, 'update_table', record_update)
+    # Add, delete, modify and replace sources
+    for n in range(2):
+        cat.insert_src({'id': 'new{0}'.format(n), 'x': 150.+n, 'y': 150., 'ra': .1,
+            'dec': .1})
+    for src_id in ['inc1', 'inc2', 'inc3']:
+        assert cat.delete_src({'id': src_id})
+    cat.loc[['inc4', 'inc5'], 'x'] += 1000
+    cat.record_changes(modified=['inc4', 'inc5'])
+    row = cat.remove_src(['inc6'])[0]
+    row['y'] = -1.
+    cat.insert_src(row)
+    cat.save()
+    assert updates==[(['inc1', 'inc2', 'inc3', 'inc4', 'inc5', 'inc6'],
+        ['inc4', 'inc5', 'inc6', 'new0', 'new1'])]
+    
+    loaded = catalog.load_catalog(file_info)
+    assert sorted(loaded.index)==sorted(cat.index)
+    for col in ['x', 'y', 'ra', 'dec']:
+        np.testing.assert_allclose(loaded.loc[cat.index, col], cat[col])
+    # The R*-trees and sky cells are updated with the table
+    new = catalog.query_region(file_info, xmin=149, xmax=152, ymin=149, ymax=151)
+    assert sorted(new.index)==['new0', 'new1']
+    moved = catalog.query_region(file_info, xmin=1000, xmax=1100, ymin=0, ymax=100)
+    assert sorted(moved.index)==['inc4', 'inc5']
+    cone = catalog.query_cone(file_info, .1, .1, .001)
+    assert sorted(cone.index)==['new0', 'new1']
+    
+    # Changing the columns replaces the table
+    cat['flux'] = 1.
+    cat.save()
+    assert len(updates)==1
+    assert 'flux' in catalog.load_catalog(file_info).columns
+
+def test_get_database(tmpdir):
+    connect_str = 'sqlite:///'+str(tmpdir.join('shared.db'))
+    database = catalog.get_database(connect_str)
+    assert catalog.get_database(connect_str) is database
+    assert catalog.get_database('sqlite:///'+str(tmpdir.join('other.db'))) is not database
+    # File databases keep a pool of connections that can be used by any thread
+    from sqlalchemy.pool import QueuePool
+    assert isinstance(database.engine.pool, QueuePool)
+    connections = []
+    def connect():
+        connections.append(database.engine.execute('SELECT 1').scalar())
+    thread = threading.Thread(target=connect)
+    thread.start()
+    thread.join()
+    assert connections==[1]
+    
+    assert not database.has_table('catalog_meta')
+    database.create_tables()
+    assert database.has_table('catalog_meta')
+    assert database.has_table('catalog_logs')
+    # Tables created outside of the database object are only found after ``invalidate``
+    cat = make_catalog('shared', 10, 18)
+    cat.to_sql('shared', database.engine)
+    assert not database.has_table('shared')
+    database.invalidate()
+    assert database.has_table('shared')
+    # Saving a catalog updates the list of tables
+    cat = make_catalog('saved', 10, 19)
+    cat.save(connect_str)
+    assert database.has_table('saved')
+
+def test_read_write_log(tmpdir, monkeypatch):
+    connect_str = 'sqlite:///'+str(tmpdir.join('log.db'))
+    monkeypatch.setattr(catalog, 'log_batch_size', 3)
+    entries = [{'action': 'add_src', 'log': {'id': n, 'x': np.float64(n), 'xy': np.arange(2)},
+        'time': 100.+n} for n in range(10)]
+    catalog.write_log(connect_str, 'log', entries[:7])
+    catalog.write_log(connect_str, 'log', entries[7:])
+    catalog.write_log(connect_str, 'other', entries[:2])
+    log = catalog.read_log(connect_str, 'log')
+    assert [entry['log']['id'] for entry in log]==list(range(10))
+    assert log[3]=={'action': 'add_src', 'log': {'id': 3, 'x': 3., 'xy': [0, 1]},
+        'time': 103.}
+    log = catalog.read_log(connect_str, 'log', start=102, end=105)
+    assert [entry['time'] for entry in log]==[102., 103., 104.]
+    assert len(catalog.read_log(connect_str, 'log', start=108))==2
+    assert len(catalog.read_log(connect_str, 'log', end=101.5))==2
+    assert len(catalog.read_log(connect_str, 'other'))==2
+
+def test_catalog_log(tmpdir, monkeypatch, enlarge):
+    import itertools
+    class Clock(object):
+        # Entries made one second apart
+        time = itertools.count(1000.).next
+    monkeypatch.setattr(catalog, 'time', Clock)
+    cat = make_catalog('logged', 10, 20)
+    cat.insert_src({'id': 'new', 'x': 1., 'y': 1., 'ra': 0., 'dec': 0.})
+    cat.log('add_src', {'id': 'new'})
+    cat.delete_src({'id': 'logged0'})
+    new_log = list(cat.new_log)
+    assert [entry['action'] for entry in cat.get_log()]==['add_src', 'delete_src']
+    file_info = save_catalog(cat, tmpdir)
+    assert cat.new_log==[]
+    assert cat.get_log()==new_log
+    cat.delete_src({'id': 'logged1'})
+    log = cat.get_log()
+    assert len(log)==3
+    assert len(cat.get_log(include_new=False))==2
+    assert cat.get_log(start=log[1]['time'])==log[1:]
+    assert cat.get_log(end=log[1]['time'])==log[:1]
+    assert catalog.load_catalog(file_info, load_log=True).saved_log==new_log
+
+def get_rows(cat):
+    return {src_id: tuple(row) for src_id, row in zip(cat.index, cat[['x', 'y']].values)}
+
+def add_src(cat, src_id, x, y):
+    """
+    Add a source the same way as ``Catalog.add_src``, without fitting it
+    """
+    src_info = {'id': src_id, 'x': x, 'y': y, 'ra': 0., 'dec': 0.}
+    cat.insert_src(src_info)
+    cat.push_undo([cat.log('add_src', src_info)])
+
+def test_undo_redo(enlarge):
+    cat = make_catalog('undo', 20, 21)
+    original = get_rows(cat)
+    assert cat.undo()==[] and cat.redo()==[]
+    add_src(cat, 'new', 1., 2.)
+    cat.delete_src({'id': 'undo3'})
+    edited = get_rows(cat)
+    assert 'new' in edited and 'undo3' not in edited
+    assert [entry['action'] for entry in cat.undo()]==['add_src']
+    assert [entry['action'] for entry in cat.undo()]==['delete_src']
+    assert get_rows(cat)==original
+    cat.redo()
+    cat.redo()
+    assert get_rows(cat)==edited
+    assert cat.redo()==[]
+    # A new edit clears the steps that can be redone
+    cat.undo()
+    cat.delete_src({'id': 'undo4'})
+    assert cat.redo()==[]
+    # Every change is logged
+    assert [entry['action'] for entry in cat.new_log]==['add_src', 'delete_src']*4
+
+def test_restore(tmpdir, enlarge):
+    cat = make_catalog('restore', 20, 22)
+    assert cat.get_versions()==[]
+    with pytest.raises(astrotoyz.core.AstroToyzError):
+        cat.restore(1)
+    file_info = save_catalog(cat, tmpdir)
+    version1 = get_rows(cat)
+    add_src(cat, 'new1', 1., 2.)
+    cat.delete_src({'id': 'restore1'})
+    cat.save()
+    version2 = get_rows(cat)
+    # Unsaved edits, including a source deleted and added again
+    add_src(cat, 'new2', 3., 4.)
+    cat.delete_src({'id': 'restore2'})
+    cat.delete_src({'id': 'new1'})
+    cat.delete_src({'id': 'restore5'})
+    cat.undo()
+    edited = get_rows(cat)
+    versions = cat.get_versions()
+    assert [(v['version'], v['length']) for v in versions]==[(1, 20), (2, 20)]
+    with pytest.raises(astrotoyz.core.AstroToyzError):
+        cat.restore(3)
+    
+    cat.restore(1)
+    assert get_rows(cat)==version1
+    cat.undo()
+    assert get_rows(cat)==edited
+    cat.redo()
+    assert get_rows(cat)==version1
+    cat.restore(2)
+    assert get_rows(cat)==version2
+    # The restored catalog is saved incrementally and loads with the same rows
+    cat.save()
+    assert get_rows(catalog.load_catalog(file_info))==version2
+    assert [v['version'] for v in cat.get_versions()]==[1, 2, 3]
+    cat.restore(1)
+    assert get_rows(cat)==version1
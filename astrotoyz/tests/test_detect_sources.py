@@ -0,0 +1,79 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+
+from astrotoyz import detect_sources
+
+def make_stamp(model, params, shape=(21, 21), noise=0., seed=1):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    stamp = model((x.astype(float), y.astype(float)), *params).reshape(shape)
+    if noise>0:
+        stamp = stamp+np.random.RandomState(seed).normal(0, noise, shape)
+    return stamp
+
+@pytest.mark.parametrize('bounded', [True, False])
+def test_fit_elliptical_gaussian(monkeypatch, bounded):
+    monkeypatch.setattr(detect_sources, 'bounded_fits', bounded)
+    params = [200., 10.3, 9.6, 2.1, 1.5, .4, 10.]
+    stamp = make_stamp(detect_sources.elliptical_gaussian, params, noise=1.)
+    fit, pcov = detect_sources.fit_elliptical_gaussian(stamp)
+    assert len(fit)>0
+    np.testing.assert_allclose(fit[1:3], params[1:3], atol=.05)
+    np.testing.assert_allclose(fit[0], params[0], rtol=.05)
+
+def test_bounded_fit_stays_in_bounds():
+    params = [200., 10.3, 9.6, 2.5, 3., 10.]
+    stamp = make_stamp(detect_sources.circular_moffat, params, noise=1.)
+    lower, upper = detect_sources.get_bounds('circular_moffat', stamp)
+    # Start the fit far from the source with a guess outside of the bounds
+    guess = [1e4, 0., 20., 100., 50., -1e4]
+    fit, pcov = detect_sources.fit_model('circular_moffat', detect_sources.circular_moffat,
+        stamp, guess)
+    assert len(fit)>0
+    assert np.all(fit>=lower) and np.all(fit<=upper)
+    np.testing.assert_allclose(fit[1:3], params[1:3], atol=.05)
+
+def test_bounded_fit_rejects_edge_sources():
+    # Only the wing of a source centered outside of the stamp is visible, so the
+    # center is pushed to the edge of the bounds
+    params = [200., -2., 10., 3., 10.]
+    stamp = make_stamp(detect_sources.circular_gaussian, params)
+    fit, pcov = detect_sources.fit_model('circular_gaussian',
+        detect_sources.circular_gaussian, stamp, [200., 2., 10., 3., 10.])
+    assert len(fit)==0
+
+@pytest.mark.parametrize('std_dev', [1.5, 2.5, 4.])
+def test_estimate_fwhm(std_dev):
+    stamp = make_stamp(detect_sources.circular_gaussian, [100., 15., 15., std_dev, 5.],
+        shape=(31,31))
+    fwhm = detect_sources.estimate_fwhm(stamp)
+    np.testing.assert_allclose(fwhm, 2*np.sqrt(2*np.log(2))*std_dev, rtol=.15)
+
+def test_estimate_fwhm_flat_stamp():
+    assert np.isnan(detect_sources.estimate_fwhm(np.ones((11,11))))
+
+def test_estimate_seeing():
+    shape = (100, 100)
+    x = np.array([20, 50, 80, 30, 70])
+    y = np.array([20, 50, 80, 70, 30])
+    img_data = np.zeros(shape)
+    for n in range(len(x)):
+        img_data += make_stamp(detect_sources.circular_gaussian,
+            [100.+10*n, x[n], y[n], 2., 0.], shape=shape)
+    # A saturated source with a much larger FWHM is ignored
+    img_data += make_stamp(detect_sources.circular_gaussian, [1e4, 50, 15, 6., 0.],
+        shape=shape)
+    x = np.append(x, 50)
+    y = np.append(y, 15)
+    seeing = detect_sources.estimate_seeing(img_data, x, y, 10, saturate=1000)
+    np.testing.assert_allclose(seeing, 2*np.sqrt(2*np.log(2))*2., rtol=.15)
+    assert np.isnan(detect_sources.estimate_seeing(img_data, x[:0], y[:0], 10))
+
+def test_get_stamp_radius():
+    assert detect_sources.get_stamp_radius(.1)==detect_sources.min_stamp_radius
+    assert detect_sources.get_stamp_radius(1e3)==detect_sources.max_stamp_radius
+    assert detect_sources.get_stamp_radius(4.)==int(np.ceil(detect_sources.stamp_fwhm_scale*4))
+    assert detect_sources.get_stamp_radius(np.nan)==detect_sources.max_stamp_radius
+    assert detect_sources.get_stamp_radius(np.nan, default=7)==7
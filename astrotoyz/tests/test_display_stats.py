@@ -0,0 +1,71 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import json
+import numpy as np
+import pytest
+import astropy.io.fits as pyfits
+from astropy.visualization import ZScaleInterval
+
+from astrotoyz import display_stats, cache
+
+def make_samples(num_samples=1000, seed=0):
+    rand = np.random.RandomState(seed)
+    samples = rand.normal(100., 5., num_samples)
+    # A broad population of faint sources, where pixels rejected in one iteration
+    # would be accepted again in the next if the rejections were not accumulated
+    samples[:num_samples//5] = rand.normal(130., 20., num_samples//5)
+    # Hot pixels
+    samples[-10:] = 1e4
+    samples[-15:-10] = np.nan
+    return samples
+
+@pytest.mark.parametrize('seed', [3, 7, 17])
+def test_zscale_matches_astropy(seed):
+    samples = make_samples(seed=seed)
+    vmin, vmax = display_stats.zscale(samples)
+    interval = ZScaleInterval(nsamples=len(samples))
+    np.testing.assert_allclose([vmin, vmax], interval.get_limits(samples), rtol=1e-10)
+
+def test_zscale_empty():
+    assert np.all(np.isnan(display_stats.zscale(np.array([np.nan]))))
+
+@pytest.fixture
+def fits_hdu(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'cache_root', str(tmpdir.join('cache')))
+    monkeypatch.setattr(display_stats, 'stats_cache', cache.LRUCache())
+    filepath = str(tmpdir.join('img.fits'))
+    pyfits.PrimaryHDU(make_samples(200*300).reshape(200, 300)).writeto(filepath)
+    hdulist = pyfits.open(filepath)
+    yield filepath, hdulist[0]
+    hdulist.close()
+
+def test_compute_display_stats(fits_hdu):
+    filepath, hdu = fits_hdu
+    stats = display_stats.compute_display_stats(hdu)
+    assert stats['num_samples']>.9*min(display_stats.max_samples, 200*300)
+    assert stats['min']<stats['zscale'][0]<100<stats['zscale'][1]<stats['max']
+    assert sum(stats['histogram']['counts'])<=stats['num_samples']
+    assert stats['percentiles']['0.5']<stats['percentiles']['99.5']
+
+def test_sidecar(fits_hdu, monkeypatch):
+    filepath, hdu = fits_hdu
+    stats = display_stats.get_display_stats(filepath, 0, hdu)
+    checksum = display_stats.get_hdu_checksum(filepath, 0, hdu.header)
+    sidecar = os.path.join(cache.get_cache_path('stats'), checksum+'.json')
+    assert os.path.isfile(sidecar)
+
+    # A new process loads the statistics from the sidecar
+    def compute(hdu):
+        raise AssertionError('Statistics were recalculated')
+    monkeypatch.setattr(display_stats, 'stats_cache', cache.LRUCache())
+    monkeypatch.setattr(display_stats, 'compute_display_stats', compute)
+    assert display_stats.get_display_stats(filepath, 0, hdu)['zscale']==stats['zscale']
+
+    # Sidecars from an older version are ignored
+    with open(sidecar, 'w') as f:
+        json.dump(dict(stats, version=display_stats.stats_version-1), f)
+    monkeypatch.setattr(display_stats, 'stats_cache', cache.LRUCache())
+    with pytest.raises(AssertionError):
+        display_stats.get_display_stats(filepath, 0, hdu)
@@ -0,0 +1,55 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import pytest
+
+import astrotoyz.core
+from astrotoyz import executors
+
+def square(x):
+    return x*x
+
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+def test_map_keeps_order(backend):
+    with executors.get_executor(backend, workers=2) as executor:
+        assert executor.backend==backend
+        assert executor.map(square, range(50))==[x*x for x in range(50)]
+
+def test_choose_backend():
+    # A single job or a single worker is never worth a pool
+    assert executors.choose_backend(1, 10., workers=4)=='serial'
+    assert executors.choose_backend(100, 10., workers=1)=='serial'
+    # Cheap jobs are not worth the dispatch overhead
+    assert executors.choose_backend(100, 1e-6, workers=4)=='serial'
+    # Expensive jobs use processes, unless they are not allowed
+    assert executors.choose_backend(100, 1., workers=4)=='process'
+    assert executors.choose_backend(100, 1., workers=4, allow_processes=False)=='thread'
+
+def test_processes_not_allowed():
+    with pytest.raises(astrotoyz.core.AstroToyzError):
+        executors.get_executor('process', allow_processes=False)
+    executor = executors.get_executor('auto', 100, 1., workers=4, allow_processes=False)
+    assert executor.backend=='thread'
+    executor.close()
+
+class Stop(Exception):
+    pass
+
+def test_detect_sources_never_forks(monkeypatch):
+    # The web application detects sources inside the session process, which must not
+    # be forked
+    import numpy as np
+    import astrotoyz.catalog
+    import astrotoyz.detect_sources
+    import astrotoyz.viewer
+    from toyz.web import session_vars
+    class HDU(object):
+        data = np.zeros((10, 10))
+    def find_stars(**settings):
+        assert settings['allow_processes'] is False
+        raise Stop()
+    monkeypatch.setattr(astrotoyz.viewer, 'get_file', lambda file_info: [HDU()])
+    monkeypatch.setattr(astrotoyz.detect_sources, 'find_stars', find_stars)
+    monkeypatch.setattr(session_vars, 'catalogs', {}, raising=False)
+    with pytest.raises(Stop):
+        astrotoyz.catalog.detect_sources({'frame': 0}, 'cat', {'seeing_map': None})
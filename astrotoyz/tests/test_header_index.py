@@ -0,0 +1,70 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import numpy as np
+import astropy.io.fits as pyfits
+
+from astrotoyz import header_index, viewer
+
+def make_mef(filepath, filters, detsec='[1:10,1:20]'):
+    hdus = [pyfits.PrimaryHDU()]
+    for filt in filters:
+        hdu = pyfits.ImageHDU(np.zeros((20, 10), dtype=np.float32))
+        hdu.header['FILTER'] = filt
+        hdu.header['DETSEC'] = detsec
+        hdus.append(hdu)
+    pyfits.HDUList(hdus).writeto(filepath, overwrite=True)
+
+def test_index_and_query(tmpdir):
+    index = header_index.HeaderIndex(str(tmpdir.join('headers.db')))
+    data_path = tmpdir.mkdir('data')
+    make_mef(str(data_path.join('a.fits')), ['r', 'g'])
+    make_mef(str(data_path.join('b.fits')), ['g'])
+    updated = index.update_directory(str(data_path))
+    assert len(updated)==2
+    # Files are only re-read when they change
+    assert index.update_directory(str(data_path))==[]
+    assert index.query(str(data_path), FILTER='g')==[
+        (str(data_path.join('a.fits')), 2), (str(data_path.join('b.fits')), 1)]
+    assert index.query(FILTER='r', NAXIS1=10)==[(str(data_path.join('a.fits')), 1)]
+    keywords = index.get_keywords(str(data_path.join('a.fits')), 1)
+    assert keywords['DETSEC']=='[1:10,1:20]' and keywords['NAXIS2']==20
+
+    # Deleted files are removed from the index
+    os.remove(str(data_path.join('b.fits')))
+    index.update_directory(str(data_path))
+    assert index.query(str(data_path), FILTER='g')==[(str(data_path.join('a.fits')), 2)]
+
+def test_query_path_is_not_a_pattern(tmpdir):
+    index = header_index.HeaderIndex(str(tmpdir.join('headers.db')))
+    # '_' and '%' would match any character in a LIKE pattern, and LIKE ignores case
+    for dirname in ['night_1', 'nightX1', 'night%1', 'NIGHT_1']:
+        path = tmpdir.mkdir(dirname)
+        make_mef(str(path.join('img.fits')), ['r'])
+        index.update_directory(str(path))
+    for dirname in ['night_1', 'night%1']:
+        assert index.query(str(tmpdir.join(dirname)), FILTER='r')==[
+            (str(tmpdir.join(dirname, 'img.fits')), 1)]
+    # Removing the files in one directory does not remove the other directories
+    os.remove(str(tmpdir.join('night_1', 'img.fits')))
+    index.update_directory(str(tmpdir.join('night_1')))
+    assert len(index.query(FILTER='r'))==3
+
+def test_stale_index(tmpdir, monkeypatch):
+    index = header_index.HeaderIndex(str(tmpdir.join('headers.db')))
+    filepath = str(tmpdir.join('img.fits'))
+    make_mef(filepath, ['r'])
+    assert len(index.get_keywords(filepath))==2
+    # Rewrite the file with more extensions without changing the modification time
+    mtime = os.path.getmtime(filepath)
+    make_mef(filepath, ['r', 'g', 'i'], detsec='[11:20,1:20]')
+    os.utime(filepath, (mtime, mtime))
+    assert index.get_keywords(filepath, 3)['FILTER']=='i'
+    assert index.get_keywords(filepath, 5)=={}
+
+    # The viewer reads the detector section of the new frame
+    monkeypatch.setattr(viewer, 'get_header_index', lambda: index)
+    monkeypatch.setattr(viewer, 'get_pyramid', lambda *args: None)
+    img_info = viewer.get_img_info({'ext': 'fits', 'filepath': filepath, 'frame': 2}, {})
+    assert img_info['coord_range']=={'x': [11, 20], 'y': [1, 20]}
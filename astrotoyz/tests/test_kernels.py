@@ -0,0 +1,59 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+
+from astrotoyz import kernels
+from astrotoyz import detect_sources
+
+models = {
+    'circular_moffat': (detect_sources.circular_moffat,
+        [100., 5.3, 4.7, 2.5, 3., 1.]),
+    'elliptical_moffat': (detect_sources.elliptical_moffat,
+        [100., 5.3, 4.7, 2.5, 1.8, 3., .4, 1.]),
+    'circular_gaussian': (detect_sources.circular_gaussian,
+        [100., 5.3, 4.7, 1.7, 1.]),
+    'elliptical_gaussian': (detect_sources.elliptical_gaussian,
+        [100., 5.3, 4.7, 1.7, 1.2, .3, 1.])
+}
+
+def get_grid():
+    y, x = np.mgrid[:11, :11]
+    return (x.astype(float), y.astype(float))
+
+def finite_difference(model, xy, params, step=1e-6):
+    """
+    Central difference Jacobian of ``model`` with respect to each parameter
+    """
+    jac = []
+    for n in range(len(params)):
+        dp = step*max(1, abs(params[n]))
+        upper = list(params)
+        lower = list(params)
+        upper[n] += dp
+        lower[n] -= dp
+        jac.append((np.ravel(model(xy, *upper))-np.ravel(model(xy, *lower)))/(2*dp))
+    return np.column_stack(jac)
+
+@pytest.mark.parametrize('model_name', sorted(models))
+def test_numpy_jacobian(model_name):
+    model, params = models[model_name]
+    numpy_jacobian, kernel, nparams = kernels.kernels[model_name]
+    xy = get_grid()
+    jac = numpy_jacobian(xy, *params)
+    assert jac.shape==(xy[0].size, nparams)
+    np.testing.assert_allclose(jac, finite_difference(model, xy, params),
+        rtol=1e-5, atol=1e-6)
+
+@pytest.mark.skipif('kernels.numba is None')
+@pytest.mark.parametrize('model_name', sorted(models))
+def test_compiled_kernel(model_name):
+    model, params = models[model_name]
+    numpy_jacobian, kernel, nparams = kernels.kernels[model_name]
+    xy = get_grid()
+    fused = kernels.FusedModel(kernel, nparams)
+    np.testing.assert_allclose(fused.model(xy, *params), np.ravel(model(xy, *params)),
+        rtol=1e-10)
+    np.testing.assert_allclose(fused.jacobian(xy, *params), numpy_jacobian(xy, *params),
+        rtol=1e-8, atol=1e-10)
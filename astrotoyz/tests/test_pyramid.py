@@ -0,0 +1,71 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import os
+import numpy as np
+import pytest
+import astropy.io.fits as pyfits
+
+from astrotoyz import pyramid, cache
+
+def test_downsample():
+    data = np.arange(15, dtype=float).reshape(3,5)
+    binned = pyramid.downsample(data)
+    assert binned.shape==(2,3)
+    assert binned[0,0]==np.mean(data[:2,:2])
+    # The last row and column are repeated
+    assert binned[1,2]==data[2,4]
+    assert binned[0,2]==np.mean(data[:2,4])
+
+def test_level_shapes(monkeypatch):
+    monkeypatch.setattr(pyramid, 'min_level_size', 100)
+    assert pyramid.get_level_shapes((401, 250))==[(401,250), (201,125), (101,63), (51,32)]
+
+@pytest.fixture
+def pyramid_image(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'cache_root', str(tmpdir.join('cache')))
+    monkeypatch.setattr(pyramid, 'pyramid_cache', cache.LRUCache())
+    monkeypatch.setattr(pyramid, 'min_pyramid_size', 200)
+    monkeypatch.setattr(pyramid, 'min_level_size', 60)
+    # Build each level from several strips
+    monkeypatch.setattr(pyramid, 'strip_rows', 64)
+    filepath = str(tmpdir.join('img.fits'))
+    data = np.random.RandomState(5).normal(size=(301, 250)).astype(np.float32)
+    pyfits.PrimaryHDU(data).writeto(filepath)
+    return filepath, data
+
+def test_build_pyramid(pyramid_image):
+    filepath, data = pyramid_image
+    assert pyramid.get_pyramid(filepath, 0, (100, 100)) is None
+    pyr = pyramid.get_pyramid(filepath, 0, data.shape, background=False)
+    assert pyr.shapes==pyramid.get_level_shapes(data.shape)
+    assert len(pyr.levels)==4
+    expected = data
+    for level in pyr.levels[1:]:
+        expected = pyramid.downsample(expected)
+        np.testing.assert_allclose(level, expected, rtol=1e-5)
+    # The pyramid is reused once it is built
+    assert pyramid.get_pyramid(filepath, 0, data.shape) is pyr
+
+def test_pyramid_read(pyramid_image):
+    filepath, data = pyramid_image
+    pyr = pyramid.get_pyramid(filepath, 0, data.shape, background=False)
+    assert pyr.get_level(1.5)==0
+    assert pyr.get_level(.5)==1
+    assert pyr.get_level(.3)==1
+    assert pyr.get_level(.01)==3
+    section = pyr.read(2, 10, 50, 21, 101)
+    np.testing.assert_array_equal(section, pyr.levels[2][2:13, 5:26])
+
+def test_background_build(pyramid_image):
+    filepath, data = pyramid_image
+    assert pyramid.get_pyramid(filepath, 0, data.shape) is None
+    path = pyramid.get_pyramid_path(filepath, 0)
+    thread = pyramid.builds.get(path)
+    if thread is not None:
+        thread.join()
+    assert pyramid.get_pyramid(filepath, 0, data.shape) is not None
+    # A new pyramid is needed when the file changes
+    mtime = os.path.getmtime(filepath)
+    os.utime(filepath, (mtime+10, mtime+10))
+    assert pyramid.get_pyramid_path(filepath, 0)!=path
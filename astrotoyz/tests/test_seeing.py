@@ -0,0 +1,63 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+
+from astrotoyz import seeing
+from astrotoyz.core import AstroToyzError
+
+def make_sources(shape, num_sources=2000, seed=2):
+    """
+    Elliptical gaussian fits whose FWHM increases linearly from the left edge of the
+    image to the right, with a constant ellipticity and position angle
+    """
+    rand = np.random.RandomState(seed)
+    x = rand.uniform(0, shape[1], num_sources)
+    y = rand.uniform(0, shape[0], num_sources)
+    fwhm = 3+2*x/shape[1]
+    std = fwhm/seeing.std2fwhm
+    dtype = [('x',float),('y',float),('std_x',float),('std_y',float),('angle',float)]
+    sources = np.zeros(num_sources, dtype=dtype)
+    sources['x'] = x
+    sources['y'] = y
+    # Put the major axis along y, so the angle is rotated by 90 degrees
+    sources['std_x'] = std*np.sqrt(.8)
+    sources['std_y'] = std/np.sqrt(.8)
+    sources['angle'] = .3
+    return sources
+
+def test_get_psf_shape():
+    sources = make_sources((100,100), 10)
+    major, minor, angle = seeing.get_psf_shape(sources)
+    np.testing.assert_allclose(minor/major, .8)
+    np.testing.assert_allclose(angle, .3+np.pi/2-np.pi)
+    with pytest.raises(AstroToyzError):
+        seeing.get_psf_shape(sources[['x','y']])
+
+def test_build_seeing_map():
+    shape = (1024, 2048)
+    sources = make_sources(shape)
+    # Add a few blends with much larger FWHM that should be clipped
+    sources['std_x'][:20] *= 5
+    sources['std_y'][:20] *= 5
+    seeing_map = seeing.build_seeing_map(sources, shape, bin_size=256, smoothing=0)
+    assert seeing_map.bins==(4, 8)
+    assert seeing_map.counts.sum()<=len(sources)-10
+    x = np.array([300., 1000., 1700.])
+    y = np.array([500., 500., 500.])
+    np.testing.assert_allclose(seeing_map.fwhm_at(x, y), 3+2*x/shape[1], rtol=.05)
+    result = seeing_map.at(1000., 500.)
+    np.testing.assert_allclose(result['ellipticity'], 1-.8, atol=.01)
+    np.testing.assert_allclose(result['angle'], .3-np.pi/2, atol=.01)
+
+def test_seeing_map_dict_round_trip():
+    shape = (512, 512)
+    seeing_map = seeing.build_seeing_map(make_sources(shape, 50), shape, bin_size=128,
+        smoothing=0)
+    seeing_map.fwhm[0,0] = np.nan
+    loaded = seeing.SeeingMap.from_dict(seeing_map.to_dict())
+    # to_dict converts NaN to a string that the client understands
+    assert seeing_map.to_dict()['fwhm'][0][0]=='NaN'
+    for name in ['fwhm', 'ellipticity', 'angle', 'counts']:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(seeing_map, name))
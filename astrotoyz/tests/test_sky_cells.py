@@ -0,0 +1,73 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+
+from astrotoyz import sky_cells
+
+def random_sky(num_points, seed):
+    """
+    Positions distributed uniformly over the sphere
+    """
+    np.random.seed(seed)
+    ra = np.random.uniform(0, 360, num_points)
+    dec = np.degrees(np.arcsin(np.random.uniform(-1, 1, num_points)))
+    return ra, dec
+
+def test_radec2cell_parents():
+    ra, dec = random_sky(1000, 1)
+    cells = sky_cells.radec2cell(ra, dec, 8)
+    assert np.all((cells>=0) & (cells<12*4**8))
+    np.testing.assert_array_equal(cells>>4, sky_cells.radec2cell(ra, dec, 6))
+    assert sky_cells.radec2cell(np.nan, 10)[0]==-1
+
+@pytest.mark.parametrize('ra,dec,radius', [
+    (10., 20., 80.),
+    (10., 20., .5),
+    (359.9, 85., 10.),
+    (180., -60., 45.),
+    (0., 0., 120.),
+])
+def test_cone_cells_coverage(ra, dec, radius):
+    cells, query_order = sky_cells.cone_cells(ra, dec, radius)
+    if radius<1:
+        # Dense points near the center of a small cone
+        np.random.seed(2)
+        pt_ra = ra+np.random.uniform(-2*radius, 2*radius, 100000)/np.cos(np.radians(dec))
+        pt_dec = dec+np.random.uniform(-2*radius, 2*radius, 100000)
+    else:
+        pt_ra, pt_dec = random_sky(200000, 2)
+    inside = sky_cells.angular_separation(ra, dec, pt_ra, pt_dec)<=radius
+    assert np.sum(inside)>1000
+    pt_cells = sky_cells.radec2cell(pt_ra[inside], pt_dec[inside], query_order)
+    assert np.all(np.in1d(pt_cells, cells))
+    if radius<=10:
+        assert len(cells)<12*4**query_order
+
+@pytest.mark.parametrize('ra_min,ra_max,dec_min,dec_max', [
+    (10., 20., -5., 5.),
+    (350., 10., 30., 60.),
+    (0., 360., -90., -70.),
+    (100., 250., -40., 80.),
+])
+def test_box_cells_coverage(ra_min, ra_max, dec_min, dec_max):
+    cells, query_order = sky_cells.box_cells(ra_min, ra_max, dec_min, dec_max)
+    pt_ra, pt_dec = random_sky(200000, 3)
+    width = sky_cells.ra_width(ra_min, ra_max)
+    inside = ((np.mod(pt_ra-ra_min, 360.)<=width) &
+        (pt_dec>=dec_min) & (pt_dec<=dec_max))
+    assert np.sum(inside)>100
+    pt_cells = sky_cells.radec2cell(pt_ra[inside], pt_dec[inside], query_order)
+    assert np.all(np.in1d(pt_cells, cells))
+
+def test_ra_width():
+    assert sky_cells.ra_width(10., 30.)==20.
+    assert sky_cells.ra_width(350., 10.)==20.
+    assert sky_cells.ra_width(0., 360.)==360.
+    assert sky_cells.ra_width(-180., 180.)==360.
+    assert sky_cells.ra_width(10., 10.)==0.
+
+def test_cell_ranges():
+    ranges = sky_cells.cell_ranges(np.array([5, 3, 4, 9]), 2, 4)
+    assert ranges==[(3*16, 6*16), (9*16, 10*16)]
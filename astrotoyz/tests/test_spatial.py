@@ -0,0 +1,93 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+
+from astrotoyz import spatial
+
+def brute_force(points, ids, query, radius):
+    """
+    Nearest source and all of the sources within ``radius`` of each position
+    """
+    nearest_ids = []
+    nearest_dist = []
+    within = []
+    for point in query:
+        dist = np.sqrt(np.sum((points-point)**2, axis=1))
+        nearest_ids.append(ids[np.argmin(dist)])
+        nearest_dist.append(np.min(dist))
+        within.append(sorted(ids[dist<=radius]))
+    return nearest_ids, np.array(nearest_dist), within
+
+class TreeQueries(object):
+    """
+    Record the number of neighbors requested from a KD-tree
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.k = []
+    def query(self, points, k):
+        self.k.append(k)
+        return self.tree.query(points, k=k)
+    def query_ball_point(self, points, radius):
+        return self.tree.query_ball_point(points, radius)
+
+@pytest.mark.parametrize('min_rebuild', [64, 100000])
+def test_px_index(monkeypatch, min_rebuild):
+    monkeypatch.setattr(spatial, 'min_rebuild', min_rebuild)
+    rand = np.random.RandomState(9)
+    points = rand.uniform(0, 1000, (5000, 2))
+    ids = np.arange(len(points))
+    index = spatial.SpatialIndex(points[:,0], points[:,1], ids)
+    # Remove most of the sources in one corner, so some positions have to widen the search
+    removed = ids[(points[:,0]<200) & (points[:,1]<200)][:-5]
+    removed = np.concatenate([removed, rand.choice(ids, 500, replace=False)])
+    index.remove(removed)
+    new_points = rand.uniform(0, 1000, (30, 2))
+    new_ids = np.arange(len(points), len(points)+30)
+    index.add(new_points[:,0], new_points[:,1], new_ids)
+    index.remove(new_ids[:5])
+
+    keep = ~np.in1d(ids, removed)
+    all_points = np.vstack([points[keep], new_points[5:]])
+    all_ids = np.concatenate([ids[keep], new_ids[5:]])
+    assert len(index)==len(all_ids)
+    query = np.vstack([rand.uniform(0, 1000, (200, 2)), rand.uniform(0, 200, (20, 2))])
+    if index.tree is not None and index.num_removed>0:
+        index.tree = TreeQueries(index.tree)
+    found_ids, found_dist = index.nearest(query[:,0], query[:,1])
+    expected_ids, expected_dist, within = brute_force(all_points, all_ids, query, 30)
+    assert list(found_ids)==expected_ids
+    np.testing.assert_allclose(found_dist, expected_dist)
+    if isinstance(index.tree, TreeQueries):
+        # Only a few neighbors are requested, not one for every removed source
+        assert index.tree.k[0]==spatial.initial_neighbors and len(index.tree.k)>1
+        assert max(index.tree.k)<index.num_removed
+    result = index.query_radius(query[:,0], query[:,1], 30)
+    assert [sorted(r) for r in result]==within
+
+def test_wcs_index():
+    rand = np.random.RandomState(10)
+    ra = rand.uniform(-1, 1, 2000)%360
+    dec = rand.uniform(-1, 1, 2000)
+    ids = np.arange(2000)
+    index = spatial.SpatialIndex(ra, dec, ids, coord_type='wcs')
+    index.remove(ids[:100])
+    query_ra = np.array([0., 359.9, .5])
+    query_dec = np.array([0., .1, -.5])
+    found_ids, found_dist = index.nearest(query_ra, query_dec)
+    xyz = spatial.radec2xyz(ra[100:], dec[100:])
+    expected_ids, chords, within = brute_force(xyz, ids[100:],
+        spatial.radec2xyz(query_ra, query_dec), spatial.angle2chord(.05))
+    assert list(found_ids)==expected_ids
+    np.testing.assert_allclose(found_dist, spatial.chord2angle(chords))
+    result = index.query_radius(query_ra, query_dec, .05)
+    assert [sorted(r) for r in result]==within
+
+def test_empty_index():
+    index = spatial.SpatialIndex([1., np.nan], [1., 2.], ['a', 'b'])
+    assert len(index)==1
+    index.remove(['a'])
+    ids, distances = index.nearest([0.], [0.])
+    assert ids[0] is None and np.isinf(distances[0])
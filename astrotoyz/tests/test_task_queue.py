@@ -0,0 +1,173 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import threading
+import multiprocessing
+import numpy as np
+import pytest
+
+import toyz.utils.core
+from toyz.web import session_vars
+from astrotoyz import task_queue
+
+def test_priority_order():
+    executor = task_queue.PriorityExecutor(num_workers=1, reserved_workers=0)
+    started = threading.Event()
+    release = threading.Event()
+    def block():
+        started.set()
+        release.wait()
+    order = []
+    finished = threading.Event()
+    executor.submit(1, block)
+    started.wait()
+    for name, priority in [('background1', 2), ('normal', 1), ('interactive1', 0),
+            ('background2', 2), ('interactive2', 0)]:
+        executor.submit(priority, order.append, name)
+    executor.submit(3, finished.set)
+    assert executor.pending()=={'interactive': 2, 'normal': 1, 'background': 2}
+    release.set()
+    assert finished.wait(10)
+    assert order==['interactive1', 'interactive2', 'normal', 'background1', 'background2']
+
+def test_reserved_worker():
+    executor = task_queue.PriorityExecutor(num_workers=2, reserved_workers=1)
+    release = threading.Event()
+    started = threading.Event()
+    def block():
+        started.set()
+        release.wait()
+    executor.submit(task_queue.priorities['background'], block)
+    started.wait()
+    # The other worker is reserved for interactive jobs, so it does not run this job
+    done = threading.Event()
+    executor.submit(task_queue.priorities['normal'], done.set)
+    assert not done.wait(.2)
+    interactive = threading.Event()
+    executor.submit(task_queue.priorities['interactive'], interactive.set)
+    assert interactive.wait(10)
+    release.set()
+    assert done.wait(10)
+
+def test_session_pipe(monkeypatch):
+    """
+    Large responses sent by many workers at once arrive intact, and the results of jobs
+    are sent after the messages the job sent
+    """
+    parent, child = multiprocessing.Pipe()
+    session_pipe = task_queue.SessionPipe(child)
+    def run_job(toyz_settings, pipe, job):
+        pipe.send({'id': job['id'], 'response': {'id': 'progress'}})
+        return {'id': job['id'], 'response': {'id': 'result'}}
+    monkeypatch.setattr(toyz.utils.core, 'run_job', run_job)
+    server = threading.Thread(target=session_pipe.serve)
+    server.start()
+
+    data = np.arange(200000)
+    def send(n):
+        for m in range(5):
+            session_pipe.send({'id': (n, m), 'response': {'data': data+n}})
+    workers = [threading.Thread(target=send, args=(n,)) for n in range(4)]
+    for worker in workers:
+        worker.start()
+    parent.send({'toyz_settings': None, 'job': {'id': 'job'}})
+    received = [parent.recv() for n in range(22)]
+    for worker in workers:
+        worker.join()
+    responses = {msg['id']: msg['response'] for msg in received}
+    for n in range(4):
+        for m in range(5):
+            np.testing.assert_array_equal(responses[(n, m)]['data'], data+n)
+    job_messages = [msg['response']['id'] for msg in received if msg['id']=='job']
+    assert job_messages==['progress', 'result']
+
+    # The session ends when the web application closes the pipe
+    parent.close()
+    server.join(10)
+    assert not server.is_alive()
+
+def test_run_async_without_pipe(monkeypatch):
+    monkeypatch.setattr(session_vars, 'pipe', None, raising=False)
+    @task_queue.run_async('normal')
+    def task(toyz_settings, tid, params):
+        return {'id': 'task', 'value': params['value']}
+    assert task(None, {}, {'value': 1})=={'id': 'task', 'value': 1}
+
+def test_run_job_sends_response(monkeypatch):
+    sent = []
+    class Pipe(object):
+        def send(self, msg):
+            sent.append(msg)
+    monkeypatch.setattr(session_vars, 'pipe', Pipe(), raising=False)
+    def task(toyz_settings, tid, params):
+        if params.get('fail'):
+            raise ValueError('bad value')
+        return {'id': 'task'}
+    tid = {'request_id': 3}
+    task_queue.run_job(task, None, tid, {})
+    task_queue.run_job(task, None, tid, {'fail': True})
+    assert [msg['response']['id'] for msg in sent]==['task', 'ERROR']
+    assert sent[0]['id'] is tid and sent[0]['response']['request_id']==3
+
+def test_run_async_serves_session(monkeypatch):
+    """
+    The first asynchronous task takes over the job loop of the session process and the
+    process exits when the web application closes the pipe
+    """
+    parent, child = multiprocessing.Pipe()
+    monkeypatch.setattr(session_vars, 'pipe', child, raising=False)
+    @task_queue.run_async('normal')
+    def task(toyz_settings, tid, params):
+        return {'id': 'task'}
+    received = []
+    def client():
+        received.append(parent.recv())
+        parent.close()
+    thread = threading.Thread(target=client)
+    thread.start()
+    with pytest.raises(SystemExit):
+        task(None, {'request_id': 1}, {})
+    thread.join()
+    assert received[0]['response']=={'id': 'task', 'request_id': 1}
+    assert isinstance(session_vars.pipe, task_queue.SessionPipe)
+
+def test_coalesced_jobs(monkeypatch):
+    """
+    Only the most recent request with the same coalescing key is answered
+    """
+    from astrotoyz import tasks
+    sent = []
+    class Pipe(object):
+        def send(self, msg):
+            sent.append(msg['response']['value'])
+    monkeypatch.setattr(session_vars, 'pipe', Pipe(), raising=False)
+    monkeypatch.setattr(task_queue, 'latest_jobs', {})
+    monkeypatch.setattr(task_queue, 'task_stats', task_queue.TaskStats())
+    # Queue the jobs instead of running them on the workers
+    jobs = []
+    class Queue(object):
+        def submit(self, priority, func, *args):
+            jobs.append(args)
+    monkeypatch.setattr(task_queue, 'get_task_queue', lambda: Queue())
+    monkeypatch.setattr(task_queue, 'start_session_pipe', lambda: False)
+    def hover(toyz_settings, tid, params):
+        if params['value']==2:
+            # A newer request arrives while this job is running
+            submit(None, {'request_id': 3}, {'viewer_id': 'v1', 'value': 3})
+        return {'id': 'hover', 'value': params['value']}
+    submit = task_queue.run_async('interactive', coalesce=tasks._viewer_request_key)(hover)
+    submit(None, {'request_id': 0}, {'viewer_id': 'v1', 'value': 0})
+    submit(None, {'request_id': 1}, {'viewer_id': 'v2', 'value': 1})
+    # Requests without a viewer are never coalesced
+    submit(None, {'request_id': 4}, {'value': 4})
+    submit(None, {'request_id': 4}, {'value': 5})
+    submit(None, {'request_id': 2}, {'viewer_id': 'v1', 'value': 2})
+    while len(jobs)>0:
+        task_queue.run_job(*jobs.pop(0))
+    # 0 is dropped before it runs and the response to 2 is dropped after it runs
+    assert sent==[1, 4, 5, 3]
+    stats = task_queue.task_stats.get()['hover']
+    assert stats['submitted']==6
+    assert stats['completed']==4
+    assert stats['dropped']==2
+    assert stats['mean_latency']>=0
@@ -0,0 +1,78 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+import astropy.io.fits as pyfits
+import astropy.wcs as pywcs
+
+from astrotoyz import tasks, viewer, cache
+from astrotoyz.core import AstroToyzError
+from astrotoyz.tests.test_cache import make_fits
+
+@pytest.fixture
+def fits_file(tmpdir, monkeypatch):
+    filepath = str(tmpdir.join('img.fits'))
+    make_fits(filepath)
+    hdulist = pyfits.open(filepath)
+    monkeypatch.setattr(viewer, 'get_file', lambda file_info: hdulist)
+    monkeypatch.setattr(viewer, 'wcs_cache', cache.LRUCache())
+    monkeypatch.setattr(viewer, 'wcs_grid_cache', cache.LRUCache())
+    yield {'filepath': filepath, 'frame': 0, 'ext': 'fits'}
+    hdulist.close()
+
+def test_coordinate_batches(fits_file):
+    wcs = pywcs.WCS(pyfits.getheader(fits_file['filepath']))
+    x = [1., 50.5, 100.]
+    y = [1., 20., 100.]
+    response = tasks.px2wcs_batch({}, 1, {'file_info': fits_file, 'x': x, 'y': y})
+    assert response['id']=='px2wcs_batch'
+    ra, dec = wcs.all_pix2world(x, y, 1)
+    np.testing.assert_allclose(response['ra'], ra)
+    np.testing.assert_allclose(response['dec'], dec)
+
+    response = tasks.wcs2px_batch({}, 2, {'file_info': fits_file, 'ra': list(ra),
+        'dec': list(dec), 'origin': 0})
+    np.testing.assert_allclose(response['x'], np.array(x)-1, atol=1e-6)
+    np.testing.assert_allclose(response['y'], np.array(y)-1, atol=1e-6)
+
+def test_coordinate_batch_nan(fits_file):
+    response = tasks.px2wcs_batch({}, 1, {'file_info': fits_file, 'x': [1., np.nan],
+        'y': [1., 1.]})
+    assert response['ra'][1]=='NaN' and response['dec'][1]=='NaN'
+    assert isinstance(response['ra'][0], float)
+
+def test_coordinate_batch_lengths(fits_file):
+    with pytest.raises(AstroToyzError):
+        tasks.px2wcs_batch({}, 1, {'file_info': fits_file, 'x': [1., 2.], 'y': [1.]})
+    with pytest.raises(AstroToyzError):
+        tasks.wcs2px_batch({}, 1, {'file_info': fits_file, 'ra': [1.], 'dec': []})
+
+def test_get_img_tile_permission(monkeypatch):
+    from toyz.utils import file_access
+    from toyz.utils.errors import ToyzJobError
+    class Settings(object):
+        db = None
+    permissions = {}
+    monkeypatch.setattr(file_access, 'get_parent_permissions',
+        lambda db, path, user_id: permissions.get(path, ''))
+    monkeypatch.setattr(viewer, 'create_tile',
+        lambda file_info, img_info, tile_info: (True, tile_info))
+    params = {'file_info': {'filepath': '/data/img.fits'}, 'img_info': {},
+        'tile_info': {'idx': 1}}
+    with pytest.raises(ToyzJobError):
+        tasks.get_img_tile(Settings(), {'user_id': 'user'}, params)
+    permissions['/data/img.fits'] = 'r'
+    response = tasks.get_img_tile(Settings(), {'user_id': 'user'}, params)
+    assert response=={'id': 'tile created', 'success': True, 'tile_info': {'idx': 1}}
+
+def test_wcs2px(fits_file, monkeypatch):
+    wcs = pywcs.WCS(pyfits.getheader(fits_file['filepath']))
+    ra, dec = wcs.all_pix2world([30.2], [70.8], 1)
+    response = tasks.wcs2px({}, 1, {'file_info': fits_file, 'img_info': {},
+        'ra': ra[0], 'dec': dec[0]})
+    assert response=={'id': 'wcs2px', 'x': 30, 'y': 71}
+    monkeypatch.setattr(viewer, 'get_wcs_grid', lambda file_info, hdulist: None)
+    with pytest.raises(AstroToyzError):
+        tasks.wcs2px({}, 1, {'file_info': fits_file, 'img_info': {}, 'ra': ra[0],
+            'dec': dec[0]})
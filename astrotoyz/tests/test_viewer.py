@@ -0,0 +1,69 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+import astropy.io.fits as pyfits
+
+from astrotoyz import viewer, cache, detect_sources
+
+def make_scaled_fits(filepath, shape=(200, 300), x=120.3, y=80.6):
+    """
+    Write an int16 image with BZERO/BSCALE containing a single gaussian source
+    """
+    y_grid, x_grid = np.mgrid[:shape[0], :shape[1]]
+    data = detect_sources.circular_gaussian((x_grid.astype(float), y_grid.astype(float)),
+        5000., x, y, 2., 1000.).reshape(shape)
+    hdu = pyfits.PrimaryHDU(data.copy())
+    hdu.scale('int16', bzero=32768)
+    hdu.writeto(filepath, overwrite=True)
+    return data
+
+@pytest.fixture
+def scaled_file(tmpdir, monkeypatch):
+    filepath = str(tmpdir.join('scaled.fits'))
+    data = make_scaled_fits(filepath)
+    hdulist = pyfits.open(filepath)
+    monkeypatch.setattr(viewer, 'get_file', lambda file_info: hdulist)
+    monkeypatch.setattr(viewer, 'fit_cache', cache.LRUCache())
+    monkeypatch.setattr(viewer, 'wcs_cache', cache.LRUCache())
+    monkeypatch.setattr(viewer, 'wcs_grid_cache', cache.LRUCache())
+    yield {'filepath': filepath, 'frame': 0, 'ext': 'fits'}, hdulist, data
+    hdulist.close()
+
+def test_read_section(scaled_file):
+    file_info, hdulist, data = scaled_file
+    hdu = hdulist[0]
+    assert viewer.get_img_shape(hdu)==data.shape
+    section = viewer.read_section(hdu, 70, 90, 110, 130)
+    # Only the section is read and scaled
+    assert not hdu._data_loaded
+    np.testing.assert_allclose(section, data[70:90,110:130], atol=1)
+
+def test_get_2d_fit_reads_sections(scaled_file):
+    file_info, hdulist, data = scaled_file
+    response = viewer.get_2d_fit(file_info, 'circular_gaussian', 118, 82, 20, 20)
+    assert response['status']=='success'
+    np.testing.assert_allclose([response['fit']['x'], response['fit']['y']],
+        [120.3, 80.6], atol=.05)
+    assert not hdulist[0]._data_loaded
+
+def test_get_2d_fit_memo(scaled_file, monkeypatch):
+    file_info, hdulist, data = scaled_file
+    fits = []
+    fit_stamp = viewer.fit_stamp
+    def count_fits(*args):
+        fits.append(args)
+        return fit_stamp(*args)
+    monkeypatch.setattr(viewer, 'fit_stamp', count_fits)
+    response = viewer.get_2d_fit(file_info, 'circular_gaussian', 118, 82, 20, 20)
+    # A nearby click snaps to the same stamp
+    response2 = viewer.get_2d_fit(file_info, 'circular_gaussian', 121, 79, 20, 20)
+    assert len(fits)==1
+    assert response2==response
+    # Callers can change their copy without changing the cached fit
+    response2['fit']['x'] += 100
+    assert viewer.get_2d_fit(file_info, 'circular_gaussian', 120, 80, 20, 20)==response
+    # A different fit type is fit again
+    viewer.get_2d_fit(file_info, 'elliptical_gaussian', 120, 80, 20, 20)
+    assert len(fits)==2
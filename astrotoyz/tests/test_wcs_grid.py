@@ -0,0 +1,70 @@
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+import pytest
+import astropy.io.fits as pyfits
+import astropy.wcs as pywcs
+
+from astrotoyz import wcs_grid
+
+def make_wcs(sip=True, crval1=10.):
+    header = pyfits.Header()
+    cards = {'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRVAL1': crval1, 'CRVAL2': 20.,
+        'CRPIX1': 1024., 'CRPIX2': 2048., 'CD1_1': -7e-5, 'CD2_2': 7e-5}
+    if sip:
+        cards.update({'CTYPE1': 'RA---TAN-SIP', 'CTYPE2': 'DEC--TAN-SIP', 'A_ORDER': 3,
+            'B_ORDER': 3, 'A_2_0': 2e-6, 'A_0_2': -1e-6, 'A_3_0': 1e-9, 'B_1_1': 1e-6,
+            'B_2_0': -1e-6, 'B_0_3': 2e-9})
+    for key, value in cards.items():
+        header[key] = value
+    return pywcs.WCS(header)
+
+shape = (4096, 2048)
+
+def test_interpolation_accuracy():
+    wcs = make_wcs(crval1=.01)
+    grid = wcs_grid.WCSGrid(wcs, shape)
+    assert not grid.exact and grid.distorted
+    assert grid.error<=wcs_grid.default_tolerance
+    rand = np.random.RandomState(3)
+    x = rand.uniform(0, shape[1]-1, 200)
+    y = rand.uniform(0, shape[0]-1, 200)
+    ra, dec = wcs.all_pix2world(x, y, 0)
+    # The field crosses RA=0
+    assert ra.min()<1 and ra.max()>359
+    ra_approx, dec_approx = grid.interp_pix2world(x, y)
+    x_approx, y_approx = grid.interp_world2pix(ra, dec)
+    # 1e-6 degrees is less than 0.02 pixels
+    assert np.max(np.abs(wcs_grid.wrap_ra(ra_approx, ra)*np.cos(np.radians(dec))))<1e-6
+    assert np.max(np.abs(dec_approx-dec))<1e-6
+    assert np.max(np.hypot(x_approx-x, y_approx-y))<2*wcs_grid.default_tolerance
+
+def test_interpolation_choice():
+    grid = wcs_grid.WCSGrid(make_wcs(), shape)
+    assert grid.use_interp(1, None)
+    assert grid.use_interp(wcs_grid.max_interp_points, grid.tolerance)
+    assert not grid.use_interp(wcs_grid.max_interp_points+1, None)
+    assert not grid.use_interp(1, grid.error/2)
+    # Without distortion the exact WCS is always used
+    grid = wcs_grid.WCSGrid(make_wcs(sip=False), shape)
+    assert not grid.distorted
+    assert not grid.use_interp(1, None)
+
+@pytest.mark.parametrize('num_points', [1, 5, 1000])
+def test_transformations(num_points):
+    wcs = make_wcs()
+    grid = wcs_grid.WCSGrid(wcs, shape)
+    rand = np.random.RandomState(4)
+    x = rand.uniform(1, shape[1], num_points)
+    y = rand.uniform(1, shape[0], num_points)
+    # The last point is outside of the image, so the exact WCS is used for it
+    x[-1] = -100.
+    ra, dec = grid.pix2world(x, y, origin=1)
+    ra_exact, dec_exact = wcs.all_pix2world(x, y, 1)
+    np.testing.assert_allclose(dec, dec_exact, atol=1e-6)
+    np.testing.assert_allclose(ra, ra_exact, atol=1e-6)
+    assert ra[-1]==ra_exact[-1] and dec[-1]==dec_exact[-1]
+    x_new, y_new = grid.world2pix(ra_exact, dec_exact, origin=1)
+    np.testing.assert_allclose(x_new, x, atol=2*wcs_grid.default_tolerance)
+    np.testing.assert_allclose(y_new, y, atol=2*wcs_grid.default_tolerance)
@@ -4,46 +4,188 @@ Tools for Astro-Toyz Viewer
 # Copyright 2015 by Fred Moolekamp
 # License: LGPLv3
 from __future__ import print_function, division
+import os
+import mmap
+import copy
+import threading
 
 import toyz.web.viewer
+import toyz.utils.core
 from toyz.web import session_vars
 import astropy.wcs as pywcs
 import astropy.io.fits as pyfits
 import numpy as np
 import astrotoyz as astro
 import astrotoyz.core
+from astrotoyz.cache import LRUCache, FileCache, get_file_key
+from astrotoyz.wcs_grid import WCSGrid
+from astrotoyz.pyramid import get_pyramid
+from astrotoyz.header_index import get_header_index
+
+def open_fits(filepath):
+    """
+    Open a FITS file read-only. Image data is memory mapped unless it has to be scaled
+    (BZERO/BSCALE), in which case astropy loads the scaled data when it is accessed.
+    """
+    return pyfits.open(filepath, mode='readonly')
+
+def get_fits_memory(hdulist):
+    """
+    Number of bytes of image data loaded into memory for an HDU list. Memory mapped
+    data is not counted, but scaled data (with BZERO/BSCALE) is.
+    """
+    memory = 0
+    for hdu in hdulist:
+        if not getattr(hdu, '_data_loaded', False) or hdu.data is None:
+            continue
+        data = hdu.data
+        while getattr(data, 'base', None) is not None and not isinstance(data, np.memmap):
+            data = data.base
+        if not isinstance(data, (np.memmap, mmap.mmap)):
+            memory += hdu.data.nbytes
+    return memory
+
+# FITS files opened by the current session
+fits_cache = FileCache(open_fits, get_fits_memory, lambda hdulist: hdulist.close())
+session_file_lock = threading.RLock()
+
+def get_file(file_info):
+    """
+    Get the open file for an image. FITS files are kept open in ``fits_cache``, so
+    switching between images does not reopen them. Other files are opened by
+    ``toyz.web.viewer.get_file``.
+    """
+    if file_info['ext']!='fits':
+        return toyz.web.viewer.get_file(file_info)
+    filepath = file_info['filepath']
+    # Tasks may run on worker threads (see astrotoyz.task_queue), so the file stored in
+    # the session is only changed by one thread at a time
+    with session_file_lock:
+        key, hdulist = fits_cache.get(filepath)
+        # Toyz uses the file stored in the session to load tiles, so it uses the cached
+        # file as well
+        session_vars.filepath = filepath
+        session_vars.img_file = hdulist
+    return hdulist
+
+# World coordinates for the most recently used images. Failed parses are stored as
+# ``None`` so that they are not retried for every request
+wcs_cache = LRUCache(maxsize=16)
+# Interpolated WCS grids for fast coordinate transformations
+wcs_grid_cache = LRUCache(maxsize=16)
+
+def load_wcs(header):
+    """
+    Create a WCS from a FITS header, or return ``None`` if the header does not contain a
+    valid WCS
+    """
+    try:
+        return pywcs.WCS(header)
+    except pywcs.InvalidTransformError:
+        # Sometimes PV keywords are not erased from the header when it
+        # is converted from TPV to TAN, so if the CTYPE is TAN we
+        # remove the useless PV cards from the header to get a 
+        # valid WCS
+        if 'TAN' in header.get('CTYPE1', ''):
+            header = header.copy()
+            bad_cards = [card for card in header if card.startswith('PV')]
+            for card in bad_cards:
+                del header[card]
+            try:
+                return pywcs.WCS(header)
+            except (pywcs.InvalidTransformError, ValueError):
+                pass
+    except ValueError:
+        pass
+    return None
 
 def get_wcs(file_info, hdulist):
     """
-    Load world coordinates for the current FITS image
-    """
-    set_wcs_info = False
-    if not hasattr(session_vars, 'wcs_info'):
-        session_vars.wcs_info = {}
-        set_wcs_info = True
-    elif (file_info['filepath'] != session_vars.wcs_info['filepath'] or
-            int(file_info['frame']) != session_vars.wcs_info['frame']):
-        set_wcs_info = True
-    if set_wcs_info==True:
-        frame = int(file_info['frame'])
-        session_vars.wcs_info['filepath'] = file_info['filepath']
-        session_vars.wcs_info['frame'] = frame
-        try:
-            session_vars.wcs_info['wcs'] = pywcs.WCS(hdulist[frame].header)
-        except pywcs.InvalidTransformError:
-            # Sometimes PV keywords are not erased from the header when it
-            # is converted from TPV to TAN, so if the CTYPE is TAN we
-            # remove the useless PV cards from the header to get a 
-            # valid WCS
-            header = hdulist[frame].header
-            if 'TAN' in header['CTYPE1']:
-                bad_cards = [card for card in header if card.startswith('PV')]
-                for card in bad_cards:
-                    del header[card]
-                session_vars.wcs_info['wcs'] = pywcs.WCS(header)
-            else:
-                session_vars.wcs_info = {}
-    return session_vars.wcs_info['wcs']
+    Load world coordinates for the current FITS image. WCS objects are cached by file,
+    modification time and frame (see ``wcs_cache``). Returns ``None`` if the image does
+    not have a valid WCS.
+    """
+    frame = int(file_info['frame'])
+    key = get_file_key(file_info)
+    return wcs_cache.get_or_create(key, lambda: load_wcs(hdulist[frame].header))
+
+def get_wcs_grid(file_info, hdulist):
+    """
+    Load the interpolated WCS (:py:class:`astrotoyz.wcs_grid.WCSGrid`) for the current
+    FITS image, or ``None`` if the image does not have a valid WCS. Grids are cached
+    in ``wcs_grid_cache``.
+    """
+    frame = int(file_info['frame'])
+    def create_grid():
+        wcs = get_wcs(file_info, hdulist)
+        if wcs is None:
+            return None
+        header = hdulist[frame].header
+        return WCSGrid(wcs, (header['NAXIS2'], header['NAXIS1']))
+    return wcs_grid_cache.get_or_create(get_file_key(file_info), create_grid)
+
+def pix2world(file_info, hdulist, x, y, origin=1, tolerance=None):
+    """
+    Convert pixel coordinates in the current image to world coordinates.
+
+    Parameters
+    ----------
+    file_info: dict
+        File info for the current image
+    hdulist: `astropy.io.fits.HDUList`
+        HDU list of the current image
+    x, y: array-like
+        Pixel coordinates
+    origin: int, optional
+        Origin of the pixel coordinates
+    tolerance: float, optional
+        Required accuracy (in pixels). Small requests for images with distortions use
+        the interpolated WCS grid (see :py:mod:`astrotoyz.wcs_grid`), unless ``tolerance``
+        is smaller than the error of the grid.
+
+    Returns
+    -------
+    ra, dec: numpy arrays
+        World coordinates, or ``None`` if the image does not have a valid WCS
+    """
+    grid = get_wcs_grid(file_info, hdulist)
+    if grid is None:
+        return None
+    return grid.pix2world(x, y, origin, tolerance)
+
+def world2pix(file_info, hdulist, ra, dec, origin=1, tolerance=None):
+    """
+    Convert world coordinates to pixel coordinates in the current image.
+    See :py:func:`pix2world` for a description of the parameters.
+
+    Returns
+    -------
+    x, y: numpy arrays
+        Pixel coordinates, or ``None`` if the image does not have a valid WCS
+    """
+    grid = get_wcs_grid(file_info, hdulist)
+    if grid is None:
+        return None
+    return grid.world2pix(ra, dec, origin, tolerance)
+
+def get_img_shape(hdu):
+    """
+    Shape ``(height, width)`` of an image HDU, read from the header so that the
+    data does not have to be loaded
+    """
+    return (hdu.header['NAXIS2'], hdu.header['NAXIS1'])
+
+def read_section(hdu, ymin, ymax, xmin, xmax):
+    """
+    Read a section of an image HDU. Using ``hdu.section`` only reads (and scales, if the
+    image has BZERO/BSCALE) the pixels in the section, instead of loading the entire image.
+    """
+    try:
+        section = hdu.section
+    except AttributeError:
+        # Some HDU types (for example compressed images) do not support sections
+        return hdu.data[ymin:ymax,xmin:xmax]
+    return np.asarray(section[ymin:ymax,xmin:xmax])
 
 def get_img_data(data_type, file_info, img_info, **kwargs):
     """
@@ -66,53 +208,97 @@ def get_img_data(data_type, file_info, img_info, **kwargs):
     
     # Now add WCS info
     if file_info['ext']=='fits':
-        hdulist = toyz.web.viewer.get_file(file_info)
-        data = hdulist[int(img_info['frame'])].data
-        wcs = get_wcs(file_info, hdulist)
+        hdulist = get_file(file_info)
+        height, width = get_img_shape(hdulist[int(img_info['frame'])])
         if data_type == 'datapoint':
-            if (kwargs['x']<data.shape[1] and kwargs['y']<data.shape[0] and
+            if (kwargs['x']<width and kwargs['y']<height and
                     kwargs['x']>=0 and kwargs['y']>=0):
-                if wcs!=None:
-                    wcs_array = wcs.all_pix2world(np.array([[kwargs['x'],kwargs['y']]]),1)
-                    response['ra'] = wcs_array[0][0]
-                    response['dec'] = wcs_array[0][1]
+                world = pix2world(file_info, hdulist, kwargs['x'], kwargs['y'])
+                if world is not None:
+                    response['ra'] = world[0][0]
+                    response['dec'] = world[1][0]
     return response
 
 def get_img_info(file_info, img_info, **kwargs):
     if file_info['ext']=='fits':
-        hdulist = toyz.web.viewer.get_file(file_info)
-        hdu = hdulist[int(file_info['frame'])]
-        try:
-            coord_ranges=[map(int,coord_range.split(':')) for 
-                coord_range in hdu.header['DETSEC'][1:-1].split(',')]
-        except KeyError:
-            coord_ranges=[[1,hdu.data.shape[1]],[1,hdu.data.shape[0]]]
+        # The header keywords are read from the index, so the FITS header is only
+        # parsed when the file is new or has been modified (an empty dict is returned
+        # if the index does not have the frame, so the header is read from the file)
+        keywords = get_header_index().get_keywords(file_info['filepath'],
+            int(file_info['frame']))
+        if 'NAXIS1' in keywords and 'NAXIS2' in keywords:
+            height, width = keywords['NAXIS2'], keywords['NAXIS1']
+        else:
+            hdulist = get_file(file_info)
+            height, width = get_img_shape(hdulist[int(file_info['frame'])])
+        # Start building the tile pyramid the first time a large image is opened
+        get_pyramid(file_info['filepath'], file_info['frame'], (height, width))
+        if 'DETSEC' in keywords:
+            coord_ranges=[map(int,coord_range.split(':')) for
+                coord_range in keywords['DETSEC'].strip()[1:-1].split(',')]
+        else:
+            coord_ranges=[[1,width],[1,height]]
         img_info['coord_range'] = {
             'x': coord_ranges[0],
             'y': coord_ranges[1]
         }
     return img_info
 
-def get_2d_fit(file_info, fit_type, x, y, width, height, **kwargs):
-    hdulist = toyz.web.viewer.get_file(file_info)
-    wcs = get_wcs(file_info, hdulist)
+# Results of recent 2D fits, keyed by the file, fit type and stamp. Each Toyz session
+# runs in its own process, so this is a per-session cache.
+fit_cache = LRUCache(maxsize=256)
+
+def get_2d_fit(file_info, fit_type, x, y, width, height, adaptive=True, **kwargs):
+    """
+    Fit a source near pixel (x,y). The stamp is centered on the brightest pixel in a
+    ``width`` x ``height`` box around (x,y). If ``adaptive`` is ``True`` the stamp is
+    shrunk to the size needed for the estimated FWHM of the source.
+    Fits are cached in ``fit_cache``, so repeated clicks on the same source (or a
+    select followed by an add) only fit the stamp once.
+    """
+    hdulist = get_file(file_info)
     hdu = hdulist[int(file_info['frame'])]
     
-    # Load user specified tile
+    # Load user specified tile. Only the pixels near the source are read from the file
+    img_height, img_width = get_img_shape(hdu)
     dx = width>>1
     dy = height>>1
     xmin = max(0, x-dx)
     ymin = max(0, y-dy)
-    xmax = min(hdu.data.shape[1], x+dx)
-    ymax = min(hdu.data.shape[0], y+dy)
-    init_data = hdu.data[ymin:ymax,xmin:xmax]
+    xmax = min(img_width, x+dx)
+    ymax = min(img_height, y+dy)
+    init_data = read_section(hdu, ymin, ymax, xmin, xmax)
     # Center the tile on the pixel with the highest value
     y_center,x_center = np.unravel_index(init_data.argmax(),init_data.shape)
-    xmin = max(0, xmin+x_center-dx)
-    ymin = max(0, ymin+y_center-dy)
-    xmax = min(hdu.data.shape[1], xmin+width+1)
-    ymax = min(hdu.data.shape[0], ymin+height+1)
-    data = hdu.data[ymin:ymax,xmin:xmax]
+    x_center += xmin
+    y_center += ymin
+    if adaptive:
+        # Use the seeing map from a previous detection if one is available
+        seeing_map = astro.seeing.get_cached_seeing_map(file_info)
+        if seeing_map is not None:
+            fwhm = seeing_map.fwhm_at(x_center, y_center)
+        else:
+            fwhm = astro.detect_sources.estimate_fwhm(init_data)
+        radius = astro.detect_sources.get_stamp_radius(fwhm, max(dx, dy))
+        dx = min(dx, radius)
+        dy = min(dy, radius)
+    xmin = max(0, x_center-dx)
+    ymin = max(0, y_center-dy)
+    xmax = min(img_width, x_center+dx+1)
+    ymax = min(img_height, y_center+dy+1)
+    # Clicks near the same source snap to the same stamp, so the fit is only run once
+    key = get_file_key(file_info, fit_type, xmin, ymin, xmax, ymax)
+    response = fit_cache.get_or_create(key,
+        lambda: fit_stamp(file_info, hdulist, fit_type, ymin, ymax, xmin, xmax))
+    # Callers add to the fit parameters, so they get their own copy
+    return copy.deepcopy(response)
+
+def fit_stamp(file_info, hdulist, fit_type, ymin, ymax, xmin, xmax):
+    """
+    Fit a source in the stamp ``[ymin:ymax, xmin:xmax]`` of the current image
+    """
+    hdu = hdulist[int(file_info['frame'])]
+    data = read_section(hdu, ymin, ymax, xmin, xmax)
     
     fit, pcov = astro.detect_sources.fit_types[fit_type](data)
     param_map = astro.detect_sources.fit_dtypes[fit_type]
@@ -124,10 +310,10 @@ def get_2d_fit(file_info, fit_type, x, y, width, height, **kwargs):
         params['x'] = xmin+params['x']
         params['y'] = ymin+params['y']
         params['coords'] = str(params['x'])+', '+str(params['y'])
-        if wcs!=None:
-            wcs_array = wcs.all_pix2world(np.array([[params['x'], params['y']]]),1)
-            params['ra'] = wcs_array[0][0]
-            params['dec'] = wcs_array[0][1]
+        world = pix2world(file_info, hdulist, params['x'], params['y'])
+        if world is not None:
+            params['ra'] = world[0][0]
+            params['dec'] = world[1][0]
         response = {
             'id': 'get_2d_fit',
             'status': 'success',
@@ -139,4 +325,52 @@ def get_2d_fit(file_info, fit_type, x, y, width, height, **kwargs):
             'status': 'fit failed',
             'fit': {}
         }
-    return response
\ No newline at end of file
+    return response
+
+def create_tile(file_info, img_info, tile_info):
+    """
+    Create a tile for the viewer. When a large FITS image is zoomed out the tile is
+    created from the coarsest level of the image pyramid (see :py:mod:`astrotoyz.pyramid`)
+    that has at least as many pixels as the tile, so the number of pixels read is bounded
+    by the tile size. Otherwise (or while the pyramid is being built) the tile is created
+    by ``toyz.web.viewer.create_tile``.
+    """
+    if file_info['ext']!='fits' or img_info['scale']>=1:
+        return toyz.web.viewer.create_tile(file_info, img_info, tile_info)
+    hdulist = get_file(file_info)
+    hdu = hdulist[int(img_info['frame'])]
+    pyramid = get_pyramid(file_info['filepath'], img_info['frame'], get_img_shape(hdu))
+    if pyramid is None:
+        return toyz.web.viewer.create_tile(file_info, img_info, tile_info)
+    level = pyramid.get_level(img_info['scale'])
+    if level==0:
+        return toyz.web.viewer.create_tile(file_info, img_info, tile_info)
+    
+    from PIL import Image
+    from matplotlib import cm as cmap
+    from matplotlib.colors import Normalize
+    data = pyramid.read(level, tile_info['y0_idx'], tile_info['yf_idx'],
+        tile_info['x0_idx'], tile_info['xf_idx'])
+    width = max(1, min(tile_info['width'], data.shape[1]))
+    height = max(1, min(tile_info['height'], data.shape[0]))
+    if file_info['resampling'] == 'NEAREST':
+        x_idx = np.linspace(0, data.shape[1]-1, width).astype(int)
+        y_idx = np.linspace(0, data.shape[0]-1, height).astype(int)
+        data = data[y_idx[:,None], x_idx]
+    # FITS images have a flipped y-axis from what browsers and other image formats expect
+    if img_info['invert_y']:
+        data = np.flipud(data)
+    if img_info['invert_x']:
+        data = np.fliplr(data)
+    norm = Normalize(img_info['colormap']['px_min'], img_info['colormap']['px_max'], True)
+    colormap_name = img_info['colormap']['name']
+    if img_info['colormap']['invert_color']:
+        colormap_name = colormap_name + '_r'
+    cm = cmap.ScalarMappable(norm, getattr(cmap, colormap_name))
+    img = Image.fromarray(np.uint8(cm.to_rgba(data)*255))
+    if file_info['resampling'] != 'NEAREST':
+        img = img.resize((width, height), getattr(Image, file_info['resampling']))
+    toyz.utils.core.create_paths([os.path.dirname(tile_info['new_filepath'])])
+    img.save(tile_info['new_filepath'],
+        format=toyz.web.viewer.img_formats[file_info['tile_format']])
+    return True, tile_info
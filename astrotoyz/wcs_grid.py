@@ -0,0 +1,270 @@
+"""
+Approximate pixel to world coordinate transformations, interpolated from a coarse grid
+of exact transformations. For images with SIP or lookup table distortions astropy
+inverts ``all_pix2world`` iteratively in python, which is slow for the small requests
+made while hovering over an image, while the interpolation only takes a few operations
+per point.
+"""
+# Copyright 2015 by Fred Moolekamp
+# License: LGPLv3
+from __future__ import division, print_function
+import numpy as np
+from scipy.interpolate import RectBivariateSpline
+
+# Maximum error (in pixels) of the interpolated transformations
+default_tolerance = .01
+# Initial spacing (in pixels) between grid points. The spacing is halved until the
+# error is less than the tolerance, or it reaches ``min_spacing``
+default_spacing = 128
+min_spacing = 16
+# Number of iterations used to invert the transformation
+inverse_iterations = 6
+# Maximum number of points converted with the interpolation. Larger requests use the
+# exact WCS, since astropy evaluates it in compiled code and it is faster for many points
+max_interp_points = 10
+
+def has_distortion(wcs):
+    """
+    Whether or not a WCS has distortions (SIP or lookup tables) that astropy evaluates
+    outside of wcslib, in which case ``all_world2pix`` is solved iteratively
+    """
+    return (wcs.sip is not None or wcs.cpdis1 is not None or wcs.cpdis2 is not None or
+        wcs.det2im1 is not None or wcs.det2im2 is not None)
+
+def wrap_ra(ra, ra0):
+    """
+    Offset of ``ra`` from ``ra0`` (in degrees) in the range ``[-180, 180)``
+    """
+    return np.mod(np.asarray(ra, dtype=float)-ra0+180., 360.)-180.
+
+def tangent_plane(ra, dec, ra0, dec0):
+    """
+    Gnomonic projection of (ra, dec) about (ra0, dec0). All angles are in degrees.
+
+    Returns
+    -------
+    xi, eta: numpy arrays
+        Standard coordinates (in degrees) of each point
+    """
+    ra = np.radians(wrap_ra(ra, ra0))
+    dec = np.radians(dec)
+    dec0 = np.radians(dec0)
+    cos_c = np.sin(dec0)*np.sin(dec)+np.cos(dec0)*np.cos(dec)*np.cos(ra)
+    xi = np.cos(dec)*np.sin(ra)/cos_c
+    eta = (np.cos(dec0)*np.sin(dec)-np.sin(dec0)*np.cos(dec)*np.cos(ra))/cos_c
+    return np.degrees(xi), np.degrees(eta)
+
+class WCSGrid(object):
+    """
+    Interpolated pixel to world transformations (and their inverse) for an image.
+
+    The exact transformation is evaluated on a grid of pixels and the offsets in RA and
+    DEC from the center of the image are interpolated with bicubic splines. The inverse
+    uses an affine fit to the tangent plane coordinates of the grid, corrected by a spline
+    of the residuals. Both directions are checked at the center of every grid cell. If the
+    error is larger than ``tolerance`` the grid is refined, and if the error is still too
+    large at ``min_spacing`` the exact WCS is used.
+
+    The interpolation is only used for images with distortions (see ``has_distortion``)
+    and for requests with at most ``max_interp_points`` points. For an undistorted WCS,
+    or for more points, the exact WCS is faster.
+
+    Parameters
+    ----------
+    wcs: `astropy.wcs.WCS`
+        Exact WCS of the image
+    shape: tuple
+        Shape of the image ``(height, width)``
+    tolerance: float, optional
+        Maximum error (in pixels) of the interpolated transformations
+    spacing: int, optional
+        Initial spacing (in pixels) between grid points
+
+    Attributes
+    ----------
+    exact: bool
+        ``True`` if the interpolation could not reach the tolerance, in which case all of
+        the transformations use the exact WCS
+    error: float
+        Maximum error (in pixels) measured at the cell centers
+    spacing: int
+        Spacing between grid points used for the interpolation
+    distorted: bool
+        Whether or not the WCS has distortions, in which case small requests are
+        interpolated
+    """
+    def __init__(self, wcs, shape, tolerance=default_tolerance, spacing=default_spacing):
+        self.wcs = wcs
+        self.shape = tuple(shape)
+        self.tolerance = tolerance
+        self.exact = True
+        self.error = np.inf
+        self.distorted = has_distortion(wcs)
+        height, width = self.shape
+        center = wcs.all_pix2world(np.array([[(width-1)/2, (height-1)/2]]), 0)[0]
+        self.ra0, self.dec0 = center
+        while spacing>=min_spacing:
+            self.build(spacing)
+            if self.error<=tolerance:
+                self.exact = False
+                break
+            spacing = spacing//2
+        self.spacing = spacing
+
+    def get_nodes(self, size, spacing):
+        """
+        Positions of the grid points along an axis with ``size`` pixels. At least 4 points
+        are needed for a cubic spline.
+        """
+        num = max(4, int(np.ceil((size-1)/spacing))+1)
+        return np.linspace(0, size-1, num)
+
+    def build(self, spacing):
+        """
+        Build the interpolating splines for a grid with a given spacing and measure
+        their error at the center of each grid cell.
+        """
+        height, width = self.shape
+        self.x_nodes = self.get_nodes(width, spacing)
+        self.y_nodes = self.get_nodes(height, spacing)
+        x, y = np.meshgrid(self.x_nodes, self.y_nodes)
+        ra, dec = self.wcs.all_pix2world(x.ravel(), y.ravel(), 0)
+        grid_shape = x.shape
+
+        # Forward transformation
+        dra = wrap_ra(ra, self.ra0).reshape(grid_shape)
+        self.ra_spline = RectBivariateSpline(self.y_nodes, self.x_nodes, dra)
+        self.dec_spline = RectBivariateSpline(self.y_nodes, self.x_nodes,
+            dec.reshape(grid_shape))
+
+        # Inverse transformation: an affine fit to the tangent plane coordinates
+        # plus a spline of the residuals
+        xi, eta = tangent_plane(ra, dec, self.ra0, self.dec0)
+        design = np.column_stack([xi, eta, np.ones(xi.shape)])
+        pixels = np.column_stack([x.ravel(), y.ravel()])
+        self.affine = np.linalg.lstsq(design, pixels, rcond=-1)[0]
+        residuals = pixels-design.dot(self.affine)
+        self.dx_spline = RectBivariateSpline(self.y_nodes, self.x_nodes,
+            residuals[:,0].reshape(grid_shape))
+        self.dy_spline = RectBivariateSpline(self.y_nodes, self.x_nodes,
+            residuals[:,1].reshape(grid_shape))
+
+        # Check the error at the center of each cell
+        x_mid = .5*(self.x_nodes[1:]+self.x_nodes[:-1])
+        y_mid = .5*(self.y_nodes[1:]+self.y_nodes[:-1])
+        x_mid, y_mid = [coord.ravel() for coord in np.meshgrid(x_mid, y_mid)]
+        ra_exact, dec_exact = self.wcs.all_pix2world(x_mid, y_mid, 0)
+        ra_approx, dec_approx = self.interp_pix2world(x_mid, y_mid)
+        x_approx, y_approx = self.interp_world2pix(ra_exact, dec_exact)
+        # Convert the error in world coordinates to pixels using the affine transform
+        xi_exact, eta_exact = tangent_plane(ra_exact, dec_exact, self.ra0, self.dec0)
+        xi_approx, eta_approx = tangent_plane(ra_approx, dec_approx, self.ra0, self.dec0)
+        delta = np.column_stack([xi_approx-xi_exact, eta_approx-eta_exact]).dot(
+            self.affine[:2])
+        forward_error = np.max(np.hypot(delta[:,0], delta[:,1]))
+        inverse_error = np.max(np.hypot(x_approx-x_mid, y_approx-y_mid))
+        self.error = max(forward_error, inverse_error)
+
+    def interp_pix2world(self, x, y):
+        """
+        Interpolate the world coordinates of (x,y), using 0 based pixel coordinates
+        """
+        ra = np.mod(self.ra0+self.ra_spline.ev(y, x), 360.)
+        dec = self.dec_spline.ev(y, x)
+        return ra, dec
+
+    def interp_world2pix(self, ra, dec):
+        """
+        Interpolate the 0 based pixel coordinates of (ra, dec)
+        """
+        xi, eta = tangent_plane(ra, dec, self.ra0, self.dec0)
+        x0 = self.affine[0,0]*xi+self.affine[1,0]*eta+self.affine[2,0]
+        y0 = self.affine[0,1]*xi+self.affine[1,1]*eta+self.affine[2,1]
+        x = x0
+        y = y0
+        # The residuals are small and smooth, so a fixed point iteration converges quickly
+        for n in range(inverse_iterations):
+            x_new = x0+self.dx_spline.ev(y, x)
+            y_new = y0+self.dy_spline.ev(y, x)
+            change = np.max(np.abs(x_new-x)+np.abs(y_new-y)) if x.size>0 else 0
+            x = x_new
+            y = y_new
+            if change<.1*self.tolerance:
+                break
+        return x, y
+
+    def use_interp(self, num_points, tolerance):
+        """
+        Whether or not to use the interpolation to convert ``num_points`` points with
+        the required ``tolerance``
+        """
+        if self.exact or not self.distorted or num_points>max_interp_points:
+            return False
+        return tolerance is None or tolerance>=self.error
+
+    def inside(self, x, y):
+        """
+        Whether or not each point is inside the grid (outside the grid the splines would
+        be extrapolated)
+        """
+        height, width = self.shape
+        return (x>=0) & (x<=width-1) & (y>=0) & (y<=height-1)
+
+    def pix2world(self, x, y, origin=0, tolerance=None):
+        """
+        Convert pixel coordinates to world coordinates.
+
+        Parameters
+        ----------
+        x, y: array-like
+            Pixel coordinates
+        origin: int, optional
+            Origin of the pixel coordinates (0 for numpy, 1 for FITS)
+        tolerance: float, optional
+            Required accuracy (in pixels). If this is smaller than the error of the
+            grid the exact WCS is used. Defaults to the tolerance of the grid.
+
+        Returns
+        -------
+        ra, dec: numpy arrays
+            World coordinates (in degrees)
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))-origin
+        y = np.atleast_1d(np.asarray(y, dtype=float))-origin
+        if not self.use_interp(x.size, tolerance):
+            return self.wcs.all_pix2world(x, y, 0)
+        ra, dec = self.interp_pix2world(x, y)
+        outside = ~self.inside(x, y)
+        if np.any(outside):
+            ra[outside], dec[outside] = self.wcs.all_pix2world(x[outside], y[outside], 0)
+        return ra, dec
+
+    def world2pix(self, ra, dec, origin=0, tolerance=None):
+        """
+        Convert world coordinates to pixel coordinates.
+
+        Parameters
+        ----------
+        ra, dec: array-like
+            World coordinates (in degrees)
+        origin: int, optional
+            Origin of the pixel coordinates (0 for numpy, 1 for FITS)
+        tolerance: float, optional
+            Required accuracy (in pixels). If this is smaller than the error of the
+            grid the exact WCS is used. Defaults to the tolerance of the grid.
+
+        Returns
+        -------
+        x, y: numpy arrays
+            Pixel coordinates
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        if not self.use_interp(ra.size, tolerance):
+            x, y = self.wcs.all_world2pix(ra, dec, 0)
+        else:
+            x, y = self.interp_world2pix(ra, dec)
+            outside = ~self.inside(x, y)
+            if np.any(outside):
+                x[outside], y[outside] = self.wcs.all_world2pix(ra[outside], dec[outside], 0)
+        return x+origin, y+origin
@@ -110,11 +110,11 @@ setup(name=PACKAGENAME,
       install_requires=['numpy>=1.5.1','astropy', 'toyz>=1.0'],
       extras_require={
           'base': [
-              'scipy>=0.15',
+              'scipy>=0.18',
               'matplotlib',
           ],
           'all': [
-              'scipy>=0.15',
+              'scipy>=0.18',
               'matplotlib',
               'sqlalchemy',
               'pillow',